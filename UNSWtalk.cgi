@@ -2,24 +2,29 @@
 
 # This script allows UNSwtalk.py to also be run as a CGI script
 #
-# You should not need to change this script
+# CGI starts Python for every request, use serve.py or UNSWtalk.wsgi
+# for a persistent server. Set UNSWTALK_DEBUG=1 to get the werkzeug debugger.
+# Each request only checks the schema version (upgrade_db) and loads the
+# social graph / autocomplete index only if it uses them.
 #
 
 import os, sys, traceback
 
 try:
     from wsgiref.handlers import CGIHandler
-    from werkzeug.debug import DebuggedApplication
 
-    from UNSWtalk import app
+    from UNSWtalk import create_app
 
     if 'PATH_INFO' not in os.environ:
         os.environ['PATH_INFO'] = ''
 
-    # run the Flask app in debug mode
-    app.secret_key = 'correct horse battery staple'
-    app.debug = True
-    CGIHandler().run(DebuggedApplication(app))
+    debug = os.environ.get('UNSWTALK_DEBUG') == '1'
+    # no maintenance thread in a process that ends with the request
+    application = create_app(debug = debug, preload = False, scheduler = False)
+    if debug:
+        from werkzeug.debug import DebuggedApplication
+        application = DebuggedApplication(application)
+    CGIHandler().run(application)
 except Exception:
     # catch any exceptions that escape Flask and print useful information
     print('Content-Type: text/plain\n', flush=True)
@@ -4,13 +4,27 @@
 import os
 import re
 import sys
+import math
 import sqlite3
-from datetime import datetime
-from flask import Flask, render_template, session, redirect, url_for, request, g
-from werkzeug import secure_filename
-import subprocess
+from datetime import datetime, timezone
+from functools import lru_cache
+from flask import Flask, render_template, session, redirect, url_for, request, g, jsonify, Response, stream_with_context, has_app_context
 import random
 import string
+import time
+import threading
+import json
+import queue
+import zipfile
+import heapq
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+from struct import error as struct_error
+from social_graph import SocialGraph, SearchTimeout
+from prefix_index import PrefixIndex
+from ranking import register_functions, rescore_posts, affinity_score
+from shards import ShardMap, seed_sequences
 
 # ------------------------------------------------------- #
 #                Common Helper Functions                  #
@@ -19,7 +33,54 @@ import string
 # Global vars:
 DATABASE_NAME = "dataset-medium"
 DATABASE_PATH = "db/{}.db".format(DATABASE_NAME)
+# shard map (shards.py), without it DATABASE_PATH is the only shard
+SHARD_CONFIG_PATH = "db/{}.shards.json".format(DATABASE_NAME)
 ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
+SECRET_KEY_PATH = "db/secret_key"
+TEMPLATE_CACHE_DIR = "db/template_cache"
+UPGRADE_SCHEMA_PATH = "db/db_upgrade.sql"
+# bump when upgrade_shard changes (changes of db_upgrade.sql are detected, see get_schema_version)
+UPGRADE_CODE_VERSION = 1
+CACHE_MAX_SIZE = 50000
+CHANGE_LOG_KEEP = 20000
+DELETE_CHUNK_SIZE = 200
+GRAPH_SNAPSHOT_PATH = "db/social_graph.bin"
+CONNECTION_MAX_DEPTH = 4
+CONNECTION_TIME_BUDGET = 0.02
+MENTIONS_PAGE_SIZE = 20
+COURSE_FEED_PAGE_SIZE = 20
+TOP_FEED_SIZE = 50
+TOP_FEED_CANDIDATES = 150
+# authors per top feed query (2 parameters each, SQLite allows 500 UNION ALL terms)
+TOP_FEED_UNION_SIZE = 250
+RESCORE_CHUNK_SIZE = 500
+NOTIFICATION_POLL_INTERVAL = 1.0
+NOTIFICATION_HEARTBEAT = 15
+NOTIFICATION_BACKLOG = 100
+# seconds a stream stays open, the browser then reconnects (with Last-Event-ID)
+NOTIFICATION_STREAM_LIFETIME = 300
+AUTOCOMPLETE_LIMIT = 10
+AUTOCOMPLETE_SCAN = 500
+EXPORT_CHUNK_SIZE = 500
+EXPORT_FILE_CHUNK = 64 * 1024
+# keys per WHERE ... IN (...) of a batch (SQLite's default parameter limit)
+BATCH_MAX_PARAMS = 999
+ZID_PATTERN = re.compile('z[0-9]{7}')
+DB_BUSY_TIMEOUT_MS = 5000
+DB_WRITE_RETRIES = 5
+DB_MMAP_SIZE = 256 * 1024 * 1024
+NEARBY_RADIUS_KM = 5
+NEARBY_MAX_RADIUS_KM = 100
+NEARBY_PAGE_SIZE = 20
+# maintenance scheduler (see Maintenance jobs), times in seconds
+MAINTENANCE_TICK = 60
+MAINTENANCE_LEASE = 6 * 3600
+MAINTENANCE_LOG_KEEP = 30 * 24 * 3600
+CONFIRMATION_TTL = 7 * 24 * 3600
+VACUUM_STEP_PAGES = 256
+ANALYSIS_LIMIT = 1000
+SUGGESTION_CHUNK_SIZE = 200
+SUGGESTION_MAX_AGE = 24 * 3600
 
 
 # Function : transform message
@@ -27,8 +88,7 @@ ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
 # zid --> full_name with link to homepage
 def transform_message(message):
     message = re.sub(r'\\n', '<br>', message)
-    zid_pattern = re.compile('z[0-9]{7}')
-    zids = set(re.findall(zid_pattern, message))
+    zids = set(re.findall(ZID_PATTERN, message))
     for curr_zid in zids:
         curr_profile = get_profile_by_zid(curr_zid)
         # if this zid exists --> replace it with link
@@ -39,29 +99,998 @@ def transform_message(message):
 
 
 # Function : transform time
-# 2016-05-13T04:35:53+0000 --> 2016-05-13 04:35:53
-def transform_time(time):
-    time = str(time)
-    time = re.sub(r'\+[0-9]{4}', '', time)
-    time = re.sub(r'T', ' ', time)
-    return time
+# 1463114153 (UTC epoch seconds) --> 2016-05-13 04:35:53
+# The same times are rendered over and over (feeds, threads), so cache them
+@lru_cache(maxsize = 65536)
+def transform_time(timestamp):
+    if timestamp == None:
+        return ""
+    return datetime.fromtimestamp(int(timestamp), timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+# ------------------------------------------------------- #
+#           Database access : read and write paths        #
+# ------------------------------------------------------- #
+# Reads use read-only connections (one per thread) that never take a write
+# lock, so under WAL they never block and are never blocked by writers.
+# All writes of a process go through one writer connection, serialized by
+# WRITE_LOCKS, each in a short BEGIN IMMEDIATE transaction.
+#
+# The data may be split over several database files (shards.py): every
+# function takes the shard to use (0 when there is only one). Reads over
+# all shards run in parallel (db_read_all) and their rows are merged.
+
+SHARD_MAP = ShardMap.load(SHARD_CONFIG_PATH, DATABASE_PATH)
+# Contention metrics of this worker, see /api/db_stats
+DB_STATS = {
+    'reads': 0, 'read_seconds': 0.0,
+    'writes': 0, 'write_seconds': 0.0,
+    'lock_wait_seconds': 0.0, 'max_lock_wait_seconds': 0.0,
+    'busy_retries': 0, 'busy_errors': 0,
+}
+# Request threads update DB_STATS concurrently, see add_db_stats
+DB_STATS_LOCK = threading.Lock()
+# One writer (and lock) per shard
+WRITE_LOCKS = [threading.RLock() for path in SHARD_MAP.paths]
+# Connections must not be shared with forked workers: remember the owner pid
+read_local = threading.local()
+writers = [{'pid': None, 'conn': None} for path in SHARD_MAP.paths]
+# Callbacks to run once the outermost transaction of this thread committed
+transaction_local = threading.local()
+# Threads of db_read_all, started on first use in each worker
+fan_out = {'pid': None, 'pool': None}
+
+
+# Function: shard_of
+# The shard holding the rows of zid
+def shard_of(zid):
+    return SHARD_MAP.shard_for_zid(zid)
+
+
+# Function: get_read_connection
+# Read-only connection of the current thread to shard (mode=ro, query_only, mmap)
+# It is in autocommit mode: every SELECT reads the latest committed snapshot
+def get_read_connection(shard = 0):
+    if getattr(read_local, 'pid', None) != os.getpid():
+        read_local.conns = {}
+        read_local.pid = os.getpid()
+    conn = read_local.conns.get(shard)
+    if conn == None:
+        uri = "file:{}?mode=ro".format(os.path.abspath(SHARD_MAP.paths[shard]))
+        conn = sqlite3.connect(uri, uri = True, isolation_level = None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA query_only = 1")
+        conn.execute("PRAGMA mmap_size = {}".format(DB_MMAP_SIZE))
+        conn.execute("PRAGMA busy_timeout = {}".format(DB_BUSY_TIMEOUT_MS))
+        conn.create_function('distance_km', 4, get_sql_distance_km, deterministic = True)
+        read_local.conns[shard] = conn
+    return conn
+
+
+# Function: close_connections
+# Close this process' connections (before forking workers)
+def close_connections():
+    for conn in getattr(read_local, 'conns', {}).values():
+        conn.close()
+    read_local.conns = {}
+    for writer in writers:
+        if writer['conn'] != None:
+            writer['conn'].close()
+            writer['conn'] = None
+    if fan_out['pool'] != None and fan_out['pid'] == os.getpid():
+        fan_out['pool'].shutdown()
+    fan_out['pool'] = None
+
+
+# Function: get_write_connection
+# The writer connection of this process to shard, only used under WRITE_LOCKS[shard]
+def get_write_connection(shard = 0):
+    writer = writers[shard]
+    if writer['conn'] == None or writer['pid'] != os.getpid():
+        conn = sqlite3.connect(SHARD_MAP.paths[shard], isolation_level = None, check_same_thread = False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA busy_timeout = {}".format(DB_BUSY_TIMEOUT_MS))
+        # post_score() for update_post_score / rescore_all_posts
+        register_functions(conn)
+        writer['conn'] = conn
+        writer['pid'] = os.getpid()
+    return writer['conn']
+
+
+# Function: get_cursor_shard
+# The shard of a cursor from db_transaction
+def get_cursor_shard(cur):
+    for shard, writer in enumerate(writers):
+        if writer['conn'] is cur.connection:
+            return shard
+    raise ValueError("not a cursor of db_transaction")
+
+
+# Function: is_busy_error
+def is_busy_error(error):
+    message = str(error)
+    return 'locked' in message or 'busy' in message
+
+
+# Function: db_read
+# Run a SELECT on the read path
+# Input:
+#       sql: str, SQL script
+#       params: list, params for SQL
+#       shard: the shard to read
+# Output:
+#       list of sqlite3.Row
+def db_read(sql, params, shard = 0):
+    start = time.perf_counter()
+    try:
+        return get_read_connection(shard).execute(sql, params).fetchall()
+    finally:
+        add_db_stats(reads = 1, read_seconds = time.perf_counter() - start)
+
+
+# Function: add_db_stats
+# Add amounts to the DB_STATS counters (max_* ones keep the largest value)
+def add_db_stats(**amounts):
+    with DB_STATS_LOCK:
+        for name, amount in amounts.items():
+            if name.startswith('max_'):
+                DB_STATS[name] = max(DB_STATS[name], amount)
+            else:
+                DB_STATS[name] += amount
+
+
+# Function: db_read_shards
+# Run one SELECT per shard, in parallel when there are several
+# Input: queries: {shard: (sql, params)}
+# Output: {shard: list of sqlite3.Row}
+def db_read_shards(queries):
+    if len(queries) <= 1:
+        return {shard: db_read(sql, params, shard) for shard, (sql, params) in queries.items()}
+    if fan_out['pool'] == None or fan_out['pid'] != os.getpid():
+        fan_out['pool'] = ThreadPoolExecutor(max_workers = SHARD_MAP.count, thread_name_prefix = 'shard-read')
+        fan_out['pid'] = os.getpid()
+    futures = {shard: fan_out['pool'].submit(db_read, sql, params, shard) for shard, (sql, params) in queries.items()}
+    return {shard: future.result() for shard, future in futures.items()}
+
+
+# Function: merge_rows
+# Merge the rows of several shards, each already sorted by key
+# Output: list of rows (all of them in shard order when key is None)
+def merge_rows(results, key = None, reverse = False, limit = None):
+    if key == None:
+        rows = [row for shard in sorted(results) for row in results[shard]]
+    elif len(results) == 1:
+        rows = list(results.popitem()[1])
+    else:
+        rows = list(heapq.merge(*results.values(), key = key, reverse = reverse))
+    return rows if limit == None else rows[:limit]
+
+
+# Function: db_read_all
+# Run a SELECT on every shard and merge the results (see merge_rows)
+# With an ORDER BY ... LIMIT, each shard returns at most LIMIT rows and
+# the merge keeps the first limit
+def db_read_all(sql, params, key = None, reverse = False, limit = None):
+    results = db_read_shards({shard: (sql, params) for shard in range(SHARD_MAP.count)})
+    return merge_rows(results, key, reverse, limit)
+
+
+# Function: locate_row
+# Shard of the row "id" of table (POST, COMMENT, REPLY), None if not found
+# The id range is tried first, then the other shards (rows moved by a rebalance)
+def locate_row(table, row_id):
+    if SHARD_MAP.count == 1:
+        return 0
+    try:
+        row_id = int(row_id)
+    except (TypeError, ValueError):
+        return None
+    hint = SHARD_MAP.shard_for_id(row_id)
+    shards = list(range(SHARD_MAP.count))
+    if hint != None:
+        shards.remove(hint)
+        shards.insert(0, hint)
+    for shard in shards:
+        if len(db_read("SELECT 1 FROM {} WHERE id = ?".format(table), [row_id], shard)) != 0:
+            return shard
+    return None
+
+
+# Function: db_transaction
+# Context manager for a write transaction on the write path of shard:
+#       with db_transaction(shard) as cur:
+#           cur.execute(...)
+# BEGIN IMMEDIATE takes the database write lock up front (waiting up to
+# DB_BUSY_TIMEOUT_MS); COMMIT on success, ROLLBACK on any exception.
+# Nested calls on the same shard join the outer transaction.
+@contextmanager
+def db_transaction(shard = 0):
+    wait_start = time.perf_counter()
+    outermost = getattr(transaction_local, 'after_commit', None) == None
+    if outermost:
+        transaction_local.after_commit = []
+    try:
+        with WRITE_LOCKS[shard]:
+            conn = get_write_connection(shard)
+            if conn.in_transaction:
+                yield conn.cursor()
+                return
+            for attempt in range(DB_WRITE_RETRIES):
+                try:
+                    conn.execute("BEGIN IMMEDIATE")
+                    break
+                except sqlite3.OperationalError as error:
+                    if not is_busy_error(error):
+                        raise
+                    if attempt == DB_WRITE_RETRIES - 1:
+                        add_db_stats(busy_errors = 1)
+                        raise
+                    add_db_stats(busy_retries = 1)
+                    time.sleep(0.01 * 2 ** attempt)
+            lock_wait = time.perf_counter() - wait_start
+            add_db_stats(lock_wait_seconds = lock_wait, max_lock_wait_seconds = lock_wait)
+            start = time.perf_counter()
+            try:
+                yield conn.cursor()
+                conn.execute("COMMIT")
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+            finally:
+                add_db_stats(writes = 1, write_seconds = time.perf_counter() - start)
+    except BaseException:
+        if outermost:
+            transaction_local.after_commit = None
+        raise
+    if not outermost:
+        return
+    callbacks, transaction_local.after_commit = transaction_local.after_commit, None
+    for callback in callbacks:
+        callback()
+    # this worker sees its own writes immediately
+    poll_changes()
+
+
+# Function: db_transactions
+# One transaction on each of shards (entered in shard order, so two
+# threads never wait for each other), for writes touching two students:
+#       with db_transactions([shard1, shard2]) as curs:
+#           curs[shard1].execute(...)
+# Each shard commits on its own: if a later commit fails, the earlier
+# ones are not rolled back.
+@contextmanager
+def db_transactions(shards):
+    with ExitStack() as stack:
+        yield {shard: stack.enter_context(db_transaction(shard)) for shard in sorted(set(shards))}
+
+
+# Function: after_commit
+# Run callback once the transaction of this thread committed (now if
+# there is none), e.g. to write to another shard without holding two locks
+def after_commit(callback):
+    callbacks = getattr(transaction_local, 'after_commit', None)
+    if callbacks == None:
+        callback()
+    else:
+        callbacks.append(callback)
+
+
+# Function: db_write
+# Run one INSERT / UPDATE / DELETE in its own short transaction
+def db_write(sql, params, shard = 0):
+    with db_transaction(shard) as cur:
+        cur.execute(sql, params)
+        return cur.fetchall()
 
 
 # Function: db_query
 # Handle general database operations
+# SELECT goes to the read path, everything else to the write path
 # Input: 
 #       sql: str, SQL script
 #       params: list, params for SQL
+#       shard: the shard to use
 # Output: 
 #       Operation results for SQL, e.g. SELECT, INSERT, DELETE
-# DATABASE_PATH = "db/dataset-small.db";
-def db_query(sql, params):
-    with sqlite3.connect(DATABASE_PATH) as conn:
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-        cur.execute(sql, params)
-        return cur.fetchall()
+def db_query(sql, params, shard = 0):
+    if sql.lstrip()[:6].upper() == 'SELECT':
+        return db_read(sql, params, shard)
+    return db_write(sql, params, shard)
+
+
+# Function: upgrade_db
+# Apply db_upgrade.sql (idempotent) to bring every shard up to date
+# Shards already upgraded by this version (PRAGMA user_version) are skipped,
+# so starting the app (every CGI request) only reads one pragma per shard
+def upgrade_db():
+    with open(UPGRADE_SCHEMA_PATH) as f:
+        upgrade_sql = f.read()
+    version = get_schema_version(upgrade_sql)
+    outdated = []
+    for shard, path in enumerate(SHARD_MAP.paths):
+        with sqlite3.connect(path) as conn:
+            if conn.execute("PRAGMA user_version").fetchone()[0] != version:
+                outdated.append(shard)
+    if len(outdated) == 0:
+        return
+    # mentions may name the students of any shard
+    students = get_all_students() if SHARD_MAP.count > 1 else None
+    for shard in outdated:
+        with sqlite3.connect(SHARD_MAP.paths[shard]) as conn:
+            upgrade_shard(conn, upgrade_sql, students)
+            seed_sequences(conn, SHARD_MAP.first_id(shard))
+            conn.execute("PRAGMA user_version = {}".format(version))
+
+
+# Function: get_schema_version
+# Version stored in PRAGMA user_version once a shard is upgraded: changes
+# with db_upgrade.sql and UPGRADE_CODE_VERSION (a positive 31 bit integer)
+def get_schema_version(upgrade_sql):
+    return zlib.crc32("{}\n{}".format(UPGRADE_CODE_VERSION, upgrade_sql).encode('utf-8')) & 0x7fffffff or 1
+
+
+# Function: get_all_students
+# zids of the students (suspended too) of all shards
+def get_all_students():
+    students = set()
+    for path in SHARD_MAP.paths:
+        with sqlite3.connect(path) as conn:
+            students.update(row[0] for row in conn.execute("SELECT zid FROM STUDENT UNION SELECT zid FROM TO_BE_SUSPENDED"))
+    return students
+
+
+# Function: upgrade_shard
+# Apply db_upgrade.sql to one database file
+def upgrade_shard(conn, upgrade_sql, students = None):
+    # WAL: readers and the writer do not block each other
+    conn.execute("PRAGMA journal_mode = WAL")
+    for table in ['POST', 'COMMENT', 'REPLY']:
+        migrate_time_column(conn, table)
+    has_mentions = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'MENTION'").fetchone()
+    added_counters = False
+    for table, columns in COUNTER_COLUMNS:
+        added_counters |= add_missing_columns(conn, table, [(column, "INTEGER NOT NULL DEFAULT 0") for column in columns])
+    added_score = add_missing_columns(conn, 'POST', [('score', "REAL NOT NULL DEFAULT 0")])
+    if add_missing_columns(conn, 'TO_BE_CONFIRMED', [('created', "INTEGER NOT NULL DEFAULT 0")]):
+        # pending registrations of older databases expire CONFIRMATION_TTL from now
+        conn.execute("UPDATE TO_BE_CONFIRMED SET created = ?", [int(time.time())])
+    conn.executescript(upgrade_sql)
+    if has_mentions == None:
+        from build_db import backfill_mentions
+        backfill_mentions(conn, students)
+    if added_counters:
+        for table, repair_sql in COUNTER_REPAIR_SQL:
+            conn.execute(repair_sql)
+    if added_counters or added_score:
+        rescore_posts(conn)
+
+
+# Counter columns (see db_upgrade.sql), maintained by triggers
+COUNTER_COLUMNS = [
+    ('POST', ['comment_count', 'reply_count']),
+    ('STUDENT', ['post_count', 'friend_count']),
+    ('TO_BE_SUSPENDED', ['post_count', 'friend_count']),
+]
+# Recompute every counter, only rows whose counters are wrong are written
+COUNTER_REPAIR_SQL = [
+    ('POST', """UPDATE POST SET comment_count = X.comments, reply_count = X.replies
+        FROM (SELECT P.id,
+                (SELECT count(*) FROM COMMENT WHERE post_id = P.id) AS comments,
+                (SELECT count(*) FROM REPLY R JOIN COMMENT C ON C.id = R.comment_id WHERE C.post_id = P.id) AS replies
+              FROM POST P) AS X
+        WHERE X.id = POST.id AND (POST.comment_count, POST.reply_count) != (X.comments, X.replies)"""),
+]
+for table in ['STUDENT', 'TO_BE_SUSPENDED']:
+    COUNTER_REPAIR_SQL.append((table, """UPDATE {0} SET post_count = X.posts, friend_count = X.friends
+        FROM (SELECT S.zid,
+                (SELECT count(*) FROM POST WHERE zid = S.zid) AS posts,
+                (SELECT count(*) FROM FRIENDS WHERE zid = S.zid) AS friends
+              FROM {0} S) AS X
+        WHERE X.zid = {0}.zid AND ({0}.post_count, {0}.friend_count) != (X.posts, X.friends)""".format(table)))
+
+
+# Function: add_missing_columns
+# Add the columns missing in databases built before them
+# Input: columns: list of (name, type and constraints)
+# Output: True if any column was added (its values must then be computed)
+def add_missing_columns(conn, table, columns):
+    added = False
+    names = [column[1] for column in conn.execute("PRAGMA table_info({})".format(table)).fetchall()]
+    for column, definition in columns:
+        if column not in names:
+            conn.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table, column, definition))
+            added = True
+    return added
+
+
+# Function: repair_counters
+# Recompute all counters (./maintenance.py repair_counters), one
+# transaction per table and shard
+# Output: dict of table -> rows corrected
+def repair_counters():
+    results = {}
+    for shard in range(SHARD_MAP.count):
+        for table, repair_sql in COUNTER_REPAIR_SQL:
+            with db_transaction(shard) as cur:
+                cur.execute(repair_sql)
+                results[table] = results.get(table, 0) + cur.rowcount
+    return results
+
+
+# Function: update_post_score
+# Recompute the score of one post (ranking.post_score) after its counters
+# changed, in the caller's transaction (cur from db_transaction)
+def update_post_score(cur, post_id):
+    cur.execute("UPDATE POST SET score = post_score(time, comment_count, reply_count) WHERE id = ?", [post_id])
+
+
+# Function: rescore_all_posts
+# Recompute every score (./maintenance.py rescore_posts), RESCORE_CHUNK_SIZE
+# posts per transaction, only changed scores are written
+# Output: number of posts rescored
+def rescore_all_posts():
+    rescored = 0
+    for shard in range(SHARD_MAP.count):
+        last_id = 0
+        while True:
+            with db_transaction(shard) as cur:
+                ids = [row['id'] for row in cur.execute("SELECT id FROM POST WHERE id > ? ORDER BY id LIMIT ?", [last_id, RESCORE_CHUNK_SIZE]).fetchall()]
+                if len(ids) == 0:
+                    break
+                cur.execute("UPDATE POST SET score = post_score(time, comment_count, reply_count) WHERE id BETWEEN ? AND ? AND score != post_score(time, comment_count, reply_count)", [ids[0], ids[-1]])
+                rescored += cur.rowcount
+            last_id = ids[-1]
+    return rescored
+
+
+# Function: migrate_time_column
+# Databases built before times were epoch integers store them as TEXT
+# (2016-05-13T04:35:53+0000): rebuild the table with an INTEGER time column
+# Triggers and indexes are dropped with the old table, db_upgrade.sql recreates them
+def migrate_time_column(conn, table):
+    columns = conn.execute("PRAGMA table_info({})".format(table)).fetchall()
+    if not any(column[1] == 'time' and column[2].upper() == 'TEXT' for column in columns):
+        return
+    from build_db import parse_time
+    conn.create_function('parse_time', 1, parse_time)
+    create_sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", [table]).fetchone()[0]
+    create_sql = re.sub(r'\btime(\s+)TEXT', r'time\1INTEGER', create_sql)
+    create_sql = re.sub(r'^CREATE TABLE\s+"?{}"?'.format(table), 'CREATE TABLE {}_MIGRATE'.format(table), create_sql)
+    names = [column[1] for column in columns]
+    select_names = ["parse_time(time)" if name == 'time' else name for name in names]
+    conn.execute("DROP TABLE IF EXISTS {}_MIGRATE".format(table))
+    conn.execute(create_sql)
+    conn.execute("INSERT INTO {}_MIGRATE ({}) SELECT {} FROM {}".format(table, ", ".join(names), ", ".join(select_names), table))
+    conn.execute("DROP TABLE {}".format(table))
+    conn.execute("ALTER TABLE {}_MIGRATE RENAME TO {}".format(table, table))
+
+
+# ------------------------------------------------------- #
+#          Cache and cross-worker invalidation            #
+# ------------------------------------------------------- #
+
+# Cached query results of this worker: (table, key) -> rows
+# Entries are evicted when CHANGE_LOG reports a write to (table, zid / ref),
+# so a write in any worker process is seen by all of them on their next request
+CACHE = {}
+# Functions called as listener(tbl, op, zid, ref) for every change,
+# and as listener(None, None, None, None) when everything must be reloaded
+CHANGE_LISTENERS = []
+# Last CHANGE_LOG id of each shard seen by this worker, None before the first poll
+last_change_ids = None
+# Held while polling and by the listeners: never waits for WRITE_LOCKS
+# (writers may read through the cache and the listeners' data while they hold one)
+CHANGE_LOCK = threading.RLock()
+# CHANGE_LOG ids to prune, shard -> last id deleted, see prune_change_log
+change_log_prunes = {}
+# Guards writes to CACHE and CONNECTION_PATHS and their generations,
+# taken last (nothing is waited for under it)
+CACHE_LOCK = threading.Lock()
+# Number of changes seen by evict_cache, see cache_put
+cache_generation = 0
+
+
+# Function: cache_put
+# Cache the rows of (tbl, key), read with BatchLoader
+# Rows are sqlite3.Row (read-only), callers copy them with dict()
+# Input: generation: cache_generation before value was read; if a change was
+#        polled since, value may be older than the eviction and is not cached
+def cache_put(tbl, key, value, generation):
+    with CACHE_LOCK:
+        if generation != cache_generation:
+            return
+        if len(CACHE) >= CACHE_MAX_SIZE:
+            CACHE.clear()
+        CACHE[(tbl, key)] = value
+
+
+# Function: on_change
+# Decorator: register a listener for CHANGE_LOG entries
+def on_change(listener):
+    CHANGE_LISTENERS.append(listener)
+    return listener
+
+
+# Function: evict_cache
+# Drop the cache entries touched by one change
+@on_change
+def evict_cache(tbl, op, zid, ref):
+    global cache_generation
+    with CACHE_LOCK:
+        cache_generation += 1
+        if tbl == None:
+            CACHE.clear()
+            return
+        CACHE.pop((tbl, zid), None)
+        if ref != None:
+            CACHE.pop((tbl, str(ref)), None)
+
+
+# Function: notify_change_listeners
+def notify_change_listeners(tbl, op, zid, ref):
+    for listener in CHANGE_LISTENERS:
+        listener(tbl, op, zid, ref)
+
+
+# Function: poll_changes
+# Read the CHANGE_LOG entries written since the last poll and pass them to
+# the listeners. A single indexed range scan per shard, cheap enough to run
+# per request. If entries were pruned before this worker saw them, reset everything.
+# Pruning the log is left to prune_change_log (it writes).
+def poll_changes():
+    with CHANGE_LOCK:
+        poll_changes_locked()
+
+
+def poll_changes_locked():
+    global last_change_ids
+    if last_change_ids == None:
+        results = db_read_shards({shard: ("SELECT max(id) AS id FROM CHANGE_LOG", []) for shard in range(SHARD_MAP.count)})
+        last_change_ids = {shard: rows[0]['id'] or 0 for shard, rows in results.items()}
+        return
+    results = db_read_shards({shard: ("SELECT id, tbl, op, zid, ref FROM CHANGE_LOG WHERE id > ? ORDER BY id", [last_change_id])
+                              for shard, last_change_id in last_change_ids.items()})
+    for shard, changes in sorted(results.items()):
+        if len(changes) == 0:
+            continue
+        last_change_id = last_change_ids[shard]
+        if changes[0]['id'] != last_change_id + 1:
+            notify_change_listeners(None, None, None, None)
+        else:
+            for change in changes:
+                notify_change_listeners(change['tbl'], change['op'], change['zid'], change['ref'])
+        last_change_ids[shard] = changes[-1]['id']
+        # keep the log short (every 1000 changes), lagging workers will reset
+        if changes[-1]['id'] // 1000 != last_change_id // 1000:
+            change_log_prunes[shard] = last_change_ids[shard] - CHANGE_LOG_KEEP
+
+
+# Function: prune_change_log
+# Delete the CHANGE_LOG entries marked by poll_changes, after CHANGE_LOCK is
+# released: a writer holding WRITE_LOCKS[shard] may be waiting for it
+def prune_change_log():
+    with CHANGE_LOCK:
+        prunes = dict(change_log_prunes)
+        change_log_prunes.clear()
+    for shard, last_id in sorted(prunes.items()):
+        db_write("DELETE FROM CHANGE_LOG WHERE id <= ?", [last_id], shard)
+
+
+# ------------------------------------------------------- #
+#                Social graph (FRIENDS)                   #
+# ------------------------------------------------------- #
+
+# The SocialGraph of this worker, see get_social_graph
+social_graph = {'graph': None}
+
+
+# Function: build_social_graph
+# Load FRIENDS into a SocialGraph, tagged with the CHANGE_LOG id it contains
+# Both queries run in one read transaction (same snapshot)
+# With several shards there is no single CHANGE_LOG id: the graph is read
+# from all of them and the changes are polled just before (see load_social_graph)
+def build_social_graph():
+    if SHARD_MAP.count > 1:
+        return SocialGraph.from_edges(db_read_all("SELECT zid, friend_zid FROM FRIENDS", []))
+    conn = get_read_connection()
+    conn.execute("BEGIN")
+    try:
+        change_id = conn.execute("SELECT coalesce(max(id), 0) FROM CHANGE_LOG").fetchone()[0]
+        edges = conn.execute("SELECT zid, friend_zid FROM FRIENDS").fetchall()
+    finally:
+        conn.execute("COMMIT")
+    return SocialGraph.from_edges(edges, change_id)
+
+
+# Function: load_social_graph
+# Memory-map the snapshot in GRAPH_SNAPSHOT_PATH and replay the FRIENDS
+# changes logged since it was written. Without a usable snapshot (missing,
+# or CHANGE_LOG already pruned past it) build from FRIENDS and write one.
+# The snapshot holds the CHANGE_LOG id of one database, so it is not used
+# with several shards: polling first means no later change is missed.
+def load_social_graph():
+    if SHARD_MAP.count > 1:
+        poll_changes()
+        return build_social_graph()
+    graph = None
+    if os.path.exists(GRAPH_SNAPSHOT_PATH):
+        try:
+            graph = SocialGraph.load_snapshot(GRAPH_SNAPSHOT_PATH)
+        except (ValueError, OSError, struct_error):
+            graph = None
+    if graph != None:
+        log = db_read("SELECT min(id) AS first_id, (SELECT seq FROM sqlite_sequence WHERE name = 'CHANGE_LOG') AS last_id FROM CHANGE_LOG", [])[0]
+        last_id = log['last_id'] or 0
+        if last_id < graph.change_id:
+            graph = None
+        elif last_id > graph.change_id and (log['first_id'] == None or log['first_id'] > graph.change_id + 1):
+            graph = None
+    if graph == None:
+        graph = build_social_graph()
+        graph.save_snapshot(GRAPH_SNAPSHOT_PATH)
+        return graph
+    for change in db_read("SELECT id, op, zid, ref FROM CHANGE_LOG WHERE tbl = 'FRIENDS' AND id > ? ORDER BY id", [graph.change_id]):
+        apply_friend_change(graph, change['op'], change['zid'], change['ref'])
+        graph.change_id = change['id']
+    return graph
+
+
+# Function: get_social_graph
+# The SocialGraph of this worker, loaded on first use
+def get_social_graph():
+    if social_graph['graph'] == None:
+        with CHANGE_LOCK:
+            if social_graph['graph'] == None:
+                social_graph['graph'] = load_social_graph()
+    return social_graph['graph']
+
+
+# Connection paths found for each viewer: viewer zid -> {target zid: path}
+# Any friendship or suspension change may change paths, so all are dropped
+CONNECTION_PATHS = {}
+# Number of times CONNECTION_PATHS was dropped, see get_connection_path
+connection_paths_generation = 0
+
+
+# Function: get_connection_path
+# Shortest chain of friends from viewer to target (bidirectional BFS on the
+# social graph), at most CONNECTION_MAX_DEPTH friendships long, not passing
+# through suspended students, given up after CONNECTION_TIME_BUDGET seconds
+# Output: [viewer, ..., target] or None (results are cached per viewer,
+#         unless the search timed out or a change was polled during it)
+def get_connection_path(viewer_zid, target_zid):
+    viewer_paths = CONNECTION_PATHS.get(viewer_zid, {})
+    if target_zid in viewer_paths:
+        return viewer_paths[target_zid]
+    generation = connection_paths_generation
+    deadline = time.monotonic() + CONNECTION_TIME_BUDGET
+    skip = get_suspended_zids().__contains__
+    try:
+        path = get_social_graph().shortest_path(viewer_zid, target_zid, max_depth = CONNECTION_MAX_DEPTH, skip = skip, deadline = deadline)
+    except SearchTimeout:
+        return None
+    with CACHE_LOCK:
+        if generation == connection_paths_generation:
+            if len(CONNECTION_PATHS) >= CACHE_MAX_SIZE:
+                CONNECTION_PATHS.clear()
+            CONNECTION_PATHS.setdefault(viewer_zid, {})[target_zid] = path
+    return path
+
+
+# zids of the suspended students (frozenset) of this worker, see get_suspended_zids
+suspended_zids = {'zids': None}
+
+
+# Function: get_suspended_zids
+# Read in one query on first use, then kept up to date by update_suspended_zids
+# (the connection search tests every node it reaches)
+def get_suspended_zids():
+    zids = suspended_zids['zids']
+    if zids == None:
+        with CHANGE_LOCK:
+            if suspended_zids['zids'] == None:
+                poll_changes()
+                suspended_zids['zids'] = frozenset(row['zid'] for row in db_read_all("SELECT zid FROM TO_BE_SUSPENDED", []))
+            zids = suspended_zids['zids']
+    return zids
+
+
+# Function: update_suspended_zids
+# A new set is published for every suspend / activate, searches running keep theirs
+@on_change
+def update_suspended_zids(tbl, op, zid, ref):
+    zids = suspended_zids['zids']
+    if zids == None:
+        return
+    if tbl == None:
+        suspended_zids['zids'] = None
+    elif tbl == 'TO_BE_SUSPENDED' and op == 'I':
+        suspended_zids['zids'] = zids | {zid}
+    elif tbl == 'TO_BE_SUSPENDED' and op == 'D':
+        suspended_zids['zids'] = zids - {zid}
+
+
+# Function: get_connection
+# How viewer is connected to target, for templates:
+#       {'degree': 2, 'label': '2nd-degree', 'via': [profiles in between]}
+# or None if not connected (or the same student)
+def get_connection(viewer_zid, target_zid):
+    if viewer_zid == target_zid or is_suspended(target_zid):
+        return None
+    path = get_connection_path(viewer_zid, target_zid)
+    if path == None:
+        return None
+    degree = len(path) - 1
+    if degree % 100 in (11, 12, 13):
+        suffix = 'th'
+    else:
+        suffix = {1: 'st', 2: 'nd', 3: 'rd'}.get(degree % 10, 'th')
+    get_loader('STUDENT').prime(path[1:-1])
+    via = [get_profile_by_zid(zid) for zid in path[1:-1]]
+    return {'degree': degree, 'label': "{}{}-degree".format(degree, suffix), 'via': [profile for profile in via if profile != None]}
+
+
+# Function: clear_connection_paths
+@on_change
+def clear_connection_paths(tbl, op, zid, ref):
+    global connection_paths_generation
+    if tbl in (None, 'FRIENDS', 'TO_BE_SUSPENDED'):
+        with CACHE_LOCK:
+            connection_paths_generation += 1
+            CONNECTION_PATHS.clear()
+
+
+# Function: apply_friend_change
+# Apply one FRIENDS row change to graph (both operations are idempotent)
+def apply_friend_change(graph, op, zid, friend_zid):
+    if op == 'I':
+        graph.add_edge(zid, friend_zid)
+    elif op == 'D':
+        graph.remove_edge(zid, friend_zid)
+
+
+# Function: update_social_graph
+# Keep the graph of this worker in step with FRIENDS (written by any worker)
+@on_change
+def update_social_graph(tbl, op, zid, ref):
+    graph = social_graph['graph']
+    if graph == None:
+        return
+    if tbl == None:
+        social_graph['graph'] = build_social_graph()
+    elif tbl == 'FRIENDS':
+        apply_friend_change(graph, op, zid, ref)
+
+
+# ------------------------------------------------------- #
+#            Autocomplete (student prefix index)          #
+# ------------------------------------------------------- #
+
+# The PrefixIndex of this worker, see get_student_index
+student_index = {'index': None}
+
+
+# Function: build_student_index
+# Index every (not suspended) student by zid and name
+def build_student_index():
+    return PrefixIndex.from_students((row['zid'], row['full_name']) for row in db_read_all("SELECT zid, full_name FROM STUDENT", []))
+
+
+# Function: get_student_index
+# The index is built once per process (create_app), then kept up to date by
+# update_student_index. Polling first means every change after the build
+# will reach the listener (replaying an older one is harmless).
+def get_student_index():
+    if student_index['index'] == None:
+        with CHANGE_LOCK:
+            if student_index['index'] == None:
+                poll_changes()
+                student_index['index'] = build_student_index()
+    return student_index['index']
+
+
+# Function: update_student_index
+# Registration (confirmation), profile edits, suspend / activate and deletes
+# all write STUDENT: re-index that one student
+@on_change
+def update_student_index(tbl, op, zid, ref):
+    index = student_index['index']
+    if index == None:
+        return
+    if tbl == None:
+        student_index['index'] = build_student_index()
+    elif tbl == 'STUDENT':
+        rows = db_read("SELECT zid, full_name FROM STUDENT WHERE zid = ?", [zid], shard_of(zid))
+        if len(rows) == 0:
+            index.remove(zid)
+        elif index.full_name(zid) != rows[0]['full_name']:
+            index.add(zid, rows[0]['full_name'])
+
+
+# Function: get_autocomplete
+# Students whose zid or name starts with prefix, for the search box
+# Friends of viewer come first, then friends of friends, then the others
+# (by name within each group), suspended students are never returned
+# Output: list of dicts (zid, full_name, profile_img, relation)
+def get_autocomplete(viewer_zid, prefix, limit = AUTOCOMPLETE_LIMIT):
+    index = get_student_index()
+    graph = get_social_graph()
+    friends = set(graph.friends(viewer_zid))
+    friends_of_friends = set()
+    for friend_zid in friends:
+        friends_of_friends.update(graph.friends(friend_zid))
+    # friends and friends of friends are matched first: the index scan stops
+    # after AUTOCOMPLETE_SCAN zids in key order and would miss them
+    candidates = index.matching(friends | friends_of_friends, prefix)
+    seen = set(candidates)
+    candidates.extend(zid for zid in index.search(prefix, AUTOCOMPLETE_SCAN) if zid not in seen)
+    if len(candidates) == 0:
+        return []
+    ranked = []
+    for zid in candidates:
+        if zid in friends:
+            relation = 0
+        elif zid in friends_of_friends and zid != viewer_zid:
+            relation = 1
+        else:
+            relation = 2
+        ranked.append((relation, (index.full_name(zid) or "").lower(), zid))
+    ranked.sort()
+    # profiles of the first ones in one batch, the others if some are skipped
+    first_zids = [zid for relation, full_name, zid in ranked[:limit]]
+    get_loader('STUDENT').prime(first_zids)
+    get_loader('TO_BE_SUSPENDED').prime(first_zids)
+    results = []
+    for relation, full_name, zid in ranked:
+        if len(results) >= limit:
+            break
+        profile = get_profile_by_zid(zid)
+        if profile == None or is_suspended(zid):
+            continue
+        results.append({
+            'zid': zid, 'full_name': profile['full_name'], 'profile_img': profile['profile_img'],
+            'relation': ['friend', 'friend of friend', None][relation],
+        })
+    return results
+
+# ------------------------------------------------------- #
+#           Request-scoped batch loading                  #
+# ------------------------------------------------------- #
+# Pages show many students and rows at once (feeds, friend lists, threads,
+# search). Helpers and views first register (prime) every key they are
+# going to need, the next load() then reads all registered keys with one
+# WHERE <column> IN (...) query per table (and shard), BATCH_MAX_PARAMS
+# keys at a time. The loaders of a request are kept on g, so each row is
+# read at most once per request. Profiles also go through CACHE.
+
+# Class: BatchLoader
+# Rows of table by the value of column, for one request
+class BatchLoader(object):
+
+    # Input:
+    #       columns: the SELECT list (must contain column)
+    #       order_by: order of the rows of one key (with many)
+    #       many: a list of rows per key, otherwise one row or None
+    #       by_zid: keys are zids, read from their shard (otherwise every shard is read)
+    #       cached: share the rows with CACHE, as (table, key) -> list of rows
+    def __init__(self, table, column, columns = "*", order_by = None, many = False, by_zid = False, cached = False):
+        self.table = table
+        self.column = column
+        self.select_sql = "SELECT {} FROM {} WHERE {} IN ({{}})".format(columns, table, column)
+        if order_by != None:
+            self.select_sql += " ORDER BY " + order_by
+        self.many = many
+        self.by_zid = by_zid
+        self.cached = cached
+        self.rows = {}
+        self.pending = set()
+
+    # Function: prime
+    # Register keys for the next batch
+    def prime(self, keys):
+        for key in keys:
+            if key != None and key not in self.rows:
+                self.pending.add(key)
+
+    # Function: load
+    # The row (a list of rows with many) of key, None if there is none
+    def load(self, key):
+        if key not in self.rows:
+            self.pending.add(key)
+            self.resolve()
+        return self.rows[key]
+
+    # Function: load_many
+    # {key: load(key)} for all keys, read in one batch
+    def load_many(self, keys):
+        keys = list(keys)
+        self.prime(keys)
+        self.resolve()
+        return {key: self.rows[key] for key in keys}
+
+    # Function: resolve
+    # Read every pending key
+    def resolve(self):
+        pending, self.pending = sorted(self.pending), set()
+        generation = cache_generation
+        if self.cached:
+            missing = []
+            for key in pending:
+                rows = CACHE.get((self.table, key))
+                if rows == None:
+                    missing.append(key)
+                else:
+                    self.store(key, rows)
+            pending = missing
+        found = {key: [] for key in pending}
+        for start in range(0, len(pending), BATCH_MAX_PARAMS):
+            for row in self.read(pending[start:start + BATCH_MAX_PARAMS]):
+                found[row[self.column]].append(row)
+        for key, rows in found.items():
+            if self.cached:
+                cache_put(self.table, key, rows, generation)
+            self.store(key, rows)
+
+    # Function: read
+    # Rows of keys (at most BATCH_MAX_PARAMS), one query per shard
+    def read(self, keys):
+        if self.by_zid:
+            groups = SHARD_MAP.group_by_shard(keys)
+        else:
+            groups = {shard: keys for shard in range(SHARD_MAP.count)}
+        queries = {shard: (self.select_sql.format(",".join("?" * len(shard_keys))), shard_keys) for shard, shard_keys in groups.items()}
+        return merge_rows(db_read_shards(queries))
+
+    def store(self, key, rows):
+        if self.many:
+            self.rows[key] = list(rows)
+        else:
+            self.rows[key] = rows[0] if len(rows) > 0 else None
+
+
+# The loaders, by name: functions creating an empty one
+LOADERS = {
+    'STUDENT': lambda: BatchLoader('STUDENT', 'zid', by_zid = True, cached = True),
+    'TO_BE_SUSPENDED': lambda: BatchLoader('TO_BE_SUSPENDED', 'zid', by_zid = True, cached = True),
+    'COURSES': lambda: BatchLoader('COURSES', 'zid', order_by = "id", many = True, by_zid = True),
+    'POST': lambda: BatchLoader('POST', 'id', columns = "id, zid, time, message, comment_count, reply_count"),
+    'COMMENT': lambda: BatchLoader('COMMENT', 'post_id', order_by = "time, id", many = True),
+    'REPLY': lambda: BatchLoader('REPLY', 'comment_id', order_by = "time, id", many = True),
+}
+
+
+# Function: get_loader
+# The BatchLoader called name of this request (a new one outside of requests)
+def get_loader(name):
+    if not has_app_context():
+        return LOADERS[name]()
+    loaders = g.setdefault('loaders', {})
+    if name not in loaders:
+        loaders[name] = LOADERS[name]()
+    return loaders[name]
+
+
+# Function: reset_loaders
+# Forget what this request has read (long-lived streams)
+def reset_loaders():
+    g.pop('loaders', None)
+
 
+# Function: prime_authors
+# Register the profiles shown with rows (posts / comments / replies): their
+# authors and the students mentioned in their messages (transform_message)
+def prime_authors(rows):
+    zids = set()
+    for row in rows:
+        zids.add(row['zid'])
+        zids.update(re.findall(ZID_PATTERN, row['message'] or ""))
+    get_loader('STUDENT').prime(zids)
+
+
+# ------------------------------------------------------- #
+#         Common Helper Functions : students and posts    #
+# ------------------------------------------------------- #
 
 # Function : get profile by zid
 # Input: zid
@@ -69,9 +1098,9 @@ def db_query(sql, params):
 #       the profile of this zid (zid, password, email, full_name, birthday, 
 #       program, home_suburb, home_longitude, home_latitude, profile_text)
 def get_profile_by_zid(zid):
-    profile = db_query("SELECT * FROM STUDENT WHERE zid = ?", [zid])
-    if len(profile) != 0:
-        profile = dict(profile[0])
+    profile = get_loader('STUDENT').load(zid)
+    if profile != None:
+        profile = dict(profile)
         return profile
     else:
         return None
@@ -82,9 +1111,9 @@ def get_profile_by_zid(zid):
 # Output: 
 #       suspended profile
 def get_suspended_profile_by_zid(zid):
-    profile = db_query("SELECT * FROM TO_BE_SUSPENDED WHERE zid = ?", [zid])
-    if len(profile) != 0:
-        profile = dict(profile[0])
+    profile = get_loader('TO_BE_SUSPENDED').load(zid)
+    if profile != None:
+        profile = dict(profile)
         return profile
     else:
         return None
@@ -95,8 +1124,8 @@ def get_suspended_profile_by_zid(zid):
 # Output: True if this zid is suspended
 def is_suspended(zid):
     try:
-        profile = db_query("SELECT * FROM TO_BE_SUSPENDED WHERE zid = ?", [zid])
-        if len(profile) != 0:
+        profile = get_loader('TO_BE_SUSPENDED').load(zid)
+        if profile != None:
             return True
         else:
             return False
@@ -109,10 +1138,11 @@ def is_suspended(zid):
 # Note that suspended will be hidden
 def get_friends_by_zid(zid):
     results = []
-    friends = db_query("SELECT * FROM FRIENDS WHERE zid = ?", [zid])
-    for friend in friends:
-        if not is_suspended(friend['friend_zid']):
-            results.append(friend['friend_zid'])
+    friends = get_social_graph().friends(zid)
+    get_loader('TO_BE_SUSPENDED').prime(friends)
+    for friend_zid in friends:
+        if not is_suspended(friend_zid):
+            results.append(friend_zid)
     return results
 
 
@@ -120,12 +1150,54 @@ def get_friends_by_zid(zid):
 # Given a zid, return a list of courses
 def get_courses_by_zid(zid):
     results = []
-    courses = db_query("SELECT * FROM COURSES WHERE zid = ?", [zid])
+    courses = get_loader('COURSES').load(zid)
     for course in courses:
         results.append(course['course'])
     return results
 
 
+# Function : get_course_codes_by_zid
+# Course codes (COMP1521) zid has been enrolled in, from COURSE_MEMBER
+def get_course_codes_by_zid(zid):
+    return [row['code'] for row in db_read("SELECT code FROM COURSE_MEMBER WHERE zid = ? ORDER BY code", [zid], shard_of(zid))]
+
+
+# Function : get_course_feed
+# Posts of the students enrolled in a course code, the latest first, one page
+# of COURSE_FEED_PAGE_SIZE: one query over COURSE_MEMBER (code, zid) and
+# POST (zid, time) per shard, authors are joined in, suspended ones drop out
+# Input: code, before: (time, id) of the last post of the previous page or None
+# Output:
+#       A list of posts, each is a dict (id, zid, full_name, profile_img,
+#       transformed time, transformed message),
+#       and the (time, id) to ask for the next page (None if no more)
+def get_course_feed(code, before = None):
+    feed_sql = """SELECT P.id, P.zid, P.time, P.message, P.comment_count, P.reply_count, S.full_name, S.profile_img
+            FROM COURSE_MEMBER M JOIN POST P ON P.zid = M.zid JOIN STUDENT S ON S.zid = M.zid
+            WHERE M.code = ? AND (P.time, P.id) < (?, ?)
+            ORDER BY P.time DESC, P.id DESC LIMIT ?"""
+    if before == None:
+        before = (2 ** 62, 0)
+    rows = db_read_all(feed_sql, [code, before[0], before[1], COURSE_FEED_PAGE_SIZE + 1],
+                       key = lambda row: (row['time'], row['id']), reverse = True, limit = COURSE_FEED_PAGE_SIZE + 1)
+    posts = [dict(row) for row in rows[:COURSE_FEED_PAGE_SIZE]]
+    if len(rows) > COURSE_FEED_PAGE_SIZE:
+        next_page = (posts[-1]['time'], posts[-1]['id'])
+    else:
+        next_page = None
+    prime_authors(posts)
+    for post in posts:
+        post['message'] = transform_message(post['message'])
+        post['time'] = transform_time(post['time'])
+    return posts, next_page
+
+
+# Function : count_course_members
+# Number of (not suspended) students enrolled in a course code
+def count_course_members(code):
+    return sum(row['n'] for row in db_read_all("SELECT count(*) AS n FROM COURSE_MEMBER M JOIN STUDENT S ON S.zid = M.zid WHERE M.code = ?", [code]))
+
+
 # Function : check_similarity
 # Check similarity of 2 zids, note that they should not be same or friends
 # One common courses : +1
@@ -133,32 +1205,42 @@ def get_courses_by_zid(zid):
 def check_similarity(zid1, zid2):
     if is_suspended(zid1) or is_suspended(zid2):
         return -100
-    # get friends
-    friends1 = set(get_friends_by_zid(zid1))
-    friends2 = set(get_friends_by_zid(zid2))
+    # get common friends (not suspended)
+    mutual_friends = [friend_zid for friend_zid in get_social_graph().mutual_friends(zid1, zid2) if not is_suspended(friend_zid)]
     # get courses
     courses1 = set(get_courses_by_zid(zid1))
     courses2 = set(get_courses_by_zid(zid2))
     # return the sum of intersections
-    return len(friends1 & friends2) + len(courses1 & courses2)
+    return len(mutual_friends) + len(courses1 & courses2)
 
 
 # Function : friend suggession
 # Provide a list (12) of likely friend suggessions
 def get_friend_suggestion(zid):
+    graph = get_social_graph()
+    friends = set(graph.friends(zid))
+    friends.add(zid)
+
     # select those have common course with zid but not friend
-    common_course_sql = "SELECT DISTINCT zid FROM COURSES WHERE course IN (SELECT course FROM COURSES WHERE zid = ?) AND zid <> ? AND zid NOT IN (SELECT friend_zid FROM FRIENDS WHERE zid = ?);"
-    set1 = set([ item['zid'] for item in db_query(common_course_sql, [zid, zid, zid])])
+    courses = sorted(set(get_courses_by_zid(zid)))
+    set1 = set()
+    if len(courses) > 0:
+        common_course_sql = "SELECT DISTINCT zid FROM COURSES WHERE course IN ({});".format(",".join("?" * len(courses)))
+        set1 = set([ item['zid'] for item in db_read_all(common_course_sql, courses)]) - friends
 
     # select those have common friends with zid but not friend
-    common_friend_sql = "SELECT DISTINCT zid FROM FRIENDS WHERE friend_zid IN (SELECT friend_zid FROM FRIENDS WHERE zid = ?) AND zid <> ? AND zid NOT IN (SELECT friend_zid FROM FRIENDS WHERE zid = ?);"
-    set2 = set([ item['zid'] for item in db_query(common_friend_sql, [zid, zid, zid])])
+    set2 = set()
+    for friend_zid in friends:
+        set2.update(graph.friends(friend_zid))
+    set2 -= friends
     
     # remove repeated 
     all_candidates = set1 | set2
 
     if len(all_candidates) > 0:
-        # calculate similarity
+        # calculate similarity (suspensions and courses read in one batch)
+        get_loader('TO_BE_SUSPENDED').prime(all_candidates | friends)
+        get_loader('COURSES').prime(all_candidates | set([zid]))
         all_similarities = {}
         for candidate in all_candidates:
             all_similarities[candidate] = check_similarity(zid, candidate)
@@ -167,9 +1249,9 @@ def get_friend_suggestion(zid):
         results = [item[0] for item in sorted_candidates]
     else:
         # If no candidate, random select 12 users
-        all_sql = "SELECT zid FROM STUDENT WHERE zid <> ? AND zid NOT IN (SELECT friend_zid FROM FRIENDS WHERE zid = ?);"
-        set3 = set([ item['zid'] for item in db_query(all_sql, [zid, zid])])
-        results = random.sample(set3, min(12, len(set3)))
+        all_sql = "SELECT zid FROM STUDENT;"
+        set3 = set([ item['zid'] for item in db_read_all(all_sql, [])]) - friends
+        results = random.sample(sorted(set3), min(12, len(set3)))
 
     return results
 
@@ -180,39 +1262,103 @@ def get_friend_suggestion(zid):
 # Input: a list of zids
 # Output: 
 #       A list of all posts made by these zids, each post is a dict (id, zid, 
-#       full_name, profile_img, transformed time, transformed message)
+#       full_name, profile_img, transformed time, transformed message,
+#       comment_count, reply_count)
 #       Posts are sorted by time, the latest will be posted first
 # Note that suspended will be hidden
 def get_posts_by_zids(zids):
-    posts = []
-    for zid in zids:
-        if not is_suspended(zid):
-            one_posts = db_query("SELECT id, zid, time, message FROM POST WHERE zid = ?", [zid])
-            for one_post in one_posts:
-                posts.append(dict(one_post))
-    posts = sorted(posts, key = lambda x: x['time'], reverse = True)
+    get_loader('TO_BE_SUSPENDED').prime(zids)
+    zids = [zid for zid in set(zids) if not is_suspended(zid)]
+    if len(zids) == 0:
+        return []
+    posts_sql = "SELECT id, zid, time, message, comment_count, reply_count FROM POST WHERE zid IN ({}) ORDER BY time DESC, id DESC"
+    queries = {}
+    for shard, shard_zids in SHARD_MAP.group_by_shard(zids).items():
+        queries[shard] = (posts_sql.format(",".join("?" * len(shard_zids))), shard_zids)
+    rows = merge_rows(db_read_shards(queries), key = lambda row: (row['time'], row['id']), reverse = True)
+    posts = [dict(one_post) for one_post in rows]
+    prime_authors(posts)
     # Transform time and message
-    for post in posts:
-        post['message'] = transform_message(post['message'])
-        post['time'] = transform_time(post['time'])
-        poster_profile = get_profile_by_zid(post['zid'])
-        post['full_name'] = poster_profile['full_name']
-        post['profile_img'] = poster_profile['profile_img']
-    return posts
+    return add_authors(posts)
+
+
+# Function : get_top_posts
+# The TOP_FEED_SIZE best posts of zids for viewer_zid ("top" feed mode)
+# TOP_FEED_CANDIDATES posts are read by stored score (POST (zid, score)
+# index, only their ids and authors), then re-ranked with the author's affinity to the
+# viewer (mutual friends, see ranking.py)
+# Each author is one bounded index read (UNION ALL of "WHERE zid = ? ORDER BY
+# score DESC LIMIT n"), so the cost does not grow with their number of posts
+# Output: posts as in get_posts_by_zids, best first
+def get_top_posts(viewer_zid, zids):
+    get_loader('TO_BE_SUSPENDED').prime(zids)
+    zids = [zid for zid in set(zids) if not is_suspended(zid)]
+    if len(zids) == 0:
+        return []
+    top_sql = "SELECT * FROM (SELECT id, zid, score FROM POST WHERE zid = ? ORDER BY score DESC, id DESC LIMIT ?)"
+    groups = {shard: [shard_zids[start:start + TOP_FEED_UNION_SIZE] for start in range(0, len(shard_zids), TOP_FEED_UNION_SIZE)]
+              for shard, shard_zids in SHARD_MAP.group_by_shard(zids).items()}
+    rows = []
+    for step in range(max(len(chunks) for chunks in groups.values())):
+        queries = {}
+        for shard, chunks in groups.items():
+            if step < len(chunks):
+                params = [value for zid in chunks[step] for value in (zid, TOP_FEED_CANDIDATES)]
+                queries[shard] = (" UNION ALL ".join([top_sql] * len(chunks[step])), params)
+        for shard_rows in db_read_shards(queries).values():
+            rows.extend(shard_rows)
+    candidates = heapq.nlargest(TOP_FEED_CANDIDATES, rows, key = lambda row: (row['score'], row['id']))
+    if len(candidates) == 0:
+        return []
+    # posts live on the shard of their author
+    ids_by_shard = {}
+    for row in candidates:
+        ids_by_shard.setdefault(shard_of(row['zid']), []).append(row['id'])
+    posts_sql = "SELECT id, zid, time, message, comment_count, reply_count, score FROM POST WHERE id IN ({})"
+    queries = {shard: (posts_sql.format(",".join("?" * len(ids))), ids) for shard, ids in ids_by_shard.items()}
+    posts = [dict(one_post) for one_post in merge_rows(db_read_shards(queries))]
+    graph = get_social_graph()
+    mutual_counts = {}
+    for zid in set(post['zid'] for post in posts):
+        mutual_counts[zid] = graph.mutual_count(viewer_zid, zid) if zid != viewer_zid else 0
+    posts.sort(key = lambda post: (affinity_score(post['score'], mutual_counts[post['zid']]), post['id']), reverse = True)
+    posts = posts[:TOP_FEED_SIZE]
+    prime_authors(posts)
+    return add_authors(posts)
+
+
+# Function: add_authors
+# Transform the time and message of posts / comments / replies (dicts) and
+# add the full_name and profile_img of their authors
+# Rows whose author has no profile are dropped: deleted accounts (their
+# content is still being purged, see delete_account_data) or suspended ones
+# Output: the rows kept
+def add_authors(rows):
+    results = []
+    for row in rows:
+        profile = get_profile_by_zid(row['zid'])
+        if profile == None:
+            continue
+        row['message'] = transform_message(row['message'])
+        row['time'] = transform_time(row['time'])
+        row['full_name'] = profile['full_name']
+        row['profile_img'] = profile['profile_img']
+        results.append(row)
+    return results
 
 
 # Function: get_post_by_post_id
 # Get one post via its post_id (primary key)
 # This post will also be shown as dict (id, zid, full_name, profile_img,
 #       transformed time, transformed message)
+# None if there is no such post or its author has no profile
 def get_post_by_post_id(post_id):
-    post = dict(db_query("SELECT id, zid, time, message FROM POST WHERE id = ?", [post_id])[0])
-    post['message'] = transform_message(post['message'])
-    post['time'] = transform_time(post['time'])
-    poster_profile = get_profile_by_zid(post['zid'])
-    post['full_name'] = poster_profile['full_name']
-    post['profile_img'] = poster_profile['profile_img']
-    return post
+    post = get_loader('POST').load(int(post_id))
+    if post == None:
+        return None
+    prime_authors([post])
+    posts = add_authors([dict(post)])
+    return posts[0] if len(posts) > 0 else None
 
 
 # Function : get_comments_by_post_id
@@ -224,18 +1370,12 @@ def get_post_by_post_id(post_id):
 #       The comments are sorted by time, the earliest will be post first.
 def get_comments_by_post_id(post_id):
     results = []
-    comments = db_query("SELECT * FROM COMMENT WHERE post_id = ?", [post_id])
+    # comments should not be shown in reverse order
+    comments = get_loader('COMMENT').load(int(post_id))
     for comment in comments:
         results.append(dict(comment))
-    # comments should not be shown in reverse order
-    results = sorted(results, key = lambda x: x['time'])
-    for comment in results:
-        comment['message'] = transform_message(comment['message'])
-        comment['time'] = transform_time(comment['time'])
-        commenter_profile = get_profile_by_zid(comment['zid'])
-        comment['full_name'] = commenter_profile['full_name']
-        comment['profile_img'] = commenter_profile['profile_img']
-    return results
+    prime_authors(results)
+    return add_authors(results)
 
 
 # Function : get_replies_by_comment_id
@@ -247,18 +1387,12 @@ def get_comments_by_post_id(post_id):
 #       The replies are sorted by time, the earliest will be posted first
 def get_replies_by_comment_id(comment_id):
     results = []
-    replies = db_query("SELECT * FROM REPLY WHERE comment_id = ?", [comment_id])
+    # replies should not be shown in reverse order
+    replies = get_loader('REPLY').load(int(comment_id))
     for reply in replies:
         results.append(dict(reply))
-    # replies should not be shown in reverse order
-    results = sorted(results, key = lambda x: x['time'])
-    for reply in results:
-        reply['message'] = transform_message(reply['message'])
-        reply['time'] = transform_time(reply['time'])
-        replier_profile = get_profile_by_zid(reply['zid'])
-        reply['full_name'] = replier_profile['full_name']
-        reply['profile_img'] = replier_profile['profile_img']
-    return results
+    prime_authors(results)
+    return add_authors(results)
 
 
 # Function : get_page_index
@@ -278,22 +1412,119 @@ def get_search_result(keyword):
     pattern = "%{}%".format(keyword)
     # search for students
     students_profile = []
-    students_id = db_query('SELECT zid, full_name, profile_img FROM STUDENT WHERE full_name LIKE ? OR zid = ?', [pattern, keyword])
+    students_id = db_read_all('SELECT zid, full_name, profile_img FROM STUDENT WHERE full_name LIKE ? OR zid = ?', [pattern, keyword])
+    get_loader('TO_BE_SUSPENDED').prime(item['zid'] for item in students_id)
     for item in students_id:
         item = dict(item)
         if not is_suspended(item['zid']):
             students_profile.append(item)
     # search for posts
     all_posts = []
-    posts_id = db_query('SELECT id FROM POST WHERE message LIKE ?', [pattern])
+    posts_id = db_read_all('SELECT id, zid, time FROM POST WHERE message LIKE ? ORDER BY time DESC, id DESC', [pattern],
+                           key = lambda row: (row['time'], row['id']), reverse = True)
+    get_loader('TO_BE_SUSPENDED').prime(item['zid'] for item in posts_id)
+    posts_id = [item for item in posts_id if not is_suspended(item['zid'])]
+    # the posts and then their authors, one batch each
+    prime_authors(get_loader('POST').load_many(item['id'] for item in posts_id).values())
     for item in posts_id:
-        post = get_post_by_post_id(dict(item)['id'])
-        if not is_suspended(post['zid']):
+        post = get_post_by_post_id(item['id'])
+        if post != None:
             all_posts.append(post)
-    all_posts = sorted(all_posts, key = lambda x: x['time'], reverse = True)
     return students_profile, all_posts
 
 
+# Function : to_coordinate
+# Coordinates are stored as TEXT, return a float or None if missing ('', 'null')
+def to_coordinate(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    if math.isnan(value) or math.isinf(value):
+        return None
+    return value
+
+
+# Function : get_distance_km
+# Great-circle (haversine) distance between two points
+def get_distance_km(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = map(math.radians, [lon1, lat1, lon2, lat2])
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 6371.0 * 2 * math.asin(min(1.0, math.sqrt(a)))
+
+
+# Function : get_sql_distance_km
+# get_distance_km for SQL (distance_km() of the read connections),
+# NULL if a coordinate is missing
+def get_sql_distance_km(lon1, lat1, lon2, lat2):
+    points = [to_coordinate(value) for value in (lon1, lat1, lon2, lat2)]
+    if None in points:
+        return None
+    return get_distance_km(*points)
+
+
+# Function : get_bounding_box
+# The box (min_lon, max_lon, min_lat, max_lat) containing the circle around (lon, lat)
+def get_bounding_box(lon, lat, radius_km):
+    delta_lat = radius_km / 111.32
+    cos_lat = math.cos(math.radians(lat))
+    if cos_lat < 0.01:
+        delta_lon = 180.0
+    else:
+        delta_lon = min(180.0, radius_km / (111.32 * cos_lat))
+    return [lon - delta_lon, lon + delta_lon, lat - delta_lat, lat + delta_lat]
+
+
+# Function : get_nearby_posts
+# Posts within radius_km of (lon, lat), the latest first, one page of
+# NEARBY_PAGE_SIZE: the R*Tree (POST_GEO) returns the candidates inside the
+# bounding box, the exact distance (distance_km) is checked in the same
+# query, and only the page is read back per shard
+# Input: before: (time, id) of the last post of the previous page or None
+# Output:
+#       A list of posts (as get_course_feed, with their distance in km),
+#       and the (time, id) to ask for the next page (None if no more)
+# Note that suspended will be hidden (joined with STUDENT)
+def get_nearby_posts(lon, lat, radius_km, before = None):
+    nearby_sql = """SELECT P.id, P.zid, P.time, P.message, P.comment_count, P.reply_count, S.full_name, S.profile_img,
+                distance_km(?, ?, P.longitude, P.latitude) AS distance
+            FROM POST_GEO G JOIN POST P ON P.id = G.id JOIN STUDENT S ON S.zid = P.zid
+            WHERE G.max_lon >= ? AND G.min_lon <= ? AND G.max_lat >= ? AND G.min_lat <= ?
+                AND distance <= ? AND (P.time, P.id) < (?, ?)
+            ORDER BY P.time DESC, P.id DESC LIMIT ?"""
+    if before == None:
+        before = (2 ** 62, 0)
+    params = [lon, lat] + get_bounding_box(lon, lat, radius_km) + [radius_km, before[0], before[1], NEARBY_PAGE_SIZE + 1]
+    rows = db_read_all(nearby_sql, params, key = lambda row: (row['time'], row['id']), reverse = True, limit = NEARBY_PAGE_SIZE + 1)
+    posts = [dict(row) for row in rows[:NEARBY_PAGE_SIZE]]
+    if len(rows) > NEARBY_PAGE_SIZE:
+        next_page = (posts[-1]['time'], posts[-1]['id'])
+    else:
+        next_page = None
+    prime_authors(posts)
+    for post in posts:
+        post['message'] = transform_message(post['message'])
+        post['time'] = transform_time(post['time'])
+    return posts, next_page
+
+
+# Function : get_nearby_students
+# Students living within radius_km of (lon, lat), the nearest first
+# Note that suspended are not in STUDENT_GEO
+def get_nearby_students(lon, lat, radius_km, exclude_zid = None):
+    nearby_sql = "SELECT S.zid, S.full_name, S.profile_img, S.home_suburb, S.home_longitude, S.home_latitude FROM STUDENT_GEO G JOIN STUDENT S ON S.zid = printf('z%07d', G.id) WHERE G.max_lon >= ? AND G.min_lon <= ? AND G.max_lat >= ? AND G.min_lat <= ?"
+    students = []
+    for row in db_read_all(nearby_sql, get_bounding_box(lon, lat, radius_km)):
+        student = dict(row)
+        if student['zid'] == exclude_zid:
+            continue
+        student['distance'] = get_distance_km(lon, lat, float(student['home_longitude']), float(student['home_latitude']))
+        if student['distance'] <= radius_km:
+            students.append(student)
+    students = sorted(students, key = lambda x: x['distance'])
+    return students
+
+
 # Function: allowed_file
 # Modified from Flask doc: http://docs.jinkan.org/docs/flask/patterns/fileuploads.html
 # Check whether file is valid
@@ -304,6 +1535,7 @@ def allowed_file(filename):
 # Function: send_email
 # E.G. to = "yunqiuxu1991@gmail.com", subject = "activation", message = "a link"
 def send_email(to, subject, message):
+    import subprocess
     mutt = [
             'mutt',
             '-s',
@@ -321,15 +1553,793 @@ def send_email(to, subject, message):
 
 
 
+# Function : find_mentions
+# Students mentioned (z1234567) in a message, except the author
+def find_mentions(message, author):
+    results = []
+    for zid in set(re.findall(ZID_PATTERN, message)):
+        if zid != author and (get_profile_by_zid(zid) != None or is_suspended(zid)):
+            results.append(zid)
+    return results
+
+
+# Function : insert_mentions
+# Record the mentions of a new post / comment / reply in MENTION
+# (in the caller's transaction, cur from db_transaction)
+def insert_mentions(cur, message, author, post_id, comment_id, reply_id, time):
+    mentions = find_mentions(message, author)
+    insert_sql = "INSERT INTO MENTION (zid, author, post_id, comment_id, reply_id, time) VALUES (?, ?, ?, ?, ?, ?)"
+    cur.executemany(insert_sql, [(zid, author, post_id, comment_id, reply_id, time) for zid in mentions])
+    insert_notifications(cur, mentions, 'mention', author, post_id, comment_id, reply_id, time)
+    return mentions
+
+
+# Function : get_mentions
+# Posts / comments / replies mentioning zid, the latest first, one page of
+# MENTIONS_PAGE_SIZE read with one seek on MENTION (zid, time, id) per shard
+# (a mention is stored with the post it is in)
+# Input: zid, before: (time, id) of the last mention of the previous page or None
+# Output:
+#       A list of mentions, each is a dict (post_id, comment_id, reply_id, zid,
+#       full_name, profile_img, transformed time, transformed message),
+#       and the (time, id) to ask for the next page (None if no more)
+# Note that suspended authors will be hidden (authors may be on another
+# shard, so they are looked up afterwards and the page can be shorter)
+def get_mentions(zid, before = None):
+    mentions_sql = """SELECT M.id AS mention_id, M.time AS mention_time, M.post_id, M.comment_id, M.reply_id,
+                M.author AS zid, M.time AS time,
+                CASE WHEN M.reply_id IS NOT NULL THEN (SELECT message FROM REPLY WHERE id = M.reply_id)
+                     WHEN M.comment_id IS NOT NULL THEN (SELECT message FROM COMMENT WHERE id = M.comment_id)
+                     ELSE (SELECT message FROM POST WHERE id = M.post_id) END AS message
+            FROM MENTION M
+            WHERE M.zid = ? AND (M.time, M.id) < (?, ?)
+            ORDER BY M.time DESC, M.id DESC LIMIT ?"""
+    if before == None:
+        before = (2 ** 62, 0)
+    rows = db_read_all(mentions_sql, [zid, before[0], before[1], MENTIONS_PAGE_SIZE + 1],
+                       key = lambda row: (row['mention_time'], row['mention_id']), reverse = True, limit = MENTIONS_PAGE_SIZE + 1)
+    page = [dict(row) for row in rows[:MENTIONS_PAGE_SIZE]]
+    if len(rows) > MENTIONS_PAGE_SIZE:
+        next_page = (page[-1]['mention_time'], page[-1]['mention_id'])
+    else:
+        next_page = None
+    mentions = []
+    prime_authors(page)
+    for mention in page:
+        author = get_profile_by_zid(mention['zid'])
+        if author == None:
+            continue
+        mention['full_name'] = author['full_name']
+        mention['profile_img'] = author['profile_img']
+        mentions.append(mention)
+    for mention in mentions:
+        mention['message'] = transform_message(mention['message'] or "")
+        mention['time'] = transform_time(mention['time'])
+    return mentions, next_page
+
+
+# ------------------------------------------------------- #
+#          Common Helper Functions : notifications        #
+# ------------------------------------------------------- #
+# Writes append rows to NOTIFICATION in their own transaction. Each worker
+# has one poller thread that reads the new rows once per
+# NOTIFICATION_POLL_INTERVAL and hands them to the open streams of their
+# recipient, so an idle stream is a thread blocked on its queue and costs
+# no query at all. Rows are stored on the shard of their recipient.
+
+# zid -> set of queues of the open /notifications/stream of zid
+NOTIFICATION_SUBSCRIBERS = {}
+NOTIFICATION_LOCK = threading.Condition()
+# The poller thread of this worker and the last NOTIFICATION id it read from each shard
+notification_poller = {'pid': None, 'thread': None, 'last_ids': {}}
+
+
+# Function : insert_notifications
+# Notify every zid in zids (once, never the actor itself) of one event
+# (in the caller's transaction, cur from db_transaction)
+# Recipients on another shard are written once the transaction committed
+def insert_notifications(cur, zids, kind, actor, post_id, comment_id, reply_id, time):
+    recipients = sorted(set(zid for zid in zids if zid != None and zid != actor))
+    insert_sql = "INSERT INTO NOTIFICATION (zid, kind, actor, post_id, comment_id, reply_id, time) VALUES (?, ?, ?, ?, ?, ?, ?)"
+    cur_shard = get_cursor_shard(cur)
+    for shard, shard_recipients in SHARD_MAP.group_by_shard(recipients).items():
+        rows = [(zid, kind, actor, post_id, comment_id, reply_id, time) for zid in shard_recipients]
+        if shard == cur_shard:
+            cur.executemany(insert_sql, rows)
+        else:
+            after_commit(lambda shard = shard, rows = rows: insert_rows(shard, insert_sql, rows))
+
+
+# Function : insert_rows
+# executemany in a transaction of its own on shard
+def insert_rows(shard, insert_sql, rows):
+    with db_transaction(shard) as cur:
+        cur.executemany(insert_sql, rows)
+
+
+# Function : subscribe_notifications
+# Register a stream of zid, start the poller of this worker if needed
+# Output: queue receiving the NOTIFICATION rows of zid
+def subscribe_notifications(zid):
+    events = queue.Queue()
+    with NOTIFICATION_LOCK:
+        start_notification_poller()
+        NOTIFICATION_SUBSCRIBERS.setdefault(zid, set()).add(events)
+        NOTIFICATION_LOCK.notify()
+    return events
+
+
+# Function : start_notification_poller
+# One poller thread per worker, shared by all its streams: started by the
+# first subscriber of the process, started again if it died (under NOTIFICATION_LOCK)
+def start_notification_poller():
+    thread = notification_poller['thread']
+    if notification_poller['pid'] == os.getpid() and thread != None and thread.is_alive():
+        return
+    if notification_poller['pid'] != os.getpid():
+        results = db_read_shards({shard: ("SELECT max(id) AS id FROM NOTIFICATION", []) for shard in range(SHARD_MAP.count)})
+        notification_poller['last_ids'] = {shard: rows[0]['id'] or 0 for shard, rows in results.items()}
+        notification_poller['pid'] = os.getpid()
+    notification_poller['thread'] = threading.Thread(target = poll_notifications, daemon = True)
+    notification_poller['thread'].start()
+
+
+# Function : unsubscribe_notifications
+def unsubscribe_notifications(zid, events):
+    with NOTIFICATION_LOCK:
+        subscribers = NOTIFICATION_SUBSCRIBERS.get(zid, set())
+        subscribers.discard(events)
+        if len(subscribers) == 0:
+            NOTIFICATION_SUBSCRIBERS.pop(zid, None)
+
+
+# Function : poll_notifications
+# Poller thread: one range scan on NOTIFICATION (per shard) per interval,
+# only while somebody is subscribed, rows are dispatched to the queues of
+# their zid (all rows of a zid are on one shard, so each queue gets
+# increasing ids)
+def poll_notifications():
+    while True:
+        with NOTIFICATION_LOCK:
+            while len(NOTIFICATION_SUBSCRIBERS) == 0:
+                NOTIFICATION_LOCK.wait()
+        time.sleep(NOTIFICATION_POLL_INTERVAL)
+        last_ids = notification_poller['last_ids']
+        try:
+            results = db_read_shards({shard: ("SELECT * FROM NOTIFICATION WHERE id > ? ORDER BY id", [last_id]) for shard, last_id in last_ids.items()})
+            for shard, rows in results.items():
+                if len(rows) > 0:
+                    last_ids[shard] = rows[-1]['id']
+            rows = drop_dead_notifications([row for shard_rows in results.values() for row in shard_rows])
+        except sqlite3.Error:
+            continue
+        with NOTIFICATION_LOCK:
+            for row in rows:
+                for events in NOTIFICATION_SUBSCRIBERS.get(row['zid'], ()):
+                    events.put(row)
+
+
+# Function : get_notifications
+# Notifications of zid after last_id (resume of a stream), oldest first
+def get_notifications(zid, last_id):
+    notifications_sql = "SELECT * FROM NOTIFICATION WHERE zid = ? AND id > ? ORDER BY id DESC LIMIT ?"
+    rows = db_read(notifications_sql, [zid, last_id, NOTIFICATION_BACKLOG], shard_of(zid))
+    return drop_dead_notifications(list(reversed(rows)))
+
+
+# Function : drop_dead_notifications
+# The rows whose post / comment / reply still exists (one query per table
+# and shard). The triggers of db_upgrade.sql delete the notifications of a
+# deleted target on its own shard, but not those of recipients on other shards.
+def drop_dead_notifications(rows):
+    live = {}
+    for table, column in [('POST', 'post_id'), ('COMMENT', 'comment_id'), ('REPLY', 'reply_id')]:
+        ids = sorted(set(row[column] for row in rows if row[column] != None))
+        live[column] = set()
+        for start in range(0, len(ids), BATCH_MAX_PARAMS):
+            chunk = ids[start:start + BATCH_MAX_PARAMS]
+            select_sql = "SELECT id FROM {} WHERE id IN ({})".format(table, ",".join("?" * len(chunk)))
+            for shard_rows in db_read_shards({shard: (select_sql, chunk) for shard in range(SHARD_MAP.count)}).values():
+                live[column].update(row['id'] for row in shard_rows)
+    return [row for row in rows if all(row[column] == None or row[column] in ids for column, ids in live.items())]
+
+
+# Function : format_notification
+# One NOTIFICATION row as an SSE event (data is JSON)
+# Output: str, or None if the actor is suspended or deleted
+def format_notification(row):
+    actor = get_profile_by_zid(row['actor'])
+    if actor == None:
+        return None
+    data = {
+        'id': row['id'], 'kind': row['kind'], 'time': transform_time(row['time']),
+        'zid': actor['zid'], 'full_name': actor['full_name'],
+        'post_id': row['post_id'], 'comment_id': row['comment_id'], 'reply_id': row['reply_id'],
+    }
+    if row['post_id'] != None:
+        data['url'] = url_for('view_post_detail', zid = row['zid'], post_id = row['post_id'])
+    else:
+        data['url'] = url_for('index', zid = actor['zid'])
+    return "id: {}\nevent: {}\ndata: {}\n\n".format(row['id'], row['kind'], json.dumps(data))
+
+
+# ------------------------------------------------------- #
+#            Common Helper Functions : export             #
+# ------------------------------------------------------- #
+# A student's data as a zip in the dataset layout (db/<dataset>/<zid>/):
+#       <zid>/student.txt                               profile, friends, courses
+#       <zid>/img.jpg                                   profile image
+#       <zid>/<post_id>.txt                             the student's posts
+#       <zid>/<post_id>-<comment_id>.txt                comments on them
+#       <zid>/<post_id>-<comment_id>-<reply_id>.txt     replies to those
+#       <zid>/comments/<post_id>-<comment_id>.txt       comments / replies written
+#       <zid>/replies/<post_id>-<comment_id>-<reply_id>.txt   on other posts
+# The zip is generated while it is sent: rows are read EXPORT_CHUNK_SIZE at
+# a time and each file is compressed and yielded as it is written, so memory
+# does not depend on how much the student wrote.
+
+# Class: ZipStream
+# Write-only, unseekable file for zipfile: collects what is written until
+# the next drain(). zipfile then writes sizes after each file's data.
+class ZipStream(object):
+
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+# Function: iter_rows
+# All rows of select_sql on shard, read EXPORT_CHUNK_SIZE at a time by keyset on id
+# select_sql must end with "AND <table>.id > ? ORDER BY <table>.id LIMIT ?"
+def iter_rows(select_sql, params, shard = 0):
+    last_id = 0
+    while True:
+        rows = db_read(select_sql, params + [last_id, EXPORT_CHUNK_SIZE], shard)
+        for row in rows:
+            yield row
+        if len(rows) < EXPORT_CHUNK_SIZE:
+            return
+        last_id = rows[-1]['id']
+
+
+# Function: format_item
+# key: value lines, as read back by build_db.get_item_dict
+def format_item(item):
+    lines = []
+    for key, value in item:
+        if isinstance(value, list):
+            value = "({})".format(", ".join(value))
+        elif value == None:
+            value = ""
+        lines.append("{}: {}\n".format(key, value))
+    return "".join(lines).encode('utf-8')
+
+
+# Function: format_dataset_time
+# epoch -> 2016-05-13T04:35:53+0000 (the dataset time format)
+def format_dataset_time(timestamp):
+    return datetime.fromtimestamp(timestamp or 0, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S+0000")
+
+
+# Function: iter_export_files
+# (file name, iterator of bytes) for every file of the export of profile
+def iter_export_files(profile):
+    zid = profile['zid']
+    shard = shard_of(zid)
+    courses = [row['course'] for row in db_read("SELECT course FROM COURSES WHERE zid = ? ORDER BY course", [zid], shard)]
+    student = [
+        ('zid', zid), ('email', profile['email']), ('full_name', profile['full_name']),
+        ('birthday', profile['birthday']), ('program', profile['program']),
+        ('home_suburb', profile['home_suburb']), ('home_longitude', profile['home_longitude']),
+        ('home_latitude', profile['home_latitude']), ('profile_text', profile['profile_text']),
+        ('friends', sorted(get_social_graph().friends(zid))), ('courses', courses),
+    ]
+    yield "{}/student.txt".format(zid), [format_item(student)]
+    img_path = os.path.join(app.static_folder, profile['profile_img'] or "")
+    if (profile['profile_img'] or "").startswith("student_img/") and os.path.isfile(img_path):
+        yield "{}/img.jpg".format(zid), iter_file(img_path)
+    # the student's posts, with every comment / reply on them
+    posts_sql = "SELECT * FROM POST WHERE zid = ? AND POST.id > ? ORDER BY POST.id LIMIT ?"
+    for row in iter_rows(posts_sql, [zid], shard):
+        post = [('from', row['zid']), ('time', format_dataset_time(row['time'])),
+                ('longitude', row['longitude']), ('latitude', row['latitude']), ('message', row['message'])]
+        yield "{}/{}.txt".format(zid, row['id']), [format_item(post)]
+    comments_sql = "SELECT COMMENT.* FROM COMMENT JOIN POST P ON P.id = COMMENT.post_id WHERE P.zid = ? AND COMMENT.id > ? ORDER BY COMMENT.id LIMIT ?"
+    for row in iter_rows(comments_sql, [zid], shard):
+        comment = [('from', row['zid']), ('time', format_dataset_time(row['time'])), ('message', row['message'])]
+        yield "{}/{}-{}.txt".format(zid, row['post_id'], row['id']), [format_item(comment)]
+    replies_sql = "SELECT REPLY.*, C.post_id FROM REPLY JOIN COMMENT C ON C.id = REPLY.comment_id JOIN POST P ON P.id = C.post_id WHERE P.zid = ? AND REPLY.id > ? ORDER BY REPLY.id LIMIT ?"
+    for row in iter_rows(replies_sql, [zid], shard):
+        reply = [('from', row['zid']), ('time', format_dataset_time(row['time'])), ('message', row['message'])]
+        yield "{}/{}-{}-{}.txt".format(zid, row['post_id'], row['comment_id'], row['id']), [format_item(reply)]
+    # what the student wrote on other students' posts (on any shard)
+    for other_shard in range(SHARD_MAP.count):
+        comments_sql = "SELECT COMMENT.* FROM COMMENT JOIN POST P ON P.id = COMMENT.post_id WHERE COMMENT.zid = ? AND P.zid != COMMENT.zid AND COMMENT.id > ? ORDER BY COMMENT.id LIMIT ?"
+        for row in iter_rows(comments_sql, [zid], other_shard):
+            comment = [('from', row['zid']), ('time', format_dataset_time(row['time'])), ('message', row['message'])]
+            yield "{}/comments/{}-{}.txt".format(zid, row['post_id'], row['id']), [format_item(comment)]
+        replies_sql = "SELECT REPLY.*, C.post_id FROM REPLY JOIN COMMENT C ON C.id = REPLY.comment_id JOIN POST P ON P.id = C.post_id WHERE REPLY.zid = ? AND P.zid != REPLY.zid AND REPLY.id > ? ORDER BY REPLY.id LIMIT ?"
+        for row in iter_rows(replies_sql, [zid], other_shard):
+            reply = [('from', row['zid']), ('time', format_dataset_time(row['time'])), ('message', row['message'])]
+            yield "{}/replies/{}-{}-{}.txt".format(zid, row['post_id'], row['comment_id'], row['id']), [format_item(reply)]
+
+
+# Function: iter_file
+# Content of a file, EXPORT_FILE_CHUNK bytes at a time
+def iter_file(path):
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(EXPORT_FILE_CHUNK)
+            if not data:
+                return
+            yield data
+
+
+# Function: generate_export
+# The zip of iter_export_files(profile), as a stream of bytes
+def generate_export(profile):
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, chunks in iter_export_files(profile):
+            info = zipfile.ZipInfo(name, date_time = time.gmtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with archive.open(info, 'w') as f:
+                for data in chunks:
+                    f.write(data)
+                    if len(stream.chunks) > 0:
+                        yield stream.drain()
+            yield stream.drain()
+    yield stream.drain()
+
+
+# ------------------------------------------------------- #
+#             Common Helper Functions : deletes           #
+# ------------------------------------------------------- #
+# Deleting a row also deletes everything hanging off it (post -> comments
+# -> replies), inside the caller's transaction (cur from db_transaction)
+
+# Function: delete_comments_cascade
+# Delete the comments selected by "where" and their replies
+def delete_comments_cascade(cur, where, params):
+    cur.execute("DELETE FROM REPLY WHERE comment_id IN (SELECT id FROM COMMENT WHERE {})".format(where), params)
+    cur.execute("DELETE FROM COMMENT WHERE {}".format(where), params)
+
+
+# Function: delete_posts_cascade
+# Delete the posts selected by "where" with their comments and replies
+def delete_posts_cascade(cur, where, params):
+    delete_comments_cascade(cur, "post_id IN (SELECT id FROM POST WHERE {})".format(where), params)
+    cur.execute("DELETE FROM POST WHERE {}".format(where), params)
+
+
+# Function: count_account_content
+# Number of posts, comments and replies written by zid
+def count_account_content(zid):
+    count_sql = "SELECT (SELECT count(*) FROM POST WHERE zid = ?) + (SELECT count(*) FROM COMMENT WHERE zid = ?) + (SELECT count(*) FROM REPLY WHERE zid = ?) AS n"
+    return sum(row['n'] for row in db_read_all(count_sql, [zid, zid, zid]))
+
+
+# Function: delete_account_data
+# Remove an account in one transaction per shard: profile, friendships and
+# courses at once, and its posts / comments / replies too when there are at
+# most DELETE_CHUNK_SIZE. Larger accounts are queued in ACCOUNT_PURGE and
+# their content is deleted by purge_account_content in a background thread
+# (until it is done, add_authors hides it). Without the maintenance scheduler
+# (CGI, where the thread would die with the process) the purge runs before
+# the request returns.
+def delete_account_data(zid):
+    in_background = count_account_content(zid) > DELETE_CHUNK_SIZE
+    with db_transactions(range(SHARD_MAP.count)) as curs:
+        for shard, cur in curs.items():
+            cur.execute("DELETE FROM STUDENT WHERE zid = ?", [zid])
+            cur.execute("DELETE FROM TO_BE_SUSPENDED WHERE zid = ?", [zid])
+            cur.execute("DELETE FROM FRIENDS WHERE zid = ? OR friend_zid = ?", [zid, zid])
+            cur.execute("DELETE FROM COURSES WHERE zid = ?", [zid])
+            cur.execute("DELETE FROM NOTIFICATION WHERE zid = ? OR actor = ?", [zid, zid])
+            if in_background:
+                if shard == shard_of(zid):
+                    cur.execute("INSERT OR REPLACE INTO ACCOUNT_PURGE (zid, requested) VALUES (?, ?)", [zid, int(time.time())])
+            else:
+                delete_posts_cascade(cur, "zid = ?", [zid])
+                delete_comments_cascade(cur, "zid = ?", [zid])
+                cur.execute("DELETE FROM REPLY WHERE zid = ?", [zid])
+    if not in_background:
+        return
+    if app.config.get('MAINTENANCE_SCHEDULER'):
+        threading.Thread(target = purge_account_content, args = [zid], daemon = True).start()
+    else:
+        purge_account_content(zid)
+
+
+# Function: delete_chunks
+# Repeatedly select up to DELETE_CHUNK_SIZE ids of "table" with select_sql and
+# delete them (cascading), one short transaction per chunk, so that other
+# writers only ever wait for one chunk
+# Output: number of rows of "table" deleted (on shard)
+def delete_chunks(table, select_sql, params, shard = 0):
+    deleted = 0
+    while True:
+        with db_transaction(shard) as cur:
+            ids = [row['id'] for row in cur.execute(select_sql, params + [DELETE_CHUNK_SIZE]).fetchall()]
+            if len(ids) == 0:
+                return deleted
+            where = "id IN ({})".format(",".join("?" * len(ids)))
+            if table == 'POST':
+                delete_posts_cascade(cur, where, ids)
+            elif table == 'COMMENT':
+                delete_comments_cascade(cur, where, ids)
+            else:
+                cur.execute("DELETE FROM {} WHERE {}".format(table, where), ids)
+        deleted += len(ids)
+
+
+# Function: purge_account_content
+# Delete the posts / comments / replies of a deleted account chunk by chunk
+# Finished purges are removed from ACCOUNT_PURGE, unfinished ones are resumed
+# by purge_orphans (./maintenance.py purge_orphans)
+def purge_account_content(zid):
+    for shard in range(SHARD_MAP.count):
+        for table in ['POST', 'COMMENT', 'REPLY']:
+            delete_chunks(table, "SELECT id FROM {} WHERE zid = ? LIMIT ?".format(table), [zid], shard)
+    temp = db_write("DELETE FROM ACCOUNT_PURGE WHERE zid = ?", [zid], shard_of(zid))
+
+
+# Function: purge_orphans
+# Delete comments whose post no longer exists and replies whose comment no
+# longer exists (left by deletes before they cascaded), and finish any
+# interrupted account purge
+# Output: dict of deleted orphan counts
+def purge_orphans():
+    for item in db_read_all("SELECT zid FROM ACCOUNT_PURGE", []):
+        purge_account_content(item['zid'])
+    results = {'COMMENT': 0, 'REPLY': 0}
+    for shard in range(SHARD_MAP.count):
+        results['COMMENT'] += delete_chunks('COMMENT', "SELECT C.id FROM COMMENT C LEFT JOIN POST P ON P.id = C.post_id WHERE P.id IS NULL LIMIT ?", [], shard)
+        results['REPLY'] += delete_chunks('REPLY', "SELECT R.id FROM REPLY R LEFT JOIN COMMENT C ON C.id = R.comment_id WHERE C.id IS NULL LIMIT ?", [], shard)
+    return results
+
+
+
+# ------------------------------------------------------- #
+#                   Maintenance jobs                      #
+# ------------------------------------------------------- #
+# Jobs are run every run_every seconds by the scheduler thread of each
+# worker (see start_maintenance_scheduler) or by ./maintenance.py run.
+# MAINTENANCE_JOB (on shard 0) holds the schedule, the last run and a lease
+# (locked_by / locked_until): a worker runs a job only if it took the lease,
+# so each job runs in one worker at a time. Every run is kept in MAINTENANCE_LOG.
+
+# name -> (function () -> dict of results, default run_every)
+MAINTENANCE_JOBS = {}
+MAINTENANCE_LOCK = threading.Lock()
+maintenance_scheduler = {'pid': None}
+
+
+# Function: maintenance_job
+# Register function as the job name, run every run_every seconds by default
+# (./maintenance.py schedule changes it, 0 disables the job)
+def maintenance_job(name, run_every):
+    def register(function):
+        MAINTENANCE_JOBS[name] = (function, run_every)
+        return function
+    return register
+
+
+maintenance_job('purge_orphans', 24 * 3600)(purge_orphans)
+
+
+# Function: repair_all_counters
+# Counters and scores of the "top" feed
+@maintenance_job('repair_counters', 7 * 24 * 3600)
+def repair_all_counters():
+    results = repair_counters()
+    results['POST score'] = rescore_all_posts()
+    return results
+
+
+# Function: expire_confirmations
+# Delete the registrations not confirmed within CONFIRMATION_TTL
+@maintenance_job('expire_confirmations', 3600)
+def expire_confirmations():
+    expired = 0
+    for shard in range(SHARD_MAP.count):
+        with db_transaction(shard) as cur:
+            cur.execute("DELETE FROM TO_BE_CONFIRMED WHERE created < ?", [int(time.time()) - CONFIRMATION_TTL])
+            expired += cur.rowcount
+    return {'TO_BE_CONFIRMED': expired}
+
+
+# Function: incremental_vacuum
+# Give the free pages back to the file system, VACUUM_STEP_PAGES per
+# transaction so that writers only wait for one step
+# Needs auto_vacuum = INCREMENTAL (./maintenance.py enable_incremental_vacuum),
+# other shards are skipped
+@maintenance_job('incremental_vacuum', 3600)
+def incremental_vacuum():
+    results = {'freed_pages': 0, 'skipped_shards': []}
+    for shard in range(SHARD_MAP.count):
+        if db_read("PRAGMA auto_vacuum", [], shard)[0][0] != 2:
+            results['skipped_shards'].append(shard)
+            continue
+        while True:
+            with db_transaction(shard) as cur:
+                free_pages = cur.execute("PRAGMA freelist_count").fetchone()[0]
+                cur.execute("PRAGMA incremental_vacuum({})".format(VACUUM_STEP_PAGES)).fetchall()
+                freed = free_pages - cur.execute("PRAGMA freelist_count").fetchone()[0]
+            results['freed_pages'] += freed
+            if freed == 0:
+                break
+    return results
+
+
+# Function: enable_incremental_vacuum
+# Switch a shard to auto_vacuum = INCREMENTAL (new databases have it, see
+# db_schema.sql). Rewrites the whole file (VACUUM): run it with the app stopped
+# Output: True if the shard was converted
+def enable_incremental_vacuum(shard):
+    with sqlite3.connect(SHARD_MAP.paths[shard], isolation_level = None) as conn:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+    return True
+
+
+# Function: analyze
+# Refresh the statistics of the query planner (sqlite_stat1), reading at
+# most ANALYSIS_LIMIT rows per index
+@maintenance_job('analyze', 24 * 3600)
+def analyze():
+    results = {}
+    for shard in range(SHARD_MAP.count):
+        with db_transaction(shard) as cur:
+            cur.execute("PRAGMA analysis_limit = {}".format(ANALYSIS_LIMIT))
+            cur.execute("ANALYZE")
+            results[shard] = cur.execute("SELECT count(*) FROM sqlite_stat1").fetchone()[0]
+    return {'sqlite_stat1': results}
+
+
+# Function: save_graph_snapshot
+# Write a fresh GRAPH_SNAPSHOT_PATH, so that starting workers replay few changes
+@maintenance_job('graph_snapshot', 3600)
+def save_graph_snapshot():
+    if SHARD_MAP.count > 1:
+        return {'skipped': "no snapshot with several shards"}
+    graph = build_social_graph()
+    graph.save_snapshot(GRAPH_SNAPSHOT_PATH)
+    return {'students': len(graph.zids), 'change_id': graph.change_id}
+
+
+# Function: backup_database
+# Online snapshot of every shard in db/backups (see backup_db.py), the
+# latest BACKUP_KEEP are kept
+@maintenance_job('backup', 24 * 3600)
+def backup_database():
+    from backup_db import create_snapshot, rotate_snapshots
+    name = create_snapshot(SHARD_MAP)
+    return {'snapshot': name, 'deleted': rotate_snapshots()}
+
+
+# Function: precompute_friend_suggestions
+# Store get_friend_suggestion of every student in FRIEND_SUGGESTION (read by
+# view_friends), SUGGESTION_CHUNK_SIZE students per app context so that
+# their profiles / courses are read in batches
+@maintenance_job('friend_suggestions', 6 * 3600)
+def precompute_friend_suggestions():
+    computed = int(time.time())
+    zids = sorted(item['zid'] for item in db_read_all("SELECT zid FROM STUDENT", []))
+    for start in range(0, len(zids), SUGGESTION_CHUNK_SIZE):
+        chunk = zids[start:start + SUGGESTION_CHUNK_SIZE]
+        with app.app_context():
+            suggestions = {zid: get_friend_suggestion(zid) for zid in chunk}
+        for shard, shard_zids in SHARD_MAP.group_by_shard(chunk).items():
+            rows = [(zid, rank, suggestion, computed) for zid in shard_zids for rank, suggestion in enumerate(suggestions[zid])]
+            with db_transaction(shard) as cur:
+                cur.executemany("DELETE FROM FRIEND_SUGGESTION WHERE zid = ?", [(zid,) for zid in shard_zids])
+                cur.executemany("INSERT INTO FRIEND_SUGGESTION (zid, rank, suggestion, computed) VALUES (?,?,?,?)", rows)
+    # students deleted since the last run
+    removed = 0
+    for shard in range(SHARD_MAP.count):
+        with db_transaction(shard) as cur:
+            cur.execute("DELETE FROM FRIEND_SUGGESTION WHERE computed < ?", [computed])
+            removed += cur.rowcount
+    return {'students': len(zids), 'removed': removed}
+
+
+# Function: get_stored_suggestions
+# The friend suggestions of zid stored by the friend_suggestions job, without
+# those who became friends or left since
+# Output: list of zids, None if there are none recent enough
+def get_stored_suggestions(zid):
+    rows = db_read("SELECT suggestion FROM FRIEND_SUGGESTION WHERE zid = ? AND computed >= ? ORDER BY rank",
+                   [zid, int(time.time()) - SUGGESTION_MAX_AGE], shard_of(zid))
+    friends = set(get_social_graph().friends(zid))
+    suggestions = [row['suggestion'] for row in rows if row['suggestion'] not in friends]
+    get_loader('STUDENT').prime(suggestions)
+    suggestions = [suggestion for suggestion in suggestions if get_profile_by_zid(suggestion) != None]
+    return suggestions if len(suggestions) > 0 else None
+
+
+# Function: claim_job
+# Take the lease of job name if it is due (or force) and no other worker holds it
+# Output: True if this worker may run the job
+def claim_job(name, force = False):
+    now = int(time.time())
+    due_sql = "" if force else " AND run_every > 0 AND coalesce(last_run, 0) + run_every <= ?"
+    with db_transaction() as cur:
+        cur.execute("INSERT OR IGNORE INTO MAINTENANCE_JOB (name, run_every) VALUES (?, ?)", [name, MAINTENANCE_JOBS[name][1]])
+        cur.execute("UPDATE MAINTENANCE_JOB SET locked_by = ?, locked_until = ? WHERE name = ? AND coalesce(locked_until, 0) < ?" + due_sql,
+                    [os.getpid(), now + MAINTENANCE_LEASE, name, now] + ([] if force else [now]))
+        return cur.rowcount == 1
+
+
+# Function: run_job
+# Run job name if this worker gets its lease, record the run and release the lease
+# Output: dict (name, started, duration, status, result) of the run, None if not run
+def run_job(name, force = False):
+    if not claim_job(name, force):
+        return None
+    function = MAINTENANCE_JOBS[name][0]
+    started = time.time()
+    try:
+        result, status = function(), 'ok'
+    except Exception as error:
+        app.logger.exception("maintenance job %s failed", name)
+        result, status = repr(error), 'error'
+    run = {'name': name, 'started': int(started), 'duration': time.time() - started, 'status': status,
+           'result': json.dumps(result, sort_keys = True)}
+    app.logger.info("maintenance job %s: %s in %.3fs %s", name, status, run['duration'], run['result'])
+    with db_transaction() as cur:
+        cur.execute("UPDATE MAINTENANCE_JOB SET last_run = ?, last_duration = ?, last_status = ?, locked_by = NULL, locked_until = NULL WHERE name = ?",
+                    [run['started'], run['duration'], status, name])
+        cur.execute("INSERT INTO MAINTENANCE_LOG (name, started, duration, status, result) VALUES (?,?,?,?,?)",
+                    [name, run['started'], run['duration'], status, run['result']])
+        cur.execute("DELETE FROM MAINTENANCE_LOG WHERE started < ?", [run['started'] - MAINTENANCE_LOG_KEEP])
+    return run
+
+
+# Function: run_due_jobs
+# Run every job that is due
+# Output: list of the runs (see run_job)
+def run_due_jobs():
+    runs = []
+    for name in MAINTENANCE_JOBS:
+        run = run_job(name)
+        if run != None:
+            runs.append(run)
+    return runs
+
+
+# Function: set_job_schedule
+# Run job name every run_every seconds (0: never, except from the CLI)
+def set_job_schedule(name, run_every):
+    temp = db_write("INSERT INTO MAINTENANCE_JOB (name, run_every) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET run_every = excluded.run_every",
+                    [name, run_every])
+
+
+# Function: get_job_status
+# Schedule and last run of every registered job
+# Output: list of dicts (name, run_every, last_run, last_duration, last_status, locked_by)
+def get_job_status():
+    rows = {row['name']: dict(row) for row in db_read("SELECT * FROM MAINTENANCE_JOB", [])}
+    status = []
+    for name, (function, run_every) in MAINTENANCE_JOBS.items():
+        status.append(rows.get(name, {'name': name, 'run_every': run_every, 'last_run': None, 'last_duration': None,
+                                      'last_status': None, 'locked_by': None}))
+    return status
+
+
+# Function: start_maintenance_scheduler
+# Start the scheduler thread of this worker (once per process)
+def start_maintenance_scheduler():
+    if maintenance_scheduler['pid'] == os.getpid():
+        return
+    with MAINTENANCE_LOCK:
+        if maintenance_scheduler['pid'] != os.getpid():
+            maintenance_scheduler['pid'] = os.getpid()
+            threading.Thread(target = run_maintenance_scheduler, daemon = True).start()
+
+
+# Function: run_maintenance_scheduler
+# Look for due jobs about every MAINTENANCE_TICK seconds; the workers wake
+# at random times and the lease picks the one that runs each job
+def run_maintenance_scheduler():
+    while True:
+        time.sleep(MAINTENANCE_TICK * random.uniform(0.5, 1.5))
+        try:
+            run_due_jobs()
+        except sqlite3.Error as error:
+            app.logger.warning("maintenance scheduler: %s", error)
+
+
 # ------------------------------------------------------- #
 #    Flask Functions : login and initialization           #
 # ------------------------------------------------------- #
 app = Flask(__name__)
 
+
+# Function: get_secret_key
+# The session key must be the same in every worker process:
+# use $UNSWTALK_SECRET_KEY, otherwise generate one once and keep it in SECRET_KEY_PATH
+# Processes starting together may all generate one: each writes its key to a
+# temporary file and links it into place, the first link wins and everyone
+# reads that file (it never exists half written)
+def get_secret_key():
+    secret_key = os.environ.get('UNSWTALK_SECRET_KEY')
+    if secret_key:
+        return secret_key
+    if not os.path.exists(SECRET_KEY_PATH):
+        temp_path = "{}.{}.tmp".format(SECRET_KEY_PATH, os.getpid())
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(os.urandom(24))
+                f.flush()
+                os.fsync(f.fileno())
+            os.link(temp_path, SECRET_KEY_PATH)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp_path)
+    with open(SECRET_KEY_PATH, 'rb') as f:
+        return f.read()
+
+
+# Function: create_app
+# App factory for long running servers (serve.py, UNSWtalk.wsgi, UNSWtalk.cgi)
+# Compiled templates are cached as bytecode in TEMPLATE_CACHE_DIR, and all
+# templates are loaded here (preload) so that pre-forked workers inherit them
+# Each worker runs the maintenance jobs (scheduler), except under CGI where
+# the process ends with the request: use ./maintenance.py run from cron
+# Pages open the notification stream only with stream: it holds a thread per
+# browser tab, which only threaded servers can afford (not CGI, sync workers)
+def create_app(debug = False, preload = True, scheduler = True, stream = False):
+    from jinja2 import FileSystemBytecodeCache
+    upgrade_db()
+    # load the social graph and the autocomplete index once, forked workers
+    # share their pages (CGI loads them on first use, if the request needs them)
+    if preload:
+        get_social_graph()
+        get_student_index()
+    app.secret_key = get_secret_key()
+    app.debug = debug
+    app.config['TEMPLATES_AUTO_RELOAD'] = debug
+    app.config['MAINTENANCE_SCHEDULER'] = scheduler
+    app.config['NOTIFICATION_STREAM'] = stream
+    if not os.path.exists(TEMPLATE_CACHE_DIR):
+        os.mkdir(TEMPLATE_CACHE_DIR)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)
+    if preload:
+        for template_name in app.jinja_env.list_templates():
+            app.jinja_env.get_template(template_name)
+    # workers open their own connections
+    close_connections()
+    return app
+
 # Function: before_request
 # Init g.user: profile and friends
 @app.before_request
 def before_request():
+    poll_changes()
+    prune_change_log()
+    if app.config.get('MAINTENANCE_SCHEDULER'):
+        start_maintenance_scheduler()
     if 'zid' in session:
         if is_suspended(session['zid']):
             g.user = get_suspended_profile_by_zid(session['zid'])
@@ -396,11 +2406,18 @@ def index(zid):
     # Get all sorted posts : your frineds' and yours
     posts_zid = get_friends_by_zid(zid)
     posts_zid.append(zid)
-    all_posts = get_posts_by_zids(posts_zid)
+    # ?mode=top : engagement ranked instead of the latest first
+    mode = 'top' if request.args.get('mode') == 'top' else 'latest'
+    if mode == 'top':
+        all_posts = get_top_posts(g.user['zid'], posts_zid)
+    else:
+        all_posts = get_posts_by_zids(posts_zid)
     # Get splitted post indexes for pagination
     pages = get_page_index(len(all_posts))
+    # How you are connected to this student
+    connection = get_connection(g.user['zid'], zid)
 
-    return render_template('index_simple.html', welcome_info = welcome_info, curr_profile = curr_profile, all_posts = all_posts, pages = pages)
+    return render_template('index_simple.html', welcome_info = welcome_info, curr_profile = curr_profile, all_posts = all_posts, pages = pages, connection = connection, mode = mode)
 
 
 # Function : logout
@@ -457,9 +2474,10 @@ def register():
         # Send confirmation code to given email
         send_email(email, "Confirmation code for UNSWTalk", confirmation_code)
         # insert new user to TABLE TO_BE_CONFIRMED
-        insert_sql = "INSERT INTO TO_BE_CONFIRMED (zid, email, password, full_name, birthday, profile_img, program, home_suburb, home_longitude, home_latitude, profile_text, confirmation_code) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)"
-        insert_data = [zid, email, password, "Default user", "", "img/default.png", "", "", "", "", "", confirmation_code]
-        temp = db_query(insert_sql, insert_data)    
+        # (expired after CONFIRMATION_TTL by the expire_confirmations job)
+        insert_sql = "INSERT INTO TO_BE_CONFIRMED (zid, email, password, full_name, birthday, profile_img, program, home_suburb, home_longitude, home_latitude, profile_text, confirmation_code, created) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)"
+        insert_data = [zid, email, password, "Default user", "", "img/default.png", "", "", "", "", "", confirmation_code, int(time.time())]
+        temp = db_write(insert_sql, insert_data, shard_of(zid))    
 
         return redirect(url_for('confirmation'))
 
@@ -476,7 +2494,7 @@ def confirmation():
         confirmation_code = request.form.get("confirmation_code","")
 
         # get confirm profile by zid
-        confirm_profile = db_query("SELECT * FROM TO_BE_CONFIRMED WHERE zid = ?", [zid])
+        confirm_profile = db_read("SELECT * FROM TO_BE_CONFIRMED WHERE zid = ?", [zid], shard_of(zid))
         if len(confirm_profile) != 0:
             confirm_profile = dict(confirm_profile[0])
         else:
@@ -491,10 +2509,11 @@ def confirmation():
         # case 3: match 
         else:
             # move confirm_profile from TO_BE_CONFIRMED to STUDENT
-            temp_delete = db_query("DELETE FROM TO_BE_CONFIRMED WHERE zid = ?", [zid])
             insert_sql = "INSERT INTO STUDENT (zid, email, password, full_name, birthday, profile_img, program, home_suburb, home_longitude, home_latitude, profile_text) VALUES (?,?,?,?,?,?,?,?,?,?,?)"
             insert_data = [confirm_profile['zid'], confirm_profile['email'], confirm_profile['password'], "Default user", "", "img/default.png", "", "", "", "", ""]
-            temp_insert = db_query(insert_sql, insert_data)
+            with db_transaction(shard_of(zid)) as cur:
+                cur.execute("DELETE FROM TO_BE_CONFIRMED WHERE zid = ?", [zid])
+                cur.execute(insert_sql, insert_data)
             # mkdir to store profile image
             img_dir = "static/student_img/{}/{}".format(DATABASE_NAME, zid)
             if not os.path.exists(img_dir):
@@ -522,7 +2541,10 @@ def view_profile(zid):
         return redirect(url_for('login'))
     # Check whether you are in your homepage
     curr_profile = get_profile_by_zid(zid)
-    return render_template('view_profile.html', curr_profile = curr_profile)
+    # How you are connected to this student
+    connection = get_connection(g.user['zid'], zid)
+    course_codes = get_course_codes_by_zid(zid)
+    return render_template('view_profile.html', curr_profile = curr_profile, connection = connection, course_codes = course_codes)
 
 
 # Function : to_edit_profile_page()
@@ -584,6 +2606,7 @@ def edit_profile():
         # Check profile_img
         file = request.files['img_path']
         if file and allowed_file(file.filename):
+            from werkzeug.utils import secure_filename
             # get file name
             filename = secure_filename(file.filename)
             # get absolute path to store
@@ -599,7 +2622,7 @@ def edit_profile():
         # Update changes
         update_sql = "UPDATE STUDENT SET email=?, password=?, full_name=?, birthday=?, profile_img=?, program=?, home_suburb=?, profile_text=? WHERE zid=?"
         update_data = [email, password, full_name, birthday, profile_img, program, home_suburb, profile_text, g.user['zid']]
-        temp = db_query(update_sql, update_data)    
+        temp = db_write(update_sql, update_data, shard_of(g.user['zid']))    
 
     return redirect(url_for('view_profile', zid = g.user['zid']))
 
@@ -614,10 +2637,8 @@ def suspend_account():
         return redirect(url_for('login'))
     # get profile to be suspended
     suspend_profile = get_profile_by_zid(g.user['zid'])
-    # delete profile from STUDENT
-    temp_delete = db_query("DELETE FROM STUDENT WHERE zid = ?", [g.user['zid']])
-    # insert profile into TO_BE_SUSPENDED
-    insert_sql = "INSERT INTO TO_BE_SUSPENDED (zid, email, password, full_name, birthday, profile_img, program, home_suburb, home_longitude, home_latitude, profile_text) VALUES (?,?,?,?,?,?,?,?,?,?,?)"
+    # move profile from STUDENT to TO_BE_SUSPENDED
+    insert_sql = "INSERT INTO TO_BE_SUSPENDED (zid, email, password, full_name, birthday, profile_img, program, home_suburb, home_longitude, home_latitude, profile_text, post_count, friend_count) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)"
     insert_data = [suspend_profile['zid'], 
                 suspend_profile['email'], 
                 suspend_profile['password'], 
@@ -628,8 +2649,12 @@ def suspend_account():
                 suspend_profile['home_suburb'],
                 suspend_profile['home_longitude'],
                 suspend_profile['home_latitude'],
-                suspend_profile['profile_text']]
-    temp_insert = db_query(insert_sql, insert_data)
+                suspend_profile['profile_text'],
+                suspend_profile['post_count'],
+                suspend_profile['friend_count']]
+    with db_transaction(shard_of(g.user['zid'])) as cur:
+        cur.execute("DELETE FROM STUDENT WHERE zid = ?", [g.user['zid']])
+        cur.execute(insert_sql, insert_data)
     return redirect(url_for('view_profile', zid = g.user['zid']))
 
 
@@ -641,12 +2666,10 @@ def activate_account():
     if 'zid' not in session:
         return redirect(url_for('login'))
     # get profile to be activated
-    suspend_profile = db_query("SELECT * FROM TO_BE_SUSPENDED WHERE zid = ?", [g.user['zid']])
+    suspend_profile = db_read("SELECT * FROM TO_BE_SUSPENDED WHERE zid = ?", [g.user['zid']], shard_of(g.user['zid']))
     suspend_profile = dict(suspend_profile[0])
-    # delete profile from TO_BE_SUSPENDED
-    temp_delete = db_query("DELETE FROM TO_BE_SUSPENDED WHERE zid = ?", [g.user['zid']])
-    # insert profile into STUDENT
-    insert_sql = "INSERT INTO STUDENT (zid, email, password, full_name, birthday, profile_img, program, home_suburb, home_longitude, home_latitude, profile_text) VALUES (?,?,?,?,?,?,?,?,?,?,?)"
+    # move profile from TO_BE_SUSPENDED to STUDENT
+    insert_sql = "INSERT INTO STUDENT (zid, email, password, full_name, birthday, profile_img, program, home_suburb, home_longitude, home_latitude, profile_text, post_count, friend_count) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)"
     insert_data = [suspend_profile['zid'], 
                 suspend_profile['email'], 
                 suspend_profile['password'], 
@@ -657,11 +2680,28 @@ def activate_account():
                 suspend_profile['home_suburb'],
                 suspend_profile['home_longitude'],
                 suspend_profile['home_latitude'],
-                suspend_profile['profile_text']]
-    temp_insert = db_query(insert_sql, insert_data)
+                suspend_profile['profile_text'],
+                suspend_profile['post_count'],
+                suspend_profile['friend_count']]
+    with db_transaction(shard_of(g.user['zid'])) as cur:
+        cur.execute("DELETE FROM TO_BE_SUSPENDED WHERE zid = ?", [g.user['zid']])
+        cur.execute(insert_sql, insert_data)
     return redirect(url_for('view_profile', zid = g.user['zid']))
 
 
+# Function : export_data
+# Download all data of g.user as a zip (see generate_export)
+# The zip is streamed, its length is not known in advance
+@app.route('/export_data', methods=['GET'])
+def export_data():
+    # Check login
+    if 'zid' not in session or g.user == None:
+        return redirect(url_for('login'))
+    response = Response(stream_with_context(generate_export(g.user)), mimetype = 'application/zip')
+    response.headers['Content-Disposition'] = 'attachment; filename="{}.zip"'.format(g.user['zid'])
+    return response
+
+
 # Function : delete account
 # Permanitely delete all information of a student
 # Only g.user can delete account
@@ -670,13 +2710,8 @@ def delete_account():
     # Check login
     if 'zid' not in session:
         return redirect(url_for('login'))
-    # Delete all information of all tables
-    temp_delete_1 = db_query("DELETE FROM REPLY WHERE zid = ?", [g.user['zid']])
-    temp_delete_2 = db_query("DELETE FROM COMMENT WHERE zid = ?", [g.user['zid']])
-    temp_delete_3 = db_query("DELETE FROM POST WHERE zid = ?", [g.user['zid']])
-    temp_delete_4 = db_query("DELETE FROM COURSES WHERE zid = ?", [g.user['zid']])
-    temp_delete_5 = db_query("DELETE FROM FRIENDS WHERE zid = ? OR friend_zid = ?", [g.user['zid'], g.user['zid']])
-    temp_delete_6 = db_query("DELETE FROM STUDENT WHERE zid = ?", [g.user['zid']])
+    # Delete all information of all tables (large accounts: posts etc. in background)
+    delete_account_data(g.user['zid'])
     # Log out
     return redirect(url_for('logout'))
 
@@ -696,11 +2731,14 @@ def new_post():
     if request.method == 'POST':
         curr_message = request.form.get('message','')
         if curr_message != None and curr_message != "":
-            # Get current time
-            curr_time = datetime.now()
-            curr_time = curr_time.strftime("%Y-%m-%dT%H:%M:%S%z")
-            # Insert into db
-            temp = db_query("INSERT INTO POST (zid, time, message) values (?, ?, ?)", [g.user['zid'], curr_time, curr_message])
+            # Get current time (UTC epoch seconds)
+            curr_time = int(time.time())
+            # Insert into db, located at the poster's home (as in the dataset)
+            with db_transaction(shard_of(g.user['zid'])) as cur:
+                cur.execute("INSERT INTO POST (zid, time, longitude, latitude, message) values (?, ?, ?, ?, ?)", [g.user['zid'], curr_time, g.user['home_longitude'], g.user['home_latitude'], curr_message])
+                post_id = cur.lastrowid
+                update_post_score(cur, post_id)
+                insert_mentions(cur, curr_message, g.user['zid'], post_id, None, None, curr_time)
     return redirect(url_for('index', zid = g.user['zid']))
 
 
@@ -712,7 +2750,10 @@ def new_post():
 def delete_post(zid, post_id):
     if 'zid' not in session:
         return redirect(url_for('login'))
-    temp = db_query("DELETE FROM POST WHERE id = ?", [post_id])
+    shard = locate_row('POST', post_id)
+    if shard != None:
+        with db_transaction(shard) as cur:
+            delete_posts_cascade(cur, "id = ?", [post_id])
     return redirect(url_for('index', zid = zid))
 
 
@@ -726,8 +2767,15 @@ def view_post_detail(zid, post_id):
         return redirect(url_for('login'))
     # Check whether this post is made on your homepage
     curr_profile = get_profile_by_zid(zid)
-    # Get this post
+    # Register the whole thread: its replies and every author are then
+    # read in one batch each
+    comments = get_loader('COMMENT').load(int(post_id))
+    replies = get_loader('REPLY').load_many(comment['id'] for comment in comments)
+    prime_authors(comments + [reply for rows in replies.values() for reply in rows])
+    # Get this post (gone: deleted, or its author's account is being deleted)
     curr_post = get_post_by_post_id(post_id)
+    if curr_post == None:
+        return redirect(url_for('index', zid = zid))
     # Get all comments
     all_comments = get_comments_by_post_id(post_id)
     # Get all replies
@@ -747,10 +2795,18 @@ def new_comment(zid, post_id):
         return redirect(url_for('login'))
     if request.method == 'POST':
         curr_message = request.form.get('comment','')
-        if curr_message != None and curr_message != "":
-            curr_time = datetime.now()
-            curr_time = curr_time.strftime("%Y-%m-%dT%H:%M:%S%z")
-            temp = db_query("INSERT INTO COMMENT (post_id, zid, time, message) values (?, ?, ?, ?)", [post_id, g.user['zid'], curr_time, curr_message])
+        shard = locate_row('POST', post_id)
+        if curr_message != None and curr_message != "" and shard != None:
+            curr_time = int(time.time())
+            # comments are stored with their post
+            with db_transaction(shard) as cur:
+                cur.execute("INSERT INTO COMMENT (post_id, zid, time, message) values (?, ?, ?, ?)", [post_id, g.user['zid'], curr_time, curr_message])
+                comment_id = cur.lastrowid
+                update_post_score(cur, post_id)
+                mentions = insert_mentions(cur, curr_message, g.user['zid'], post_id, comment_id, None, curr_time)
+                post = cur.execute("SELECT zid FROM POST WHERE id = ?", [post_id]).fetchone()
+                if post != None and post['zid'] not in mentions:
+                    insert_notifications(cur, [post['zid']], 'comment', g.user['zid'], post_id, comment_id, None, curr_time)
     return redirect(url_for('view_post_detail', zid = zid, post_id = post_id))
 
 
@@ -762,7 +2818,13 @@ def new_comment(zid, post_id):
 def delete_comment(zid, post_id, comment_id):
     if 'zid' not in session:
         return redirect(url_for('login'))
-    temp = db_query("DELETE FROM COMMENT WHERE id = ?", [comment_id])
+    shard = locate_row('COMMENT', comment_id)
+    if shard != None:
+        with db_transaction(shard) as cur:
+            comment = cur.execute("SELECT post_id FROM COMMENT WHERE id = ?", [comment_id]).fetchone()
+            delete_comments_cascade(cur, "id = ?", [comment_id])
+            if comment != None:
+                update_post_score(cur, comment['post_id'])
     return redirect(url_for('view_post_detail', zid = zid, post_id = post_id))
 
 
@@ -776,10 +2838,19 @@ def new_reply(zid, post_id, comment_id):
         return redirect(url_for('login'))
     if request.method == 'POST':
         curr_message = request.form.get('reply','')
-        if curr_message != None and curr_message != "":
-            curr_time = datetime.now()
-            curr_time = curr_time.strftime("%Y-%m-%dT%H:%M:%S%z")
-            temp = db_query("INSERT INTO REPLY (comment_id, zid, time, message) values (?, ?, ?, ?)", [comment_id, g.user['zid'], curr_time, curr_message])
+        shard = locate_row('COMMENT', comment_id)
+        if curr_message != None and curr_message != "" and shard != None:
+            curr_time = int(time.time())
+            # replies are stored with their comment
+            with db_transaction(shard) as cur:
+                cur.execute("INSERT INTO REPLY (comment_id, zid, time, message) values (?, ?, ?, ?)", [comment_id, g.user['zid'], curr_time, curr_message])
+                reply_id = cur.lastrowid
+                comment = cur.execute("SELECT C.post_id, C.zid, P.zid AS post_zid FROM COMMENT C LEFT JOIN POST P ON P.id = C.post_id WHERE C.id = ?", [comment_id]).fetchone()
+                if comment != None:
+                    update_post_score(cur, comment['post_id'])
+                    mentions = insert_mentions(cur, curr_message, g.user['zid'], comment['post_id'], comment_id, reply_id, curr_time)
+                    recipients = [zid for zid in [comment['zid'], comment['post_zid']] if zid not in mentions]
+                    insert_notifications(cur, recipients, 'reply', g.user['zid'], comment['post_id'], comment_id, reply_id, curr_time)
     return redirect(url_for('view_post_detail', zid = zid, post_id = post_id))
 
 
@@ -791,7 +2862,13 @@ def new_reply(zid, post_id, comment_id):
 def delete_reply(zid, post_id, reply_id):
     if 'zid' not in session:
         return redirect(url_for('login'))
-    temp = db_query("DELETE FROM REPLY WHERE id = ?", [reply_id])
+    shard = locate_row('REPLY', reply_id)
+    if shard != None:
+        with db_transaction(shard) as cur:
+            comment = cur.execute("SELECT C.post_id FROM REPLY R JOIN COMMENT C ON C.id = R.comment_id WHERE R.id = ?", [reply_id]).fetchone()
+            cur.execute("DELETE FROM REPLY WHERE id = ?", [reply_id])
+            if comment != None:
+                update_post_score(cur, comment['post_id'])
     return redirect(url_for('view_post_detail', zid = zid, post_id = post_id))
 
 
@@ -814,11 +2891,98 @@ def search():
     return redirect(url_for('index', zid = g.user['zid']))
 
 
+# Function : mentions
+# Posts / comments / replies mentioning g.user, the latest first
+# ?before=<time>-<id> : the page after this mention
+@app.route('/mentions', methods=['GET'])
+def mentions():
+    # Check login
+    if 'zid' not in session:
+        return redirect(url_for('login'))
+    before = None
+    match = re.match(r'^([0-9]+)-([0-9]+)$', request.args.get('before', ''))
+    if match:
+        before = (int(match.group(1)), int(match.group(2)))
+    all_mentions, next_page = get_mentions(g.user['zid'], before)
+    if next_page != None:
+        next_page = "{}-{}".format(next_page[0], next_page[1])
+    return render_template('mentions.html', curr_profile = g.user, all_mentions = all_mentions, next_page = next_page)
+
+
+# Function : course_feed
+# Recent posts of the students enrolled in a course (code, e.g. COMP1521)
+# ?before=<time>-<id> : the page after this post
+@app.route('/course/<code>/feed', methods=['GET'])
+def course_feed(code):
+    # Check login
+    if 'zid' not in session:
+        return redirect(url_for('login'))
+    code = code.upper()
+    before = None
+    match = re.match(r'^([0-9]+)-([0-9]+)$', request.args.get('before', ''))
+    if match:
+        before = (int(match.group(1)), int(match.group(2)))
+    all_posts, next_page = get_course_feed(code, before)
+    if next_page != None:
+        next_page = "{}-{}".format(next_page[0], next_page[1])
+    return render_template('course_feed.html', curr_profile = g.user, code = code, member_count = count_course_members(code),
+                           all_posts = all_posts, next_page = next_page)
+
+# Function : nearby
+# Students and posts around the home of user <zid>
+# ?radius=<km> (default NEARBY_RADIUS_KM)
+# ?before=<time>-<id> : the page of posts after this post
+@app.route('/<zid>/nearby', methods=['GET', 'POST'])
+def nearby(zid):
+    # Check login
+    if 'zid' not in session:
+        return redirect(url_for('login'))
+    curr_profile = get_profile_by_zid(zid)
+    if curr_profile == None:
+        return redirect(url_for('index', zid = g.user['zid']))
+    try:
+        radius = float(request.values.get('radius', NEARBY_RADIUS_KM))
+    except ValueError:
+        radius = NEARBY_RADIUS_KM
+    radius = min(max(radius, 0.1), NEARBY_MAX_RADIUS_KM)
+    lon = to_coordinate(curr_profile['home_longitude'])
+    lat = to_coordinate(curr_profile['home_latitude'])
+    before = None
+    match = re.match(r'^([0-9]+)-([0-9]+)$', request.args.get('before', ''))
+    if match:
+        before = (int(match.group(1)), int(match.group(2)))
+    if lon == None or lat == None:
+        students_profile, all_posts, next_page = [], [], None
+    else:
+        students_profile = get_nearby_students(lon, lat, radius, exclude_zid = zid)
+        all_posts, next_page = get_nearby_posts(lon, lat, radius, before)
+    if next_page != None:
+        next_page = "{}-{}".format(next_page[0], next_page[1])
+    return render_template('nearby.html', curr_profile = curr_profile, students_profile = students_profile, all_posts = all_posts,
+                           next_page = next_page, radius = radius)
+
+
 
 # ------------------------------------------------------- #
 #           Flask Functions : handle friends              #
 # ------------------------------------------------------- #
 
+# Function: add_friendship
+# Both FRIENDS rows (each on the shard of its zid) and the notification
+def add_friendship(zid, friend_zid):
+    with db_transactions([shard_of(zid), shard_of(friend_zid)]) as curs:
+        curs[shard_of(zid)].execute("INSERT INTO FRIENDS (zid, friend_zid) VALUES (?, ?)", [zid, friend_zid])
+        curs[shard_of(friend_zid)].execute("INSERT INTO FRIENDS (zid, friend_zid) VALUES (?, ?)", [friend_zid, zid])
+        insert_notifications(curs[shard_of(friend_zid)], [friend_zid], 'friend', zid, None, None, None, int(time.time()))
+
+
+# Function: delete_friendship
+def delete_friendship(zid, friend_zid):
+    with db_transactions([shard_of(zid), shard_of(friend_zid)]) as curs:
+        curs[shard_of(zid)].execute("DELETE FROM FRIENDS WHERE zid=? and friend_zid=?", [zid, friend_zid])
+        curs[shard_of(friend_zid)].execute("DELETE FROM FRIENDS WHERE friend_zid=? and zid=?", [zid, friend_zid])
+
+
 # Function: view_friends
 # View the friend list of user with given zid
 # Only g.user has friend suggestion
@@ -831,16 +2995,20 @@ def view_friends(zid):
     curr_profile = get_profile_by_zid(zid)
     # Get all friends' zids
     friends_zid = get_friends_by_zid(zid)
-    # Collect all friends' profile_img and full_name
+    # Collect all friends' profile_img and full_name (read in one batch)
+    get_loader('STUDENT').prime(friends_zid)
     friends_profile = []
     for friend_zid in friends_zid:
        friend_profile = get_profile_by_zid(friend_zid)
        friends_profile.append(friend_profile)
 
-    # Get friend suggestions
+    # Get friend suggestions (precomputed by the friend_suggestions job if recent)
     if zid == g.user['zid']:
         friend_suggestion = []
-        suggestions_zid = get_friend_suggestion(zid)
+        suggestions_zid = get_stored_suggestions(zid)
+        if suggestions_zid == None:
+            suggestions_zid = get_friend_suggestion(zid)
+        get_loader('STUDENT').prime(suggestions_zid)
 
         for suggestion_zid in suggestions_zid:
             suggestion_profile = get_profile_by_zid(suggestion_zid)
@@ -858,8 +3026,7 @@ def view_friends(zid):
 def add_friend_index(zid):
     if 'zid' not in session:
         return redirect(url_for('login'))
-    temp = db_query("INSERT INTO FRIENDS (zid, friend_zid) VALUES (?, ?)", [g.user['zid'], zid])
-    temp = db_query("INSERT INTO FRIENDS (zid, friend_zid) VALUES (?, ?)", [zid, g.user['zid']])
+    add_friendship(g.user['zid'], zid)
     return redirect(url_for('index', zid = zid))
 
 # Flask function: delete friend from index page
@@ -869,8 +3036,7 @@ def add_friend_index(zid):
 def delete_friend_index(zid):
     if 'zid' not in session:
         return redirect(url_for('login'))
-    temp = db_query("DELETE FROM FRIENDS WHERE zid=? and friend_zid=?", [g.user['zid'], zid])
-    temp = db_query("DELETE FROM FRIENDS WHERE friend_zid=? and zid=?", [g.user['zid'], zid])
+    delete_friendship(g.user['zid'], zid)
     return redirect(url_for('index', zid = zid))
 
 # Flask function: add a friend from friend list
@@ -880,8 +3046,7 @@ def delete_friend_index(zid):
 def add_friend_list(curr_zid, zid):
     if 'zid' not in session:
         return redirect(url_for('login'))
-    temp = db_query("INSERT INTO FRIENDS (zid, friend_zid) VALUES (?, ?)", [g.user['zid'], zid])
-    temp = db_query("INSERT INTO FRIENDS (zid, friend_zid) VALUES (?, ?)", [zid, g.user['zid']])
+    add_friendship(g.user['zid'], zid)
     return redirect(url_for('view_friends', zid = curr_zid))
 
 # Flask function: delete a friend from friend list
@@ -891,16 +3056,101 @@ def add_friend_list(curr_zid, zid):
 def delete_friend_list(curr_zid, zid):
     if 'zid' not in session:
         return redirect(url_for('login'))
-    temp = db_query("DELETE FROM FRIENDS WHERE zid=? and friend_zid=?", [g.user['zid'], zid])
-    temp = db_query("DELETE FROM FRIENDS WHERE friend_zid=? and zid=?", [g.user['zid'], zid])
+    delete_friendship(g.user['zid'], zid)
     return redirect(url_for('view_friends', zid = curr_zid))
 
 
+# ------------------------------------------------------- #
+#           Flask Functions : API                         #
+# ------------------------------------------------------- #
+
+# Function: db_stats
+# Database contention metrics of the worker serving this request
+@app.route('/api/db_stats', methods=['GET'])
+def db_stats():
+    if 'zid' not in session:
+        return redirect(url_for('login'))
+    with DB_STATS_LOCK:
+        stats = dict(DB_STATS)
+    stats['pid'] = os.getpid()
+    stats['shards'] = SHARD_MAP.count
+    return jsonify(stats)
+
+
+# Function: autocomplete
+# Typeahead for the search box: ?q=<zid or name prefix>
+# Output: JSON list of {zid, full_name, profile_img, relation, url}
+@app.route('/api/autocomplete', methods=['GET'])
+def autocomplete():
+    if 'zid' not in session or g.user == None:
+        return redirect(url_for('login'))
+    results = get_autocomplete(g.user['zid'], request.args.get('q', '')[:64])
+    for item in results:
+        item['url'] = url_for('index', zid = item['zid'])
+        item['profile_img'] = url_for('static', filename = item['profile_img'])
+    return jsonify(results)
+
+# Function: notifications_stream
+# Server-sent events: the notifications of g.user as they are written
+# A reconnecting EventSource sends Last-Event-ID and gets what it missed
+# (at most NOTIFICATION_BACKLOG), a new stream starts from now.
+# A comment line is sent every NOTIFICATION_HEARTBEAT seconds so proxies
+# keep the connection open and closed clients are noticed. The stream ends
+# after NOTIFICATION_STREAM_LIFETIME seconds, so no tab holds a thread for good.
+# Without app.config['NOTIFICATION_STREAM'], 204 tells EventSource to stop.
+@app.route('/notifications/stream', methods=['GET'])
+def notifications_stream():
+    if 'zid' not in session or g.user == None:
+        return redirect(url_for('login'))
+    if not app.config.get('NOTIFICATION_STREAM'):
+        return Response(status = 204)
+    zid = g.user['zid']
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id', ''))
+    # subscribe before reading the backlog, so nothing falls in between
+    events = subscribe_notifications(zid)
+    if last_event_id.isdigit():
+        last_id = int(last_event_id)
+        backlog = get_notifications(zid, last_id)
+    else:
+        last_id = notification_poller['last_ids'][shard_of(zid)]
+        backlog = []
+
+    def generate(last_id):
+        deadline = time.monotonic() + NOTIFICATION_STREAM_LIFETIME
+        try:
+            yield "retry: 5000\n\n"
+            for row in backlog:
+                last_id = row['id']
+                message = format_notification(row)
+                if message != None:
+                    yield message
+            while time.monotonic() < deadline:
+                try:
+                    row = events.get(timeout = min(NOTIFICATION_HEARTBEAT, max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                if row['id'] <= last_id:
+                    continue
+                last_id = row['id']
+                # the stream outlives any profile it has read
+                reset_loaders()
+                message = format_notification(row)
+                if message != None:
+                    yield message
+        finally:
+            unsubscribe_notifications(zid, events)
+
+    response = Response(stream_with_context(generate(last_id)), mimetype = 'text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
 # ------------------------------------------------------- #
 #           Flask Functions : main                        #
 # ------------------------------------------------------- #
 
 if __name__ == '__main__':
-    app.secret_key = os.urandom(12)
-    app.run(debug=True)
+    create_app(debug = True, stream = True).run(debug = True)
 
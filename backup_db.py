@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Online backups of the database (every shard) with SQLite's backup API
+# How to run: ./backup_db.py <command>
+#       backup [--keep N] : new snapshot in db/backups/, keep the N latest
+#       list : snapshots and their files
+#       verify [name] : check the checksums and run PRAGMA quick_check
+#       restore name : replace the database by a snapshot (stop the app first)
+#       path [name] : files of a snapshot (default: the latest), e.g. for analytics
+#
+# The app keeps running during a backup: BACKUP_STEP_PAGES pages are copied
+# per step with a pause between steps, and the copy is read in one read
+# transaction, so under WAL writers are never blocked and the snapshot is
+# the database as it was when the backup started (each shard is copied in
+# turn, a snapshot of several shards is not one single point in time).
+#
+# A snapshot is a directory db/backups/<UTC time>/ holding one file per shard
+# and manifest.json (shard map generation, original paths, sha256 of each
+# file). Snapshot files are never written again: open_snapshot opens them
+# read-only for analytics, without touching the live database.
+
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import argparse
+
+from shards import ShardMap
+
+
+BACKUP_DIR = "db/backups"
+BACKUP_KEEP = 7
+BACKUP_STEP_PAGES = 1024
+BACKUP_STEP_SLEEP = 0.01
+MANIFEST_NAME = "manifest.json"
+CHECKSUM_CHUNK = 1024 * 1024
+# unfinished snapshots (backup interrupted) are deleted after this many seconds
+TEMP_MAX_AGE = 24 * 3600
+
+
+# Function: backup_file
+# Copy the database source_path to target_path, pages pages per step
+def backup_file(source_path, target_path, pages = BACKUP_STEP_PAGES, sleep = BACKUP_STEP_SLEEP):
+    source = sqlite3.connect(source_path, isolation_level = None)
+    target = sqlite3.connect(target_path, isolation_level = None)
+    try:
+        source.execute("PRAGMA query_only = 1")
+        # one read transaction for the whole copy: the backup does not restart
+        # when other connections write, and they do not wait for it
+        source.execute("BEGIN")
+        source.execute("SELECT count(*) FROM sqlite_master").fetchone()
+        # (backup's own sleep only applies when the database is locked)
+        source.backup(target, pages = pages, progress = lambda status, remaining, total: time.sleep(sleep))
+        source.execute("COMMIT")
+        # a self-contained file (no -wal), which can be opened immutable
+        target.execute("PRAGMA journal_mode = DELETE").fetchone()
+    finally:
+        target.close()
+        source.close()
+
+
+# Function: file_checksum
+# sha256 of the file at path (hex)
+def file_checksum(path):
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHECKSUM_CHUNK)
+            if len(chunk) == 0:
+                break
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+# Function: create_snapshot
+# Back up every shard of shard_map into a new snapshot
+# The files are written to a temporary directory, renamed when complete
+# Output: the name of the snapshot
+def create_snapshot(shard_map, backup_dir = BACKUP_DIR, pages = BACKUP_STEP_PAGES, sleep = BACKUP_STEP_SLEEP):
+    os.makedirs(backup_dir, exist_ok = True)
+    name = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+    suffix = 1
+    while os.path.exists(os.path.join(backup_dir, name)):
+        name = "{}-{}".format(name.split('-')[0], suffix)
+        suffix += 1
+    temp_dir = os.path.join(backup_dir, "{}.{}.tmp".format(name, os.getpid()))
+    os.mkdir(temp_dir)
+    manifest = {'created': int(time.time()), 'generation': shard_map.generation, 'files': []}
+    for shard, path in enumerate(shard_map.paths):
+        file_name = "shard{}.db".format(shard)
+        started = time.time()
+        backup_file(path, os.path.join(temp_dir, file_name), pages, sleep)
+        manifest['files'].append({'file': file_name, 'path': path, 'size': os.path.getsize(os.path.join(temp_dir, file_name)),
+                                  'sha256': file_checksum(os.path.join(temp_dir, file_name)),
+                                  'seconds': round(time.time() - started, 3)})
+    with open(os.path.join(temp_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent = 2)
+    os.rename(temp_dir, os.path.join(backup_dir, name))
+    return name
+
+
+# Function: list_snapshots
+# Names of the complete snapshots, oldest first
+def list_snapshots(backup_dir = BACKUP_DIR):
+    if not os.path.isdir(backup_dir):
+        return []
+    return sorted(name for name in os.listdir(backup_dir)
+                  if not name.endswith('.tmp') and os.path.exists(os.path.join(backup_dir, name, MANIFEST_NAME)))
+
+
+# Function: load_manifest
+# Manifest of snapshot name (default: the latest)
+# Output: (snapshot directory, manifest dict)
+def load_manifest(name = None, backup_dir = BACKUP_DIR):
+    if name == None:
+        names = list_snapshots(backup_dir)
+        if len(names) == 0:
+            raise ValueError("no snapshot in {}".format(backup_dir))
+        name = names[-1]
+    snapshot_dir = os.path.join(backup_dir, name)
+    if not os.path.exists(os.path.join(snapshot_dir, MANIFEST_NAME)):
+        raise ValueError("{} is not a snapshot".format(snapshot_dir))
+    with open(os.path.join(snapshot_dir, MANIFEST_NAME)) as f:
+        return snapshot_dir, json.load(f)
+
+
+# Function: rotate_snapshots
+# Delete all but the keep latest snapshots, and old unfinished ones
+# Output: names of the deleted snapshots
+def rotate_snapshots(keep = BACKUP_KEEP, backup_dir = BACKUP_DIR):
+    names = list_snapshots(backup_dir)
+    deleted = names[:max(len(names) - keep, 0)]
+    for name in deleted:
+        shutil.rmtree(os.path.join(backup_dir, name))
+    for name in os.listdir(backup_dir) if os.path.isdir(backup_dir) else []:
+        path = os.path.join(backup_dir, name)
+        if name.endswith('.tmp') and time.time() - os.path.getmtime(path) > TEMP_MAX_AGE:
+            shutil.rmtree(path)
+    return deleted
+
+
+# Function: connect_snapshot_file
+# Read-only connection to a snapshot file (immutable: no locks, never written)
+def connect_snapshot_file(path):
+    conn = sqlite3.connect("file:{}?mode=ro&immutable=1".format(os.path.abspath(path)), uri = True)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+# Function: verify_snapshot
+# Compare the files of a snapshot with their checksums and check them
+# Output: list of problems (empty if the snapshot is good)
+def verify_snapshot(name = None, backup_dir = BACKUP_DIR):
+    snapshot_dir, manifest = load_manifest(name, backup_dir)
+    problems = []
+    for item in manifest['files']:
+        path = os.path.join(snapshot_dir, item['file'])
+        if not os.path.exists(path):
+            problems.append("{}: missing".format(item['file']))
+            continue
+        if file_checksum(path) != item['sha256']:
+            problems.append("{}: checksum mismatch".format(item['file']))
+            continue
+        conn = connect_snapshot_file(path)
+        try:
+            result = conn.execute("PRAGMA quick_check").fetchone()[0]
+        finally:
+            conn.close()
+        if result != 'ok':
+            problems.append("{}: {}".format(item['file'], result))
+    return problems
+
+
+# Function: open_snapshot
+# Read-only connections to the shards of a snapshot (default: the latest),
+# for analytics: rows are on the shard of the map (generation, paths) they
+# were backed up from, so conns[ShardMap.shard_for_zid(zid)] holds zid
+# Output: list of connections, in shard order
+def open_snapshot(name = None, backup_dir = BACKUP_DIR):
+    snapshot_dir, manifest = load_manifest(name, backup_dir)
+    return [connect_snapshot_file(os.path.join(snapshot_dir, item['file'])) for item in manifest['files']]
+
+
+# Function: restore_snapshot
+# Copy a verified snapshot over the database files it was taken from and
+# switch the shard map back to them. Stop the app first.
+# Input: config_path / default_path: the shard map file and the default database
+# Output: paths of the restored files
+def restore_snapshot(name, config_path, default_path, backup_dir = BACKUP_DIR):
+    problems = verify_snapshot(name, backup_dir)
+    if len(problems) > 0:
+        raise ValueError("snapshot {} is damaged: {}".format(name, ", ".join(problems)))
+    snapshot_dir, manifest = load_manifest(name, backup_dir)
+    paths = []
+    for item in manifest['files']:
+        source = connect_snapshot_file(os.path.join(snapshot_dir, item['file']))
+        target = sqlite3.connect(item['path'], isolation_level = None)
+        try:
+            source.backup(target)
+            target.execute("PRAGMA journal_mode = WAL").fetchone()
+        finally:
+            target.close()
+            source.close()
+        paths.append(item['path'])
+    if paths == [default_path] and manifest['generation'] == 0:
+        if os.path.exists(config_path):
+            os.remove(config_path)
+    else:
+        ShardMap(paths, manifest['generation']).save(config_path)
+    return paths
+
+
+# Function: format_size
+def format_size(size):
+    return "{:.1f} MB".format(size / 1024 / 1024)
+
+
+# Main : run a backup command
+if __name__ == "__main__":
+    # relative paths (db/) are resolved from here
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, os.getcwd())
+    import UNSWtalk
+
+    parser = argparse.ArgumentParser(description = "Online backups of the UNSWtalk database")
+    commands = parser.add_subparsers(dest = 'command')
+    backup_parser = commands.add_parser('backup', help = "take a new snapshot while the app runs")
+    backup_parser.add_argument('--keep', type = int, default = BACKUP_KEEP, help = "number of snapshots kept")
+    backup_parser.add_argument('--pages', type = int, default = BACKUP_STEP_PAGES, help = "pages copied per step")
+    commands.add_parser('list', help = "list the snapshots")
+    verify_parser = commands.add_parser('verify', help = "check the checksums of a snapshot")
+    verify_parser.add_argument('name', nargs = '?')
+    restore_parser = commands.add_parser('restore', help = "replace the database by a snapshot (stop the app first)")
+    restore_parser.add_argument('name')
+    path_parser = commands.add_parser('path', help = "files of a snapshot")
+    path_parser.add_argument('name', nargs = '?')
+    args = parser.parse_args()
+    if args.command == None:
+        parser.print_help()
+        sys.exit(1)
+
+    try:
+        if args.command == 'backup':
+            UNSWtalk.upgrade_db()
+            name = create_snapshot(UNSWtalk.SHARD_MAP, pages = args.pages)
+            snapshot_dir, manifest = load_manifest(name)
+            for item in manifest['files']:
+                print("{} -> {}/{}: {} in {:.3f}s".format(item['path'], snapshot_dir, item['file'], format_size(item['size']), item['seconds']))
+            for deleted in rotate_snapshots(args.keep):
+                print("{} deleted".format(deleted))
+        elif args.command == 'list':
+            for name in list_snapshots():
+                snapshot_dir, manifest = load_manifest(name)
+                print("{}  generation {}  {} shard(s)  {}".format(name, manifest['generation'], len(manifest['files']),
+                                                                  format_size(sum(item['size'] for item in manifest['files']))))
+        elif args.command == 'verify':
+            problems = verify_snapshot(args.name)
+            for problem in problems:
+                print(problem)
+            if len(problems) > 0:
+                sys.exit(1)
+            print("ok")
+        elif args.command == 'restore':
+            for path in restore_snapshot(args.name, UNSWtalk.SHARD_CONFIG_PATH, UNSWtalk.DATABASE_PATH):
+                print("{} restored".format(path))
+            # derived from the old data
+            if os.path.exists(UNSWtalk.GRAPH_SNAPSHOT_PATH):
+                os.remove(UNSWtalk.GRAPH_SNAPSHOT_PATH)
+        elif args.command == 'path':
+            snapshot_dir, manifest = load_manifest(args.name)
+            for item in manifest['files']:
+                print(os.path.join(snapshot_dir, item['file']))
+    except ValueError as error:
+        sys.exit(str(error))
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Benchmark the social graph on large synthetic friendship graphs
+# How to run: ./bench_social_graph.py --students 200000 --friends 50
+#
+# Each student gets ~friends friendships (both directions, as in FRIENDS),
+# most of them inside a "cohort" of nearby zids and a few random ones, which
+# gives the short paths of a real social network.
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from social_graph import SocialGraph, SearchTimeout
+
+
+# Function: synthetic_edges
+# Yield (zid, friend_zid) rows for n students
+def synthetic_edges(n, friends, seed):
+    rng = random.Random(seed)
+    cohort = 500
+    for i in range(n):
+        for _ in range(friends // 2):
+            if rng.random() < 0.9:
+                j = min(n - 1, max(0, i + rng.randint(-cohort, cohort)))
+            else:
+                j = rng.randrange(n)
+            if j != i:
+                yield ('z%07d' % i, 'z%07d' % j)
+                yield ('z%07d' % j, 'z%07d' % i)
+
+
+# Function: timed
+# Mean seconds per call and the results of calling function(*args) for all args
+def timed(function, all_args):
+    results = []
+    start = time.perf_counter()
+    for args in all_args:
+        results.append(function(*args))
+    return (time.perf_counter() - start) / len(all_args), results
+
+
+# Function: percentile
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+# Main : run the benchmark
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Social graph benchmark")
+    parser.add_argument('--students', type = int, default = 200000)
+    parser.add_argument('--friends', type = int, default = 50)
+    parser.add_argument('--queries', type = int, default = 1000)
+    parser.add_argument('--max-depth', type = int, default = 4)
+    parser.add_argument('--budget', type = float, default = 0.02, help = "time budget per path query (seconds)")
+    parser.add_argument('--seed', type = int, default = 2041)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    graph = SocialGraph.from_edges(synthetic_edges(args.students, args.friends, args.seed))
+    print("build: {} students, {} rows in {:.1f}s, {:.1f} MB of arrays".format(
+        len(graph.zids), len(graph.neighbours), time.perf_counter() - start, graph.memory_bytes() / 2 ** 20))
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        snapshot_path = os.path.join(temp_dir, 'graph.bin')
+        start = time.perf_counter()
+        graph.save_snapshot(snapshot_path)
+        save_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        graph = SocialGraph.load_snapshot(snapshot_path)
+        print("snapshot: save {:.2f}s, load (mmap) {:.3f}s".format(save_seconds, time.perf_counter() - start))
+
+        rng = random.Random(args.seed + 1)
+        pairs = [(rng.choice(graph.zids), rng.choice(graph.zids)) for _ in range(args.queries)]
+
+        seconds, _ = timed(graph.friends, [(a,) for a, b in pairs])
+        print("friends: {:.1f} us".format(seconds * 1e6))
+        seconds, _ = timed(graph.mutual_count, pairs)
+        print("mutual_count: {:.1f} us".format(seconds * 1e6))
+
+        latencies = []
+        found = timeouts = 0
+        for a, b in pairs:
+            start = time.perf_counter()
+            try:
+                path = graph.shortest_path(a, b, max_depth = args.max_depth, deadline = time.monotonic() + args.budget)
+            except SearchTimeout:
+                path = None
+                timeouts += 1
+            latencies.append(time.perf_counter() - start)
+            if path != None:
+                found += 1
+        print("shortest_path (depth <= {}): found {}/{}, timeouts {}, p50 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms".format(
+            args.max_depth, found, len(pairs), timeouts,
+            percentile(latencies, 0.5) * 1e3, percentile(latencies, 0.99) * 1e3, max(latencies) * 1e3))
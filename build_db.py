@@ -2,14 +2,19 @@
 # encoding: utf-8
 
 # Build database from dataset
-# How to run: ./build_db.py
+# How to run: ./build_db.py [--shards N]
+#       --shards N : split the data over N database files (see shards.py)
 
 import os
 import re
 import sys
+import argparse
 import sqlite3
 from collections import defaultdict
+from datetime import datetime, timezone
 import shutil
+from ranking import rescore_posts
+from shards import ShardMap, seed_sequences
 
 
 dataset = "dataset-medium"
@@ -47,6 +52,54 @@ def get_item_dict(file_path):
     return item_dict
 
 
+# Function: parse_time
+# 2016-05-13T04:35:53+0000 --> 1463114153 (UTC epoch seconds)
+# Times without an offset are taken as UTC, unknown values give None
+def parse_time(value):
+    if isinstance(value, int):
+        return value
+    value = str(value).strip()
+    for time_format in ("%Y-%m-%dT%H:%M:%S%z", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S"):
+        try:
+            parsed = datetime.strptime(value, time_format)
+        except ValueError:
+            continue
+        if parsed.tzinfo == None:
+            parsed = parsed.replace(tzinfo = timezone.utc)
+        return int(parsed.timestamp())
+    return None
+
+
+# Function: find_mentions
+# zids mentioned in a message (z + 7 digits)
+def find_mentions(message):
+    return set(re.findall(r'z[0-9]{7}', str(message)))
+
+
+# Function: backfill_mentions
+# Rebuild table MENTION from all posts / comments / replies
+# Only existing students are recorded, mentioning yourself is not a mention
+# students: all zids when conn is one shard of several (default: those of conn)
+def backfill_mentions(conn, students = None):
+    if students == None:
+        students = set(row[0] for row in conn.execute("SELECT zid FROM STUDENT UNION SELECT zid FROM TO_BE_SUSPENDED"))
+    messages_sql = """
+        SELECT zid, id, NULL, NULL, time, message FROM POST WHERE message LIKE '%z%'
+        UNION ALL
+        SELECT zid, post_id, id, NULL, time, message FROM COMMENT WHERE message LIKE '%z%'
+        UNION ALL
+        SELECT R.zid, C.post_id, R.comment_id, R.id, R.time, R.message FROM REPLY R JOIN COMMENT C ON C.id = R.comment_id WHERE R.message LIKE '%z%'
+    """
+    to_be_insert = []
+    for author, post_id, comment_id, reply_id, time, message in conn.execute(messages_sql):
+        for zid in find_mentions(message):
+            if zid in students and zid != author:
+                to_be_insert.append((zid, author, post_id, comment_id, reply_id, time))
+    conn.execute("DELETE FROM MENTION")
+    conn.executemany("INSERT INTO MENTION (zid, author, post_id, comment_id, reply_id, time) VALUES (?, ?, ?, ?, ?, ?)", to_be_insert)
+    return len(to_be_insert)
+
+
 # Function: check_dir
 # check whether a dir is exist, otherwise create it
 def check_dir(dir):
@@ -118,12 +171,28 @@ def get_replies(dataset, zid, comment):
 
 # Main : generate database
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Build the database from db/" + dataset)
+    parser.add_argument('--shards', type = int, default = 1, help = "number of database files")
+    args = parser.parse_args()
 
     # Build tables
     dataset_path = "db/" + dataset
-    db_filename = dataset + ".db"
-    db_path = "db/" + db_filename
-    os.system("sqlite3 db/{} < db/db_schema.sql".format(db_filename))
+    db_path = "db/" + dataset + ".db"
+    config_path = "db/" + dataset + ".shards.json"
+    if args.shards == 1:
+        shard_map = ShardMap([db_path])
+        if os.path.exists(config_path):
+            os.remove(config_path)
+    else:
+        shard_map = ShardMap(["db/{}.shard{}.db".format(dataset, shard) for shard in range(args.shards)])
+    for shard, path in enumerate(shard_map.paths):
+        os.system("sqlite3 {} < db/db_schema.sql".format(path))
+        os.system("sqlite3 {} < db/db_upgrade.sql".format(path))
+        with sqlite3.connect(path) as conn:
+            seed_sequences(conn, shard_map.first_id(shard))
+    # derived files of the old database
+    if os.path.exists("db/social_graph.bin"):
+        os.remove("db/social_graph.bin")
     
     # Get all students' profile
     student_zids = [f for f in os.listdir(dataset_path)]
@@ -131,68 +200,85 @@ if __name__ == "__main__":
     for student_zid in student_zids:
         student_dicts.append(get_student_dict(dataset, student_zid))
 
+    # Every row goes to the shard of its zid (posts: their author, comments
+    # and replies: their post)
+    conns = [sqlite3.connect(path) for path in shard_map.paths]
+    def get_cursor(zid):
+        return conns[shard_map.shard_for_zid(zid)].cursor()
+
     # Insert profiles into table STUDENT
-    with sqlite3.connect(db_path) as conn:
-        cur = conn.cursor()
-        to_be_insert = []
-        for student_dict in student_dicts:
-            to_be_insert.append((student_dict['zid'], student_dict['email'], student_dict['password'],
-                                student_dict['full_name'], student_dict['birthday'], student_dict['profile_img'],
-                                student_dict['program'], student_dict['home_suburb'], student_dict['home_longitude'], 
-                                student_dict['home_latitude'], student_dict['profile_text']))
-        insert_sql = "INSERT INTO STUDENT VALUES (?,?,?,?,?,?,?,?,?,?,?)"
-        result = cur.executemany(insert_sql, to_be_insert)
+    insert_sql = "INSERT INTO STUDENT (zid, email, password, full_name, birthday, profile_img, program, home_suburb, home_longitude, home_latitude, profile_text) VALUES (?,?,?,?,?,?,?,?,?,?,?)"
+    for student_dict in student_dicts:
+        get_cursor(student_dict['zid']).execute(insert_sql, (student_dict['zid'], student_dict['email'], student_dict['password'],
+                            student_dict['full_name'], student_dict['birthday'], student_dict['profile_img'],
+                            student_dict['program'], student_dict['home_suburb'], student_dict['home_longitude'], 
+                            student_dict['home_latitude'], student_dict['profile_text']))
 
     # Insert friends into FRIENDS
-    with sqlite3.connect(db_path) as conn:
-        cur = conn.cursor()
-        for student_dict in student_dicts:
-            for friend in student_dict['friends']:
-                # remove same pairs
-                cur.execute('DELETE FROM FRIENDS WHERE zid=? and friend_zid=?',[friend, student_dict['zid']])
-                cur.execute('DELETE FROM FRIENDS WHERE zid=? and friend_zid=?',[student_dict['zid'], friend])
-                # friendship between each other
-                insert_friend_sql = "INSERT INTO FRIENDS(zid, friend_zid) VALUES (?, ?)"
-                cur.executemany(insert_friend_sql, [(student_dict['zid'], friend)])
-                insert_friend_sql = "INSERT INTO FRIENDS(zid, friend_zid) VALUES (?, ?)"
-                cur.executemany(insert_friend_sql, [(friend, student_dict['zid'])])
+    for student_dict in student_dicts:
+        for friend in student_dict['friends']:
+            # remove same pairs
+            get_cursor(friend).execute('DELETE FROM FRIENDS WHERE zid=? and friend_zid=?',[friend, student_dict['zid']])
+            get_cursor(student_dict['zid']).execute('DELETE FROM FRIENDS WHERE zid=? and friend_zid=?',[student_dict['zid'], friend])
+            # friendship between each other
+            insert_friend_sql = "INSERT INTO FRIENDS(zid, friend_zid) VALUES (?, ?)"
+            get_cursor(student_dict['zid']).execute(insert_friend_sql, (student_dict['zid'], friend))
+            get_cursor(friend).execute(insert_friend_sql, (friend, student_dict['zid']))
 
     # Insert courses into COURSES
-    with sqlite3.connect(db_path) as conn:
-        cur = conn.cursor()
-        for student_dict in student_dicts:
-            for course in student_dict['courses']:
-                insert_course_sql = "INSERT INTO COURSES(zid, course) VALUES (?, ?)"
-                cur.executemany(insert_course_sql, [(student_dict['zid'], course)])
-
-    # Insert POST / COMMENT / REPLY  
-    with sqlite3.connect(db_path) as conn:
-        cur = conn.cursor()
-        post_id, comment_id, reply_id = 0, 0, 0
-        for student_zid in student_zids:
-            # Posts
-            for post in get_posts(dataset, student_zid):
-                post_dir = "db/{}/{}/{}".format(dataset, student_zid, post)
-                post_dict = get_item_dict(post_dir)
-                insert_post_sql = "INSERT INTO POST(id, zid, time, longitude, latitude, message) VALUES (?, ?, ?, ?, ?, ?)"
-                post_id += 1
-                cur.execute(insert_post_sql, [post_id, post_dict["from"], post_dict["time"], post_dict["longitude"], post_dict["latitude"], post_dict["message"]])
-                # Comments
-                for comment in get_comments(dataset, student_zid, post):
-                    comment_dir = "db/{}/{}/{}".format(dataset, student_zid, comment)
-                    comment_dict = get_item_dict(comment_dir)
-                    insert_comment_sql = "INSERT INTO COMMENT(id, post_id, zid, time, message) VALUES (?, ?, ?, ?, ?)"
-                    comment_id += 1
-                    cur.execute(insert_comment_sql, [comment_id, post_id, comment_dict['from'], comment_dict['time'], comment_dict['message']])
-                    # Replies
-                    for reply in get_replies(dataset, student_zid, comment):
-                        reply_dir = "db/{}/{}/{}".format(dataset, student_zid, reply)
-                        reply_dict = get_item_dict(reply_dir)
-                        insert_reply_sql = "INSERT INTO REPLY(id, comment_id, zid, time, message) VALUES (?, ?, ?, ?, ?)"
-                        reply_id += 1
-                        cur.execute(insert_reply_sql, [reply_id, comment_id, reply_dict['from'], reply_dict['time'], reply_dict['message']])
+    for student_dict in student_dicts:
+        for course in student_dict['courses']:
+            insert_course_sql = "INSERT INTO COURSES(zid, course) VALUES (?, ?)"
+            get_cursor(student_dict['zid']).execute(insert_course_sql, (student_dict['zid'], course))
+
+    # Insert POST / COMMENT / REPLY, ids are counted per shard from its range
+    post_ids = [shard_map.first_id(shard) for shard in range(shard_map.count)]
+    comment_ids = list(post_ids)
+    reply_ids = list(post_ids)
+    for student_zid in student_zids:
+        # Posts
+        for post in get_posts(dataset, student_zid):
+            post_dir = "db/{}/{}/{}".format(dataset, student_zid, post)
+            post_dict = get_item_dict(post_dir)
+            shard = shard_map.shard_for_zid(post_dict["from"])
+            cur = conns[shard].cursor()
+            insert_post_sql = "INSERT INTO POST(id, zid, time, longitude, latitude, message) VALUES (?, ?, ?, ?, ?, ?)"
+            post_ids[shard] += 1
+            post_id = post_ids[shard]
+            cur.execute(insert_post_sql, [post_id, post_dict["from"], parse_time(post_dict["time"]), post_dict["longitude"], post_dict["latitude"], post_dict["message"]])
+            # Comments
+            for comment in get_comments(dataset, student_zid, post):
+                comment_dir = "db/{}/{}/{}".format(dataset, student_zid, comment)
+                comment_dict = get_item_dict(comment_dir)
+                insert_comment_sql = "INSERT INTO COMMENT(id, post_id, zid, time, message) VALUES (?, ?, ?, ?, ?)"
+                comment_ids[shard] += 1
+                comment_id = comment_ids[shard]
+                cur.execute(insert_comment_sql, [comment_id, post_id, comment_dict['from'], parse_time(comment_dict['time']), comment_dict['message']])
+                # Replies
+                for reply in get_replies(dataset, student_zid, comment):
+                    reply_dir = "db/{}/{}/{}".format(dataset, student_zid, reply)
+                    reply_dict = get_item_dict(reply_dir)
+                    insert_reply_sql = "INSERT INTO REPLY(id, comment_id, zid, time, message) VALUES (?, ?, ?, ?, ?)"
+                    reply_ids[shard] += 1
+                    cur.execute(insert_reply_sql, [reply_ids[shard], comment_id, reply_dict['from'], parse_time(reply_dict['time']), reply_dict['message']])
+    for conn in conns:
+        conn.commit()
+
+    # Index mentions (of the students of every shard)
+    students = set(student_dict['zid'] for student_dict in student_dicts)
+    for conn in conns:
+        backfill_mentions(conn, students)
+
+    # Scores of the "top" feed
+    for conn in conns:
+        rescore_posts(conn)
+
+    # The import itself does not need to invalidate anything
+    for conn in conns:
+        conn.execute("DELETE FROM CHANGE_LOG")
+        conn.commit()
+        conn.close()
+    if shard_map.count > 1:
+        shard_map.save(config_path)
 
     print("Finished!")
-
-
-
@@ -1,5 +1,26 @@
 -- Database schema
 
+-- free pages are given back by the incremental_vacuum maintenance job
+-- (only effective in a new, empty database file)
+PRAGMA auto_vacuum = INCREMENTAL;
+-- a rebuilt database is checked again by upgrade_db (UNSWtalk.py)
+PRAGMA user_version = 0;
+
+
+-- Tables of db_upgrade.sql, derived from the tables below or written by
+-- the app: dropped too, so rebuilding a database file starts from empty
+-- ones (db_upgrade.sql creates them again and backfills the derived ones)
+DROP TABLE IF EXISTS CHANGE_LOG;
+DROP TABLE IF EXISTS POST_GEO;
+DROP TABLE IF EXISTS STUDENT_GEO;
+DROP TABLE IF EXISTS ACCOUNT_PURGE;
+DROP TABLE IF EXISTS MENTION;
+DROP TABLE IF EXISTS NOTIFICATION;
+DROP TABLE IF EXISTS COURSE_MEMBER;
+DROP TABLE IF EXISTS MAINTENANCE_JOB;
+DROP TABLE IF EXISTS MAINTENANCE_LOG;
+DROP TABLE IF EXISTS FRIEND_SUGGESTION;
+
 
 -- Table : STUDENT
 DROP TABLE IF EXISTS STUDENT;
@@ -14,7 +35,9 @@ CREATE TABLE STUDENT (
   home_suburb    TEXT,
   home_longitude TEXT,
   home_latitude  TEXT,
-  profile_text   TEXT
+  profile_text   TEXT,
+  post_count     INTEGER          NOT NULL DEFAULT 0,
+  friend_count   INTEGER          NOT NULL DEFAULT 0
 );
 
 
@@ -32,7 +55,8 @@ CREATE TABLE TO_BE_CONFIRMED(
   home_longitude TEXT,
   home_latitude  TEXT,
   profile_text   TEXT,
-  confirmation_code TEXT          NOT NULL
+  confirmation_code TEXT          NOT NULL,
+  created        INTEGER          NOT NULL DEFAULT 0
 );
 
 
@@ -49,7 +73,9 @@ CREATE TABLE TO_BE_SUSPENDED (
   home_suburb    TEXT,
   home_longitude TEXT,
   home_latitude  TEXT,
-  profile_text   TEXT
+  profile_text   TEXT,
+  post_count     INTEGER          NOT NULL DEFAULT 0,
+  friend_count   INTEGER          NOT NULL DEFAULT 0
 );
 
 
@@ -70,14 +96,18 @@ CREATE TABLE COURSES (
 );
 
 -- Table : POST
+-- time: UTC epoch seconds (also for COMMENT / REPLY)
 DROP TABLE IF EXISTS POST;
 CREATE TABLE POST (
   id        INTEGER PRIMARY KEY AUTOINCREMENT,
   zid       TEXT REFERENCES STUDENT (zid),
-  time      TEXT,
+  time      INTEGER,
   longitude TEXT,
   latitude  TEXT,
-  message   TEXT
+  message   TEXT,
+  comment_count INTEGER NOT NULL DEFAULT 0,
+  reply_count   INTEGER NOT NULL DEFAULT 0,
+  score         REAL    NOT NULL DEFAULT 0
 );
 
 -- Table : COMMENT
@@ -86,7 +116,7 @@ CREATE TABLE COMMENT (
   id      INTEGER PRIMARY KEY AUTOINCREMENT,
   post_id INTEGER REFERENCES POST (id),
   zid     TEXT REFERENCES STUDENT (zid),
-  time    TEXT,
+  time    INTEGER,
   message TEXT
 );
 
@@ -96,7 +126,7 @@ CREATE TABLE REPLY (
   id         INTEGER PRIMARY KEY AUTOINCREMENT,
   comment_id INTEGER REFERENCES COMMENT (id),
   zid        TEXT REFERENCES STUDENT (zid),
-  time       TEXT,
+  time       INTEGER,
   message    TEXT
 );
 
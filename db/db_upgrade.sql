@@ -0,0 +1,306 @@
+-- Schema upgrades, applied on top of db_schema.sql
+-- Every statement is idempotent: this file is run by build_db.py and
+-- again by the app at startup (upgrade_db) to migrate existing databases
+
+
+-- Table : CHANGE_LOG: every write to a cached table is recorded here by the
+-- triggers below, so that each worker process can evict stale cache entries
+--   tbl : table name, op : I(nsert) / U(pdate) / D(elete)
+--   zid : owner of the row, ref : related key (friend_zid, post id, ...)
+CREATE TABLE IF NOT EXISTS CHANGE_LOG (
+  id   INTEGER PRIMARY KEY AUTOINCREMENT,
+  tbl  TEXT NOT NULL,
+  op   TEXT NOT NULL,
+  zid  TEXT,
+  ref  TEXT
+);
+
+-- STUDENT
+CREATE TRIGGER IF NOT EXISTS STUDENT_log_insert AFTER INSERT ON STUDENT BEGIN
+  INSERT INTO CHANGE_LOG (tbl, op, zid, ref) VALUES ('STUDENT', 'I', NEW.zid, NULL);
+END;
+CREATE TRIGGER IF NOT EXISTS STUDENT_log_update AFTER UPDATE ON STUDENT BEGIN
+  INSERT INTO CHANGE_LOG (tbl, op, zid, ref) VALUES ('STUDENT', 'U', NEW.zid, NULL);
+END;
+CREATE TRIGGER IF NOT EXISTS STUDENT_log_delete AFTER DELETE ON STUDENT BEGIN
+  INSERT INTO CHANGE_LOG (tbl, op, zid, ref) VALUES ('STUDENT', 'D', OLD.zid, NULL);
+END;
+
+-- TO_BE_SUSPENDED
+CREATE TRIGGER IF NOT EXISTS TO_BE_SUSPENDED_log_insert AFTER INSERT ON TO_BE_SUSPENDED BEGIN
+  INSERT INTO CHANGE_LOG (tbl, op, zid, ref) VALUES ('TO_BE_SUSPENDED', 'I', NEW.zid, NULL);
+END;
+CREATE TRIGGER IF NOT EXISTS TO_BE_SUSPENDED_log_update AFTER UPDATE ON TO_BE_SUSPENDED BEGIN
+  INSERT INTO CHANGE_LOG (tbl, op, zid, ref) VALUES ('TO_BE_SUSPENDED', 'U', NEW.zid, NULL);
+END;
+CREATE TRIGGER IF NOT EXISTS TO_BE_SUSPENDED_log_delete AFTER DELETE ON TO_BE_SUSPENDED BEGIN
+  INSERT INTO CHANGE_LOG (tbl, op, zid, ref) VALUES ('TO_BE_SUSPENDED', 'D', OLD.zid, NULL);
+END;
+
+-- FRIENDS
+CREATE TRIGGER IF NOT EXISTS FRIENDS_log_insert AFTER INSERT ON FRIENDS BEGIN
+  INSERT INTO CHANGE_LOG (tbl, op, zid, ref) VALUES ('FRIENDS', 'I', NEW.zid, NEW.friend_zid);
+END;
+CREATE TRIGGER IF NOT EXISTS FRIENDS_log_update AFTER UPDATE ON FRIENDS BEGIN
+  INSERT INTO CHANGE_LOG (tbl, op, zid, ref) VALUES ('FRIENDS', 'U', NEW.zid, NEW.friend_zid);
+END;
+CREATE TRIGGER IF NOT EXISTS FRIENDS_log_delete AFTER DELETE ON FRIENDS BEGIN
+  INSERT INTO CHANGE_LOG (tbl, op, zid, ref) VALUES ('FRIENDS', 'D', OLD.zid, OLD.friend_zid);
+END;
+
+-- POST
+CREATE TRIGGER IF NOT EXISTS POST_log_insert AFTER INSERT ON POST BEGIN
+  INSERT INTO CHANGE_LOG (tbl, op, zid, ref) VALUES ('POST', 'I', NEW.zid, NEW.id);
+END;
+CREATE TRIGGER IF NOT EXISTS POST_log_update AFTER UPDATE ON POST BEGIN
+  INSERT INTO CHANGE_LOG (tbl, op, zid, ref) VALUES ('POST', 'U', NEW.zid, NEW.id);
+END;
+CREATE TRIGGER IF NOT EXISTS POST_log_delete AFTER DELETE ON POST BEGIN
+  INSERT INTO CHANGE_LOG (tbl, op, zid, ref) VALUES ('POST', 'D', OLD.zid, OLD.id);
+END;
+
+-- COMMENT
+CREATE TRIGGER IF NOT EXISTS COMMENT_log_insert AFTER INSERT ON COMMENT BEGIN
+  INSERT INTO CHANGE_LOG (tbl, op, zid, ref) VALUES ('COMMENT', 'I', NEW.zid, NEW.post_id);
+END;
+CREATE TRIGGER IF NOT EXISTS COMMENT_log_update AFTER UPDATE ON COMMENT BEGIN
+  INSERT INTO CHANGE_LOG (tbl, op, zid, ref) VALUES ('COMMENT', 'U', NEW.zid, NEW.post_id);
+END;
+CREATE TRIGGER IF NOT EXISTS COMMENT_log_delete AFTER DELETE ON COMMENT BEGIN
+  INSERT INTO CHANGE_LOG (tbl, op, zid, ref) VALUES ('COMMENT', 'D', OLD.zid, OLD.post_id);
+END;
+
+-- REPLY
+CREATE TRIGGER IF NOT EXISTS REPLY_log_insert AFTER INSERT ON REPLY BEGIN
+  INSERT INTO CHANGE_LOG (tbl, op, zid, ref) VALUES ('REPLY', 'I', NEW.zid, NEW.comment_id);
+END;
+CREATE TRIGGER IF NOT EXISTS REPLY_log_update AFTER UPDATE ON REPLY BEGIN
+  INSERT INTO CHANGE_LOG (tbl, op, zid, ref) VALUES ('REPLY', 'U', NEW.zid, NEW.comment_id);
+END;
+CREATE TRIGGER IF NOT EXISTS REPLY_log_delete AFTER DELETE ON REPLY BEGIN
+  INSERT INTO CHANGE_LOG (tbl, op, zid, ref) VALUES ('REPLY', 'D', OLD.zid, OLD.comment_id);
+END;
+
+-- Table : POST_GEO / STUDENT_GEO: R*Tree spatial indexes for "nearby" queries
+-- POST_GEO.id is POST.id, STUDENT_GEO.id is the number part of the zid (z5190009 -> 5190009)
+-- Suspended students are not in STUDENT, so they are not in STUDENT_GEO
+-- Rows without valid coordinates ('', 'null') are not indexed
+CREATE VIRTUAL TABLE IF NOT EXISTS POST_GEO USING rtree(id, min_lon, max_lon, min_lat, max_lat);
+CREATE VIRTUAL TABLE IF NOT EXISTS STUDENT_GEO USING rtree(id, min_lon, max_lon, min_lat, max_lat);
+
+CREATE TRIGGER IF NOT EXISTS POST_geo_insert AFTER INSERT ON POST
+WHEN NEW.longitude GLOB '*[0-9]*' AND NEW.longitude NOT GLOB '*[^0-9.+-]*'
+ AND NEW.latitude GLOB '*[0-9]*' AND NEW.latitude NOT GLOB '*[^0-9.+-]*' BEGIN
+  INSERT OR REPLACE INTO POST_GEO VALUES (NEW.id, NEW.longitude, NEW.longitude, NEW.latitude, NEW.latitude);
+END;
+CREATE TRIGGER IF NOT EXISTS POST_geo_delete AFTER DELETE ON POST BEGIN
+  DELETE FROM POST_GEO WHERE id = OLD.id;
+END;
+CREATE TRIGGER IF NOT EXISTS POST_geo_update AFTER UPDATE OF longitude, latitude ON POST BEGIN
+  DELETE FROM POST_GEO WHERE id = OLD.id;
+  INSERT INTO POST_GEO SELECT NEW.id, NEW.longitude, NEW.longitude, NEW.latitude, NEW.latitude
+  WHERE NEW.longitude GLOB '*[0-9]*' AND NEW.longitude NOT GLOB '*[^0-9.+-]*'
+    AND NEW.latitude GLOB '*[0-9]*' AND NEW.latitude NOT GLOB '*[^0-9.+-]*';
+END;
+
+CREATE TRIGGER IF NOT EXISTS STUDENT_geo_insert AFTER INSERT ON STUDENT
+WHEN NEW.home_longitude GLOB '*[0-9]*' AND NEW.home_longitude NOT GLOB '*[^0-9.+-]*'
+ AND NEW.home_latitude GLOB '*[0-9]*' AND NEW.home_latitude NOT GLOB '*[^0-9.+-]*' BEGIN
+  INSERT OR REPLACE INTO STUDENT_GEO VALUES (CAST(substr(NEW.zid, 2) AS INTEGER), NEW.home_longitude, NEW.home_longitude, NEW.home_latitude, NEW.home_latitude);
+END;
+CREATE TRIGGER IF NOT EXISTS STUDENT_geo_delete AFTER DELETE ON STUDENT BEGIN
+  DELETE FROM STUDENT_GEO WHERE id = CAST(substr(OLD.zid, 2) AS INTEGER);
+END;
+CREATE TRIGGER IF NOT EXISTS STUDENT_geo_update AFTER UPDATE OF home_longitude, home_latitude ON STUDENT BEGIN
+  DELETE FROM STUDENT_GEO WHERE id = CAST(substr(OLD.zid, 2) AS INTEGER);
+  INSERT INTO STUDENT_GEO SELECT CAST(substr(NEW.zid, 2) AS INTEGER), NEW.home_longitude, NEW.home_longitude, NEW.home_latitude, NEW.home_latitude
+  WHERE NEW.home_longitude GLOB '*[0-9]*' AND NEW.home_longitude NOT GLOB '*[^0-9.+-]*'
+    AND NEW.home_latitude GLOB '*[0-9]*' AND NEW.home_latitude NOT GLOB '*[^0-9.+-]*';
+END;
+
+-- Backfill databases built before the spatial indexes existed (only when empty)
+INSERT INTO POST_GEO
+  SELECT id, longitude, longitude, latitude, latitude FROM POST
+  WHERE NOT EXISTS (SELECT 1 FROM POST_GEO)
+    AND longitude GLOB '*[0-9]*' AND longitude NOT GLOB '*[^0-9.+-]*'
+    AND latitude GLOB '*[0-9]*' AND latitude NOT GLOB '*[^0-9.+-]*';
+INSERT INTO STUDENT_GEO
+  SELECT CAST(substr(zid, 2) AS INTEGER), home_longitude, home_longitude, home_latitude, home_latitude FROM STUDENT
+  WHERE NOT EXISTS (SELECT 1 FROM STUDENT_GEO)
+    AND home_longitude GLOB '*[0-9]*' AND home_longitude NOT GLOB '*[^0-9.+-]*'
+    AND home_latitude GLOB '*[0-9]*' AND home_latitude NOT GLOB '*[^0-9.+-]*';
+
+-- Indexes for time ordered reads (time is UTC epoch seconds)
+CREATE INDEX IF NOT EXISTS POST_zid_time ON POST (zid, time);
+CREATE INDEX IF NOT EXISTS POST_time ON POST (time);
+CREATE INDEX IF NOT EXISTS COMMENT_post_time ON COMMENT (post_id, time);
+CREATE INDEX IF NOT EXISTS REPLY_comment_time ON REPLY (comment_id, time);
+
+-- Indexes for friendship lookups and for deleting both directions of a friendship
+CREATE INDEX IF NOT EXISTS FRIENDS_zid ON FRIENDS (zid, friend_zid);
+CREATE INDEX IF NOT EXISTS FRIENDS_friend_zid ON FRIENDS (friend_zid);
+CREATE INDEX IF NOT EXISTS COMMENT_zid ON COMMENT (zid);
+CREATE INDEX IF NOT EXISTS REPLY_zid ON REPLY (zid);
+
+-- Table : ACCOUNT_PURGE: deleted accounts whose posts / comments / replies
+-- are still being deleted in the background
+CREATE TABLE IF NOT EXISTS ACCOUNT_PURGE (
+  zid        TEXT PRIMARY KEY NOT NULL,
+  requested  INTEGER
+);
+
+-- Table : MENTION: one row per student (zid) mentioned in a post / comment / reply
+-- Filled by new_post / new_comment / new_reply and build_db.py (backfill_mentions)
+--   author : who wrote the message, post_id : the post (of the thread)
+--   comment_id / reply_id : set when the mention is in a comment / reply
+CREATE TABLE IF NOT EXISTS MENTION (
+  id         INTEGER PRIMARY KEY AUTOINCREMENT,
+  zid        TEXT    NOT NULL,
+  author     TEXT    NOT NULL,
+  post_id    INTEGER NOT NULL,
+  comment_id INTEGER,
+  reply_id   INTEGER,
+  time       INTEGER
+);
+CREATE INDEX IF NOT EXISTS MENTION_zid_time ON MENTION (zid, time, id);
+CREATE INDEX IF NOT EXISTS MENTION_post ON MENTION (post_id);
+CREATE INDEX IF NOT EXISTS MENTION_comment ON MENTION (comment_id) WHERE comment_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS MENTION_reply ON MENTION (reply_id) WHERE reply_id IS NOT NULL;
+
+CREATE TRIGGER IF NOT EXISTS POST_mention_delete AFTER DELETE ON POST BEGIN
+  DELETE FROM MENTION WHERE post_id = OLD.id;
+END;
+CREATE TRIGGER IF NOT EXISTS COMMENT_mention_delete AFTER DELETE ON COMMENT BEGIN
+  DELETE FROM MENTION WHERE comment_id = OLD.id;
+END;
+CREATE TRIGGER IF NOT EXISTS REPLY_mention_delete AFTER DELETE ON REPLY BEGIN
+  DELETE FROM MENTION WHERE reply_id = OLD.id;
+END;
+
+-- Table : NOTIFICATION: append-only events for one student (zid), streamed by
+-- /notifications/stream (the id is the SSE event id)
+--   kind  : 'comment' (on zid's post), 'reply' (on zid's comment / post),
+--           'friend' (actor added zid), 'mention' (actor mentioned zid)
+--   actor : who caused the event
+CREATE TABLE IF NOT EXISTS NOTIFICATION (
+  id         INTEGER PRIMARY KEY AUTOINCREMENT,
+  zid        TEXT    NOT NULL,
+  kind       TEXT    NOT NULL,
+  actor      TEXT    NOT NULL,
+  post_id    INTEGER,
+  comment_id INTEGER,
+  reply_id   INTEGER,
+  time       INTEGER
+);
+CREATE INDEX IF NOT EXISTS NOTIFICATION_zid ON NOTIFICATION (zid, id);
+CREATE INDEX IF NOT EXISTS NOTIFICATION_post ON NOTIFICATION (post_id) WHERE post_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS NOTIFICATION_comment ON NOTIFICATION (comment_id) WHERE comment_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS NOTIFICATION_reply ON NOTIFICATION (reply_id) WHERE reply_id IS NOT NULL;
+
+CREATE TRIGGER IF NOT EXISTS POST_notification_delete AFTER DELETE ON POST BEGIN
+  DELETE FROM NOTIFICATION WHERE post_id = OLD.id;
+END;
+CREATE TRIGGER IF NOT EXISTS COMMENT_notification_delete AFTER DELETE ON COMMENT BEGIN
+  DELETE FROM NOTIFICATION WHERE comment_id = OLD.id;
+END;
+CREATE TRIGGER IF NOT EXISTS REPLY_notification_delete AFTER DELETE ON REPLY BEGIN
+  DELETE FROM NOTIFICATION WHERE reply_id = OLD.id;
+END;
+
+-- Table : COURSE_MEMBER: students enrolled in a course code (any term)
+-- COURSES.course is "2017 S2 COMP1521", the code is its last word;
+-- kept in step with COURSES by triggers, read by the course feeds
+CREATE TABLE IF NOT EXISTS COURSE_MEMBER (
+  code       TEXT NOT NULL,
+  zid        TEXT NOT NULL,
+  PRIMARY KEY (code, zid)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS COURSE_MEMBER_zid ON COURSE_MEMBER (zid);
+CREATE INDEX IF NOT EXISTS COURSES_zid ON COURSES (zid);
+
+CREATE TRIGGER IF NOT EXISTS COURSES_member_insert AFTER INSERT ON COURSES BEGIN
+  INSERT OR IGNORE INTO COURSE_MEMBER (code, zid)
+    VALUES (substr(NEW.course, length(rtrim(NEW.course, replace(NEW.course, ' ', ''))) + 1), NEW.zid);
+END;
+CREATE TRIGGER IF NOT EXISTS COURSES_member_delete AFTER DELETE ON COURSES BEGIN
+  DELETE FROM COURSE_MEMBER
+    WHERE code = substr(OLD.course, length(rtrim(OLD.course, replace(OLD.course, ' ', ''))) + 1) AND zid = OLD.zid
+      AND NOT EXISTS (SELECT 1 FROM COURSES WHERE zid = OLD.zid
+                      AND substr(course, length(rtrim(course, replace(course, ' ', ''))) + 1) = COURSE_MEMBER.code);
+END;
+
+-- Backfill databases built before COURSE_MEMBER existed (only when empty)
+INSERT OR IGNORE INTO COURSE_MEMBER (code, zid)
+  SELECT substr(course, length(rtrim(course, replace(course, ' ', ''))) + 1), zid FROM COURSES
+  WHERE NOT EXISTS (SELECT 1 FROM COURSE_MEMBER);
+
+-- Counters: POST (comment_count, reply_count), STUDENT / TO_BE_SUSPENDED
+-- (post_count, friend_count) are kept up to date by these triggers, in the
+-- transaction of the write. friend_count counts FRIENDS rows (suspended
+-- friends included). Columns of older databases are added by upgrade_db,
+-- ./maintenance.py repair_counters recomputes them all.
+CREATE TRIGGER IF NOT EXISTS COMMENT_count_insert AFTER INSERT ON COMMENT BEGIN
+  UPDATE POST SET comment_count = comment_count + 1 WHERE id = NEW.post_id;
+END;
+CREATE TRIGGER IF NOT EXISTS COMMENT_count_delete AFTER DELETE ON COMMENT BEGIN
+  UPDATE POST SET comment_count = comment_count - 1 WHERE id = OLD.post_id;
+END;
+CREATE TRIGGER IF NOT EXISTS REPLY_count_insert AFTER INSERT ON REPLY BEGIN
+  UPDATE POST SET reply_count = reply_count + 1 WHERE id = (SELECT post_id FROM COMMENT WHERE id = NEW.comment_id);
+END;
+CREATE TRIGGER IF NOT EXISTS REPLY_count_delete AFTER DELETE ON REPLY BEGIN
+  UPDATE POST SET reply_count = reply_count - 1 WHERE id = (SELECT post_id FROM COMMENT WHERE id = OLD.comment_id);
+END;
+CREATE TRIGGER IF NOT EXISTS POST_count_insert AFTER INSERT ON POST BEGIN
+  UPDATE STUDENT SET post_count = post_count + 1 WHERE zid = NEW.zid;
+  UPDATE TO_BE_SUSPENDED SET post_count = post_count + 1 WHERE zid = NEW.zid;
+END;
+CREATE TRIGGER IF NOT EXISTS POST_count_delete AFTER DELETE ON POST BEGIN
+  UPDATE STUDENT SET post_count = post_count - 1 WHERE zid = OLD.zid;
+  UPDATE TO_BE_SUSPENDED SET post_count = post_count - 1 WHERE zid = OLD.zid;
+END;
+CREATE TRIGGER IF NOT EXISTS FRIENDS_count_insert AFTER INSERT ON FRIENDS BEGIN
+  UPDATE STUDENT SET friend_count = friend_count + 1 WHERE zid = NEW.zid;
+  UPDATE TO_BE_SUSPENDED SET friend_count = friend_count + 1 WHERE zid = NEW.zid;
+END;
+CREATE TRIGGER IF NOT EXISTS FRIENDS_count_delete AFTER DELETE ON FRIENDS BEGIN
+  UPDATE STUDENT SET friend_count = friend_count - 1 WHERE zid = OLD.zid;
+  UPDATE TO_BE_SUSPENDED SET friend_count = friend_count - 1 WHERE zid = OLD.zid;
+END;
+
+-- Index for the "top" feed: POST.score is written by the app (ranking.py)
+CREATE INDEX IF NOT EXISTS POST_zid_score ON POST (zid, score);
+
+-- Maintenance scheduler (UNSWtalk.run_job), used on shard 0 only
+-- Table : MAINTENANCE_JOB: schedule and last run of each job
+--   run_every : seconds between runs (0: disabled)
+--   locked_by / locked_until : pid of the worker running the job, until when
+CREATE TABLE IF NOT EXISTS MAINTENANCE_JOB (
+  name          TEXT PRIMARY KEY NOT NULL,
+  run_every     INTEGER NOT NULL,
+  last_run      INTEGER,
+  last_duration REAL,
+  last_status   TEXT,
+  locked_by     INTEGER,
+  locked_until  INTEGER
+);
+-- Table : MAINTENANCE_LOG: every run (duration in seconds, result as JSON)
+CREATE TABLE IF NOT EXISTS MAINTENANCE_LOG (
+  id         INTEGER PRIMARY KEY,
+  name       TEXT    NOT NULL,
+  started    INTEGER NOT NULL,
+  duration   REAL,
+  status     TEXT,
+  result     TEXT
+);
+CREATE INDEX IF NOT EXISTS MAINTENANCE_LOG_started ON MAINTENANCE_LOG (started);
+
+-- Table : FRIEND_SUGGESTION: suggestions of each student (zid) in rank
+-- order, written by the friend_suggestions job, read by view_friends
+CREATE TABLE IF NOT EXISTS FRIEND_SUGGESTION (
+  zid        TEXT    NOT NULL,
+  rank       INTEGER NOT NULL,
+  suggestion TEXT    NOT NULL,
+  computed   INTEGER NOT NULL,
+  PRIMARY KEY (zid, rank)
+) WITHOUT ROWID;
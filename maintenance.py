@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Database maintenance commands
+# How to run: ./maintenance.py <command>
+#       purge_orphans : delete orphan comments / replies, finish interrupted account deletes
+#       repair_counters : recompute comment / reply / post / friend counters
+#       rescore_posts : recompute the scores of the "top" feed
+#       jobs : schedule and last run of the maintenance jobs
+#       run [job ...] : run the given jobs now, or every due job (e.g. from cron)
+#       schedule job seconds : run job every seconds (0 disables it)
+#       log : the last runs and their durations
+#       enable_incremental_vacuum : switch old databases to auto_vacuum = INCREMENTAL (stop the app first)
+
+import os
+import sys
+import argparse
+
+# relative paths (db/) are resolved from here
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.getcwd())
+
+import UNSWtalk
+
+
+# Function: format_run_every
+def format_run_every(seconds):
+    if seconds == 0:
+        return "disabled"
+    if seconds % 3600 == 0:
+        return "{}h".format(seconds // 3600)
+    return "{}s".format(seconds)
+
+
+# Function: purge_orphans
+def purge_orphans(args):
+    results = UNSWtalk.purge_orphans()
+    for table, deleted in results.items():
+        print("{}: {} orphan rows deleted".format(table, deleted))
+
+
+# Function: repair_counters
+def repair_counters(args):
+    results = UNSWtalk.repair_counters()
+    for table, corrected in results.items():
+        print("{}: {} rows corrected".format(table, corrected))
+
+
+# Function: rescore_posts
+def rescore_posts(args):
+    print("POST: {} scores updated".format(UNSWtalk.rescore_all_posts()))
+
+
+# Function: jobs
+def jobs(args):
+    for job in UNSWtalk.get_job_status():
+        last_run = UNSWtalk.transform_time(job['last_run']) if job['last_run'] != None else "never"
+        duration = "{:.3f}s".format(job['last_duration']) if job['last_duration'] != None else ""
+        running = "running in {}".format(job['locked_by']) if job['locked_by'] != None else ""
+        print("{:<22}{:>10}  {:<28}{:>10}  {:<6}{}".format(job['name'], format_run_every(job['run_every']),
+                                                       last_run, duration, job['last_status'] or "", running))
+
+
+# Function: run
+# The named jobs are run even if they are not due, unless another worker runs them
+def run(args):
+    for name in args.jobs:
+        if name not in UNSWtalk.MAINTENANCE_JOBS:
+            sys.exit("unknown job {}, see ./maintenance.py jobs".format(name))
+    if len(args.jobs) > 0:
+        runs = []
+        for name in args.jobs:
+            result = UNSWtalk.run_job(name, force = True)
+            if result == None:
+                print("{}: already running".format(name))
+            else:
+                runs.append(result)
+    else:
+        runs = UNSWtalk.run_due_jobs()
+    for result in runs:
+        print("{}: {} in {:.3f}s {}".format(result['name'], result['status'], result['duration'], result['result']))
+
+
+# Function: schedule
+def schedule(args):
+    if args.job not in UNSWtalk.MAINTENANCE_JOBS:
+        sys.exit("unknown job {}, see ./maintenance.py jobs".format(args.job))
+    UNSWtalk.set_job_schedule(args.job, args.seconds)
+    print("{}: {}".format(args.job, format_run_every(args.seconds)))
+
+
+# Function: log
+def log(args):
+    rows = UNSWtalk.db_read("SELECT * FROM MAINTENANCE_LOG ORDER BY id DESC LIMIT ?", [args.limit])
+    for row in reversed(rows):
+        print("{}  {:<22}{:<6}{:>10.3f}s  {}".format(UNSWtalk.transform_time(row['started']), row['name'],
+                                                   row['status'], row['duration'], row['result']))
+
+
+# Function: enable_incremental_vacuum
+def enable_incremental_vacuum(args):
+    for shard, path in enumerate(UNSWtalk.SHARD_MAP.paths):
+        converted = UNSWtalk.enable_incremental_vacuum(shard)
+        print("{}: {}".format(path, "converted" if converted else "already incremental"))
+
+
+# Main : run a maintenance command
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "UNSWtalk database maintenance")
+    commands = parser.add_subparsers(dest = 'command')
+    commands.add_parser('purge_orphans', help = "delete orphan comments / replies").set_defaults(run = purge_orphans)
+    commands.add_parser('repair_counters', help = "recompute the counter columns").set_defaults(run = repair_counters)
+    commands.add_parser('rescore_posts', help = "recompute the scores of the top feed").set_defaults(run = rescore_posts)
+    commands.add_parser('jobs', help = "schedule and last run of the maintenance jobs").set_defaults(run = jobs)
+    run_parser = commands.add_parser('run', help = "run jobs now (default: every due job)")
+    run_parser.add_argument('jobs', nargs = '*', help = "job names")
+    run_parser.set_defaults(run = run)
+    schedule_parser = commands.add_parser('schedule', help = "set how often a job runs")
+    schedule_parser.add_argument('job')
+    schedule_parser.add_argument('seconds', type = int, help = "seconds between runs, 0 disables the job")
+    schedule_parser.set_defaults(run = schedule)
+    log_parser = commands.add_parser('log', help = "last runs of the maintenance jobs")
+    log_parser.add_argument('--limit', type = int, default = 20)
+    log_parser.set_defaults(run = log)
+    commands.add_parser('enable_incremental_vacuum', help = "switch to auto_vacuum = INCREMENTAL (stop the app first)").set_defaults(run = enable_incremental_vacuum)
+    args = parser.parse_args()
+    if args.command == None:
+        parser.print_help()
+        sys.exit(1)
+    UNSWtalk.upgrade_db()
+    args.run(args)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# coding : utf-8
+
+# In-memory prefix index of students for autocomplete
+#
+# Every student is indexed under lower-case keys: the zid, the full name and
+# each word of the full name, so "z519", "pamela" and "and" all find
+# "Pamela Anderson". The (key, zid) pairs are kept in one sorted list and a
+# prefix lookup is a bisect followed by a scan of the matching run.
+#
+# add / remove keep the list sorted (insort), which is cheap for single
+# registrations and profile edits. Readers take the same lock: a search
+# never sees the list while an entry is moved.
+
+import threading
+from bisect import bisect_left, insort
+
+
+# Class: PrefixIndex
+class PrefixIndex(object):
+
+    def __init__(self):
+        self.entries = []
+        # zid -> (full_name, keys of zid)
+        self.students = {}
+        self.lock = threading.Lock()
+
+    # Function: from_students
+    # Build the index from (zid, full_name) pairs
+    @classmethod
+    def from_students(cls, students):
+        index = cls()
+        for zid, full_name in students:
+            keys = get_keys(zid, full_name)
+            index.students[zid] = (full_name, keys)
+            index.entries.extend((key, zid) for key in keys)
+        index.entries.sort()
+        return index
+
+    # Function: add
+    # Index zid (again, replacing its old keys)
+    def add(self, zid, full_name):
+        with self.lock:
+            self.remove_locked(zid)
+            keys = get_keys(zid, full_name)
+            self.students[zid] = (full_name, keys)
+            for key in keys:
+                insort(self.entries, (key, zid))
+
+    # Function: remove
+    def remove(self, zid):
+        with self.lock:
+            self.remove_locked(zid)
+
+    def remove_locked(self, zid):
+        if zid not in self.students:
+            return
+        full_name, keys = self.students.pop(zid)
+        for key in keys:
+            position = bisect_left(self.entries, (key, zid))
+            if position < len(self.entries) and self.entries[position] == (key, zid):
+                del self.entries[position]
+
+    # Function: search
+    # zids with a key starting with prefix, each zid once, in key order
+    # Input:
+    #       prefix: str (case-insensitive)
+    #       limit: stop after this many distinct zids
+    # Output:
+    #       list of zids
+    def search(self, prefix, limit):
+        prefix = prefix.strip().lower()
+        if prefix == "":
+            return []
+        results = []
+        seen = set()
+        with self.lock:
+            entries = self.entries
+            position = bisect_left(entries, (prefix,))
+            while position < len(entries) and len(results) < limit:
+                key, zid = entries[position]
+                if not key.startswith(prefix):
+                    break
+                if zid not in seen:
+                    seen.add(zid)
+                    results.append(zid)
+                position += 1
+        return results
+
+    # Function: matching
+    # The zids among zids with a key starting with prefix, in the order given
+    def matching(self, zids, prefix):
+        prefix = prefix.strip().lower()
+        if prefix == "":
+            return []
+        with self.lock:
+            students = [(zid, self.students.get(zid)) for zid in zids]
+        return [zid for zid, student in students
+                if student != None and any(key.startswith(prefix) for key in student[1])]
+
+    # Function: full_name
+    def full_name(self, zid):
+        with self.lock:
+            student = self.students.get(zid)
+        return student[0] if student != None else None
+
+    def __len__(self):
+        return len(self.students)
+
+
+# Function: get_keys
+# Lower-case keys of a student: zid, full name and every word of the full name
+def get_keys(zid, full_name):
+    keys = set([zid.lower()])
+    if full_name:
+        full_name = " ".join(full_name.lower().split())
+        keys.add(full_name)
+        keys.update(full_name.split(" "))
+    keys.discard("")
+    return sorted(keys)
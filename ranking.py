@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# coding : utf-8
+
+# Engagement score of posts for the "top" feed
+#
+#       score = log2(1 + comments + REPLY_WEIGHT * replies) + time / SCORE_HALF_LIFE
+#
+# Ranking by this score is ranking by
+#       (1 + engagement) * 2 ** ((time - now) / SCORE_HALF_LIFE)
+# i.e. engagement decaying by half every SCORE_HALF_LIFE seconds, but the
+# stored value does not change as time passes: it only has to be written
+# when a post gets a comment / reply, and POST (zid, score) stays a valid
+# index. rescore_posts recomputes all scores (after deletes, or when the
+# constants change).
+
+import math
+
+SCORE_HALF_LIFE = 24 * 3600
+REPLY_WEIGHT = 0.5
+# weight of log2(1 + mutual friends of viewer and author), applied when
+# the feed is read (the score column does not depend on the viewer)
+AFFINITY_WEIGHT = 0.5
+
+
+# Function: post_score
+# Score of a post from its time (epoch) and counters
+# Also registered as the SQL function post_score(time, comment_count, reply_count)
+def post_score(time, comment_count, reply_count):
+    engagement = (comment_count or 0) + REPLY_WEIGHT * (reply_count or 0)
+    return math.log2(1 + max(engagement, 0)) + (time or 0) / SCORE_HALF_LIFE
+
+
+# Function: affinity_score
+# Score of a post for one viewer
+def affinity_score(score, mutual_count):
+    return score + AFFINITY_WEIGHT * math.log2(1 + mutual_count)
+
+
+# Function: register_functions
+# Make post_score available to SQL on conn
+def register_functions(conn):
+    conn.create_function('post_score', 3, post_score)
+
+
+# Function: rescore_posts
+# Recompute the score of every post on conn (build / upgrade)
+def rescore_posts(conn):
+    register_functions(conn)
+    conn.execute("UPDATE POST SET score = post_score(time, comment_count, reply_count)")
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Move the data to a new number of shards (see shards.py)
+# How to run: ./rebalance_shards.py N
+# Stop the app first. Every row is copied from the current shards into N
+# new database files of the next generation, keeping its id (new rows get
+# ids from the ranges of the new generation), then the shard map is
+# switched to the new files. The old files are not deleted.
+
+import os
+import sys
+import argparse
+import sqlite3
+
+# relative paths (db/) are resolved from here
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.getcwd())
+
+import UNSWtalk
+from shards import ShardMap, seed_sequences
+
+
+COPY_CHUNK_SIZE = 1000
+# Tables copied, in this order: a row goes to the shard of its zid, except
+# comments / mentions (their post) and replies (their comment)
+# CHANGE_LOG is not copied, COURSE_MEMBER and the R*Trees are filled by triggers,
+# the maintenance schedule and FRIEND_SUGGESTION start again empty
+COPY_TABLES = ['STUDENT', 'TO_BE_SUSPENDED', 'TO_BE_CONFIRMED', 'FRIENDS', 'COURSES', 'ACCOUNT_PURGE',
+               'POST', 'COMMENT', 'REPLY', 'MENTION', 'NOTIFICATION']
+
+
+# Function: create_shards
+# Empty databases for new_map, with the full schema and their id ranges
+def create_shards(new_map):
+    with open("db/db_schema.sql") as f:
+        schema_sql = f.read()
+    with open(UNSWtalk.UPGRADE_SCHEMA_PATH) as f:
+        upgrade_sql = f.read()
+    conns = []
+    for shard, path in enumerate(new_map.paths):
+        if os.path.exists(path):
+            sys.exit("{} already exists".format(path))
+        conn = sqlite3.connect(path)
+        conn.executescript(schema_sql)
+        UNSWtalk.upgrade_shard(conn, upgrade_sql)
+        seed_sequences(conn, new_map.first_id(shard))
+        conn.commit()
+        conns.append(conn)
+    return conns
+
+
+# Function: copy_table
+# Copy every row of table from the old shards to the new ones
+# Input: target: function (row) -> new shard
+# Output: number of rows copied to each new shard
+def copy_table(table, old_map, conns, target):
+    counts = [0] * len(conns)
+    for path in old_map.paths:
+        old_conn = sqlite3.connect("file:{}?mode=ro".format(os.path.abspath(path)), uri = True)
+        old_conn.row_factory = sqlite3.Row
+        cursor = old_conn.execute("SELECT * FROM {}".format(table))
+        names = [column[0] for column in cursor.description]
+        insert_sql = "INSERT INTO {} ({}) VALUES ({})".format(table, ", ".join(names), ",".join("?" * len(names)))
+        while True:
+            rows = cursor.fetchmany(COPY_CHUNK_SIZE)
+            if len(rows) == 0:
+                break
+            batches = {}
+            for row in rows:
+                batches.setdefault(target(row), []).append(tuple(row))
+            for shard, batch in batches.items():
+                conns[shard].executemany(insert_sql, batch)
+                counts[shard] += len(batch)
+        old_conn.close()
+    return counts
+
+
+# Function: rebalance
+def rebalance(count):
+    UNSWtalk.upgrade_db()
+    old_map = UNSWtalk.SHARD_MAP
+    generation = old_map.generation + 1
+    new_map = ShardMap(["db/{}.g{}.shard{}.db".format(UNSWtalk.DATABASE_NAME, generation, shard) for shard in range(count)], generation)
+    conns = create_shards(new_map)
+    # new shard of every post / comment, for the rows stored with them
+    post_shards = {}
+    comment_shards = {}
+
+    def by_zid(row):
+        return new_map.shard_for_zid(row['zid'])
+
+    def by_post(row):
+        shard = post_shards.get(row['post_id'])
+        return shard if shard != None else by_zid(row)
+
+    def post_target(row):
+        post_shards[row['id']] = by_zid(row)
+        return post_shards[row['id']]
+
+    def comment_target(row):
+        comment_shards[row['id']] = by_post(row)
+        return comment_shards[row['id']]
+
+    def reply_target(row):
+        shard = comment_shards.get(row['comment_id'])
+        return shard if shard != None else by_zid(row)
+
+    targets = {'POST': post_target, 'COMMENT': comment_target, 'REPLY': reply_target, 'MENTION': by_post}
+    for table in COPY_TABLES:
+        counts = copy_table(table, old_map, conns, targets.get(table, by_zid))
+        print("{}: {}".format(table, " / ".join(str(n) for n in counts)))
+    # the inserts ran the counter triggers on top of the copied counters
+    for conn in conns:
+        for table, repair_sql in UNSWtalk.COUNTER_REPAIR_SQL:
+            conn.execute(repair_sql)
+        conn.execute("DELETE FROM CHANGE_LOG")
+        conn.commit()
+        conn.close()
+    new_map.save(UNSWtalk.SHARD_CONFIG_PATH)
+    if os.path.exists(UNSWtalk.GRAPH_SNAPSHOT_PATH):
+        os.remove(UNSWtalk.GRAPH_SNAPSHOT_PATH)
+    print("{} now uses {} shards, the old files can be deleted:".format(UNSWtalk.SHARD_CONFIG_PATH, count))
+    for path in old_map.paths:
+        print("    {}".format(path))
+
+
+# Main : rebalance the shards
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Move the UNSWtalk data to a new number of shards (stop the app first)")
+    parser.add_argument('shards', type = int, help = "number of database files")
+    args = parser.parse_args()
+    rebalance(args.shards)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Run UNSWtalk as a persistent pre-forked server
+# Python, Flask and the templates are loaded once in the master process,
+# then N workers are forked and serve requests until they are stopped.
+#
+# How to run:
+#       ./serve.py --workers 4 --port 8000                  (HTTP / WSGI)
+#       ./serve.py --workers 4 --fastcgi --socket /tmp/unswtalk.sock   (FastCGI, needs flup)
+
+import os
+import sys
+import signal
+import argparse
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+
+# Class: PreforkWSGIServer
+# The listening socket is created by the master and shared by all workers,
+# each worker handles its connections in threads
+class PreforkWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+# Function: parse_args
+def parse_args():
+    parser = argparse.ArgumentParser(description = "Persistent UNSWtalk server")
+    parser.add_argument('--workers', type = int, default = os.cpu_count() or 2, help = "number of worker processes")
+    parser.add_argument('--host', default = "127.0.0.1")
+    parser.add_argument('--port', type = int, default = 8000)
+    parser.add_argument('--fastcgi', action = 'store_true', help = "speak FastCGI instead of HTTP (requires flup)")
+    parser.add_argument('--socket', default = None, help = "unix socket path for FastCGI")
+    return parser.parse_args()
+
+
+# Function: run_fastcgi
+# flup forks and manages the workers itself
+def run_fastcgi(application, args):
+    try:
+        from flup.server.fcgi_fork import WSGIServer as FCGIServer
+    except ImportError:
+        sys.exit("FastCGI mode requires flup: pip install flup")
+    bind_address = args.socket if args.socket else (args.host, args.port)
+    FCGIServer(application, bindAddress = bind_address, maxChildren = args.workers,
+               minSpare = args.workers, maxSpare = args.workers).run()
+
+
+# Function: run_prefork
+# Fork the workers and restart any worker that exits
+def run_prefork(application, args):
+    server = PreforkWSGIServer((args.host, args.port), WSGIRequestHandler)
+    server.set_app(application)
+    workers = set()
+    running = True
+
+    def spawn_worker():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        workers.add(pid)
+
+    def stop(signum, frame):
+        nonlocal running
+        running = False
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(args.workers):
+        spawn_worker()
+    print("UNSWtalk: {} workers on http://{}:{}/".format(args.workers, args.host, args.port), flush = True)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        workers.discard(pid)
+        if running:
+            spawn_worker()
+    server.server_close()
+
+
+if __name__ == "__main__":
+    # relative paths (db/, static/, templates/) are resolved from here
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, os.getcwd())
+    from UNSWtalk import create_app
+
+    args = parse_args()
+    # threaded workers: pages may hold a notification stream open
+    application = create_app(stream = True)
+    if args.fastcgi:
+        run_fastcgi(application, args)
+    else:
+        run_prefork(application, args)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# coding : utf-8
+
+# Shard map: which database file holds which rows
+#
+# Every shard is a complete database (same schema, triggers, CHANGE_LOG).
+# The rows of a student live on the shard of their zid (crc32(zid) % count):
+# STUDENT / TO_BE_* / FRIENDS / COURSES / NOTIFICATION rows by their zid,
+# POST by its author, COMMENT / REPLY / MENTION with their post.
+#
+# Row ids (AUTOINCREMENT) are allocated in disjoint ranges, so an id is
+# unique over all shards and tells on which shard the row was created:
+#       first id of a shard = (generation * MAX_SHARDS + shard) * SHARD_ID_RANGE
+# A rebalance (rebalance_shards.py) copies the rows to the files of the next
+# generation, keeping their ids, so after it an id is only a hint.
+#
+# The map is read from a JSON file ({"generation": 0, "paths": [...]});
+# without one there is a single shard, the database file itself.
+
+import os
+import json
+import zlib
+
+
+MAX_SHARDS = 64
+SHARD_ID_RANGE = 10 ** 10
+# tables whose ids are allocated per shard (CHANGE_LOG stays per shard)
+ID_TABLES = ['FRIENDS', 'COURSES', 'POST', 'COMMENT', 'REPLY', 'MENTION', 'NOTIFICATION']
+
+
+# Class: ShardMap
+class ShardMap(object):
+
+    def __init__(self, paths, generation = 0):
+        if len(paths) == 0 or len(paths) > MAX_SHARDS:
+            raise ValueError("a shard map needs 1 to {} shards".format(MAX_SHARDS))
+        self.paths = list(paths)
+        self.generation = generation
+
+    # Function: load
+    # The map in config_path, or the single shard default_path
+    @classmethod
+    def load(cls, config_path, default_path):
+        if not os.path.exists(config_path):
+            return cls([default_path])
+        with open(config_path) as f:
+            config = json.load(f)
+        return cls(config['paths'], config.get('generation', 0))
+
+    # Function: save
+    # Write the map to config_path, atomically replacing the old one
+    def save(self, config_path):
+        temp_path = "{}.{}.tmp".format(config_path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump({'generation': self.generation, 'paths': self.paths}, f, indent = 2)
+        os.replace(temp_path, config_path)
+
+    @property
+    def count(self):
+        return len(self.paths)
+
+    # Function: shard_for_zid
+    def shard_for_zid(self, zid):
+        if len(self.paths) == 1:
+            return 0
+        return zlib.crc32(zid.encode('utf-8')) % len(self.paths)
+
+    # Function: group_by_shard
+    # {shard: [zids on it]}, only shards with zids
+    def group_by_shard(self, zids):
+        groups = {}
+        for zid in zids:
+            groups.setdefault(self.shard_for_zid(zid), []).append(zid)
+        return groups
+
+    # Function: shard_for_id
+    # The shard a row id was allocated on in this generation, None if it
+    # comes from another generation (then every shard must be checked)
+    def shard_for_id(self, row_id):
+        block = int(row_id) // SHARD_ID_RANGE
+        generation, shard = divmod(block, MAX_SHARDS)
+        if generation != self.generation or shard >= len(self.paths):
+            return None
+        return shard
+
+    # Function: first_id
+    # ids allocated on shard start after this one
+    def first_id(self, shard):
+        return (self.generation * MAX_SHARDS + shard) * SHARD_ID_RANGE
+
+
+# Function: seed_sequences
+# Make the AUTOINCREMENT tables of conn allocate ids after first_id
+# (idempotent, sequences already past it are left alone)
+def seed_sequences(conn, first_id):
+    if first_id == 0:
+        return
+    for table in ID_TABLES:
+        conn.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = ? AND seq < ?", [first_id, table, first_id])
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)", [table, first_id, table])
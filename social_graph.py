@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# coding : utf-8
+
+# Compact in-memory social graph (FRIENDS)
+#
+# zids are interned to integer ids (0 .. n-1) and the adjacency lists are
+# stored in CSR form: the neighbours of node i are
+#       neighbours[offsets[i] : offsets[i + 1]]  (sorted ints)
+# in two flat int32 arrays, i.e. 4 bytes per friendship instead of a Python
+# set of strings per student.
+#
+# CSR arrays are immutable, so add / remove friend are kept in small
+# per-node overlays (added / removed sets) and merged into the arrays by
+# compact() once the overlays grow.
+#
+# Readers run in several threads while the CHANGE_LOG listener applies
+# changes: the arrays and overlays form one state tuple that is never
+# modified. Writers (serialized by a lock) build a new one and publish it
+# with a single assignment, readers take self.state once per call.
+#
+# A snapshot file holds the same arrays and is memory-mapped on load, so
+# starting a worker does not rebuild the graph from the database.
+
+import os
+import mmap
+import time
+import struct
+import threading
+from array import array
+
+
+SNAPSHOT_MAGIC = b'UTGRAPH1'
+# magic, change id, node count, edge count, zid blob length
+SNAPSHOT_HEADER = struct.Struct('<8sQIII')
+# merge the overlays into the CSR arrays after this many changed nodes
+COMPACT_THRESHOLD = 1024
+
+
+# Class: SearchTimeout
+# Raised by shortest_path when its deadline passed (not the same as "not connected")
+class SearchTimeout(Exception):
+    pass
+
+
+# Class: SocialGraph
+# Undirected friendship graph, FRIENDS stores both directions of a friendship
+# and so does the graph (edges are directed rows)
+class SocialGraph(object):
+
+    def __init__(self, zids, offsets, neighbours, change_id = 0):
+        self.zids = list(zids)
+        self.index = {zid: i for i, zid in enumerate(self.zids)}
+        # (offsets, neighbours, added, removed): added / removed map a node
+        # to a frozenset of neighbour ids
+        self.state = (offsets, neighbours, {}, {})
+        # last CHANGE_LOG id contained in the graph
+        self.change_id = change_id
+        self.snapshot = None
+        self.lock = threading.Lock()
+
+    @property
+    def offsets(self):
+        return self.state[0]
+
+    @property
+    def neighbours(self):
+        return self.state[1]
+
+    # Function: from_edges
+    # Build the CSR arrays from (zid, friend_zid) pairs
+    @classmethod
+    def from_edges(cls, edges, change_id = 0):
+        adjacency = {}
+        for zid, friend_zid in edges:
+            adjacency.setdefault(zid, set()).add(friend_zid)
+            adjacency.setdefault(friend_zid, set())
+        zids = sorted(adjacency)
+        index = {zid: i for i, zid in enumerate(zids)}
+        offsets = array('i', [0])
+        neighbours = array('i')
+        for zid in zids:
+            neighbours.extend(sorted(index[friend_zid] for friend_zid in adjacency[zid]))
+            offsets.append(len(neighbours))
+        return cls(zids, offsets, neighbours, change_id)
+
+    # Function: load_snapshot
+    # Memory-map a snapshot written by save_snapshot (no copy of the arrays)
+    @classmethod
+    def load_snapshot(cls, path):
+        with open(path, 'rb') as f:
+            snapshot = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, change_id, node_count, edge_count, blob_length = SNAPSHOT_HEADER.unpack_from(snapshot, 0)
+        if magic != SNAPSHOT_MAGIC:
+            snapshot.close()
+            raise ValueError("{} is not a social graph snapshot".format(path))
+        position = SNAPSHOT_HEADER.size
+        blob = snapshot[position:position + blob_length].decode('ascii')
+        zids = blob.split('\n') if node_count > 0 else []
+        position += blob_length + (-blob_length % 4)
+        view = memoryview(snapshot)
+        offsets = view[position:position + 4 * (node_count + 1)].cast('i')
+        position += 4 * (node_count + 1)
+        neighbours = view[position:position + 4 * edge_count].cast('i')
+        graph = cls(zids, offsets, neighbours, change_id)
+        graph.snapshot = snapshot
+        return graph
+
+    # Function: save_snapshot
+    # Write the (compacted) graph to path, atomically replacing the old file
+    def save_snapshot(self, path):
+        with self.lock:
+            self.compact_locked()
+            offsets, neighbours, added, removed = self.state
+            zids = self.zids[:len(offsets) - 1]
+            change_id = self.change_id
+        blob = '\n'.join(zids).encode('ascii')
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, change_id, len(zids), len(neighbours), len(blob)))
+            f.write(blob)
+            f.write(b'\0' * (-len(blob) % 4))
+            f.write(array('i', offsets).tobytes())
+            f.write(array('i', neighbours).tobytes())
+        os.replace(temp_path, path)
+
+    # Function: intern
+    # Integer id of zid, new zids are appended (under self.lock)
+    def intern(self, zid):
+        node = self.index.get(zid)
+        if node == None:
+            node = len(self.zids)
+            self.zids.append(zid)
+            self.index[zid] = node
+        return node
+
+    # Function: neighbour_ids
+    # Sorted neighbour ids of node, in state (default: the current one)
+    def neighbour_ids(self, node, state = None):
+        offsets, neighbours, added, removed = self.state if state == None else state
+        base = base_ids(offsets, neighbours, node)
+        if node not in added and node not in removed:
+            return base
+        result = set(base)
+        result -= removed.get(node, frozenset())
+        result |= added.get(node, frozenset())
+        return sorted(result)
+
+    # Function: friends
+    # Friend zids of zid (empty if unknown)
+    def friends(self, zid):
+        node = self.index.get(zid)
+        if node == None:
+            return []
+        zids = self.zids
+        return [zids[i] for i in self.neighbour_ids(node)]
+
+    # Function: degree
+    def degree(self, zid):
+        node = self.index.get(zid)
+        if node == None:
+            return 0
+        return len(self.neighbour_ids(node))
+
+    # Function: is_friend
+    def is_friend(self, zid, friend_zid):
+        node = self.index.get(zid)
+        friend = self.index.get(friend_zid)
+        if node == None or friend == None:
+            return False
+        return friend in self.neighbour_ids(node)
+
+    # Function: mutual_friends
+    # zids that are friends of both zid1 and zid2
+    def mutual_friends(self, zid1, zid2):
+        node1 = self.index.get(zid1)
+        node2 = self.index.get(zid2)
+        if node1 == None or node2 == None:
+            return []
+        state = self.state
+        friends1 = self.neighbour_ids(node1, state)
+        friends2 = self.neighbour_ids(node2, state)
+        if len(friends1) > len(friends2):
+            friends1, friends2 = friends2, friends1
+        zids = self.zids
+        return [zids[i] for i in set(friends1).intersection(friends2)]
+
+    # Function: mutual_count
+    def mutual_count(self, zid1, zid2):
+        return len(self.mutual_friends(zid1, zid2))
+
+    # Function: shortest_path
+    # Bidirectional BFS from zid to target_zid, always expanding the smaller
+    # frontier by one whole level, so the first meeting gives a shortest path
+    # Input:
+    #       max_depth: longest path (number of friendships) searched
+    #       skip: skip(zid) -> True for nodes that may not be on the path
+    #             (the two ends are never skipped)
+    #       deadline: time.monotonic() value after which the search gives up,
+    #             checked before the neighbours of every node are scanned
+    # Output:
+    #       [zid, ..., target_zid], or None if not connected within max_depth
+    #       (raises SearchTimeout if the deadline passed first)
+    def shortest_path(self, zid, target_zid, max_depth = 6, skip = None, deadline = None):
+        source = self.index.get(zid)
+        target = self.index.get(target_zid)
+        if source == None or target == None:
+            return None
+        if source == target:
+            return [zid]
+        parents = {source: None}
+        target_parents = {target: None}
+        frontier = [source]
+        target_frontier = [target]
+        zids = self.zids
+        # one state for the whole search
+        state = self.state
+        for depth in range(max_depth):
+            if len(frontier) == 0 or len(target_frontier) == 0:
+                return None
+            # expand the smaller side
+            forward = len(frontier) <= len(target_frontier)
+            if not forward:
+                frontier, target_frontier = target_frontier, frontier
+                parents, target_parents = target_parents, parents
+            next_frontier = []
+            meet = None
+            for node in frontier:
+                if deadline != None and time.monotonic() > deadline:
+                    raise SearchTimeout()
+                for neighbour in self.neighbour_ids(node, state):
+                    if neighbour in parents:
+                        continue
+                    if neighbour in target_parents:
+                        parents[neighbour] = node
+                        meet = neighbour
+                        break
+                    if skip != None and skip(zids[neighbour]):
+                        continue
+                    parents[neighbour] = node
+                    next_frontier.append(neighbour)
+                if meet != None:
+                    break
+            frontier = next_frontier
+            if not forward:
+                frontier, target_frontier = target_frontier, frontier
+                parents, target_parents = target_parents, parents
+            if meet != None:
+                path = []
+                node = meet
+                while node != None:
+                    path.append(node)
+                    node = parents[node]
+                path.reverse()
+                node = target_parents[meet]
+                while node != None:
+                    path.append(node)
+                    node = target_parents[node]
+                return [zids[node] for node in path]
+        return None
+
+    # Function: add_edge
+    # Add the row zid -> friend_zid (idempotent)
+    def add_edge(self, zid, friend_zid):
+        with self.lock:
+            self.update_overlays(self.intern(zid), self.intern(friend_zid), True)
+
+    # Function: remove_edge
+    # Remove the row zid -> friend_zid (idempotent)
+    def remove_edge(self, zid, friend_zid):
+        with self.lock:
+            node, friend = self.index.get(zid), self.index.get(friend_zid)
+            if node == None or friend == None:
+                return
+            self.update_overlays(node, friend, False)
+
+    # Function: update_overlays
+    # Publish a new state where the row node -> friend is added (add) or
+    # removed, with copies of the overlays (under self.lock)
+    def update_overlays(self, node, friend, add):
+        offsets, neighbours, added, removed = self.state
+        in_base = friend in base_ids(offsets, neighbours, node)
+        node_added = set(added.get(node, ()))
+        node_removed = set(removed.get(node, ()))
+        if add:
+            node_removed.discard(friend)
+            if not in_base:
+                node_added.add(friend)
+        else:
+            node_added.discard(friend)
+            if in_base:
+                node_removed.add(friend)
+        added, removed = dict(added), dict(removed)
+        for overlay, nodes in [(added, node_added), (removed, node_removed)]:
+            if len(nodes) > 0:
+                overlay[node] = frozenset(nodes)
+            else:
+                overlay.pop(node, None)
+        self.state = (offsets, neighbours, added, removed)
+        if len(added) + len(removed) > COMPACT_THRESHOLD:
+            self.compact_locked()
+
+    # Function: compact
+    # Merge the overlays into new CSR arrays
+    def compact(self):
+        with self.lock:
+            self.compact_locked()
+
+    def compact_locked(self):
+        state = self.state
+        if len(state[2]) == 0 and len(state[3]) == 0:
+            return
+        offsets = array('i', [0])
+        neighbours = array('i')
+        for node in range(len(self.zids)):
+            neighbours.extend(self.neighbour_ids(node, state))
+            offsets.append(len(neighbours))
+        self.state = (offsets, neighbours, {}, {})
+
+    # Function: memory_bytes
+    # Approximate size of the adjacency arrays
+    def memory_bytes(self):
+        offsets, neighbours, added, removed = self.state
+        return 4 * (len(offsets) + len(neighbours))
+
+
+# Function: base_ids
+# Neighbour ids of node in the CSR arrays (nodes added since have none)
+def base_ids(offsets, neighbours, node):
+    if node + 1 < len(offsets):
+        return neighbours[offsets[node]:offsets[node + 1]]
+    return ()
@@ -0,0 +1,51 @@
+// Typeahead for the search box: students by zid or name prefix
+// from /api/autocomplete, friends first
+$(function () {
+  var script = $('#autocomplete-script');
+  var input = $('input[name=keyword]');
+  if (input.length == 0) {
+    return;
+  }
+  var menu = $('<ul class="dropdown-menu"></ul>').css('width', input.outerWidth());
+  input.attr('autocomplete', 'off').after(menu);
+  input.parent().css('position', 'relative');
+  var timer = null;
+  var last = null;
+
+  function render(results) {
+    menu.empty();
+    $.each(results, function (i, item) {
+      var link = $('<a></a>').attr('href', item.url);
+      link.append($('<img>').attr('src', item.profile_img).attr('width', 24).attr('height', 24));
+      link.append(document.createTextNode(' ' + item.full_name + ' (' + item.zid + ')'));
+      if (item.relation) {
+        link.append($('<small class="text-muted"></small>').text(' ' + item.relation));
+      }
+      menu.append($('<li></li>').append(link));
+    });
+    menu.toggle(results.length > 0);
+  }
+
+  input.on('input', function () {
+    clearTimeout(timer);
+    timer = setTimeout(function () {
+      var q = $.trim(input.val());
+      if (q == last) {
+        return;
+      }
+      last = q;
+      if (q == '') {
+        render([]);
+        return;
+      }
+      $.getJSON(script.data('url'), {q: q}, function (results) {
+        if (q == last) {
+          render(results);
+        }
+      });
+    }, 100);
+  });
+  input.on('blur', function () {
+    setTimeout(function () { menu.hide(); }, 200);
+  });
+});
@@ -0,0 +1,38 @@
+// Live notifications (new comments, replies, friends, mentions)
+// Listens to /notifications/stream and shows each event above the page content
+(function () {
+  if (!window.EventSource) {
+    return;
+  }
+  var script = document.getElementById('notifications-script');
+  var source = new EventSource(script.getAttribute('data-stream'));
+  var texts = {
+    'comment': ' commented on your post',
+    'reply': ' replied to a comment',
+    'friend': ' added you as a friend',
+    'mention': ' mentioned you'
+  };
+
+  function show(event) {
+    var data = JSON.parse(event.data);
+    var box = document.getElementById('notifications');
+    if (!box) {
+      box = document.createElement('div');
+      box.id = 'notifications';
+      box.className = 'container';
+      var section = document.getElementsByTagName('section')[0];
+      section.parentNode.insertBefore(box, section);
+    }
+    var alert = document.createElement('div');
+    alert.className = 'alert alert-info';
+    var link = document.createElement('a');
+    link.href = data.url;
+    link.textContent = data.full_name + texts[data.kind] + ' (' + data.time + ')';
+    alert.appendChild(link);
+    box.insertBefore(alert, box.firstChild);
+  }
+
+  for (var kind in texts) {
+    source.addEventListener(kind, show);
+  }
+})();
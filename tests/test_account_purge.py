@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# coding : utf-8
+
+# Reading threads while a deleted account's content is being purged
+# How to run: python -m pytest tests (or python -m unittest discover tests)
+# Each test runs on a new database in a temporary directory
+
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+# relative paths (db/, templates/) are resolved from the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+import UNSWtalk
+from shards import ShardMap
+
+
+AUTHOR = "z1000001"
+PURGED = "z1000002"
+
+
+class AccountPurgeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        path = os.path.join(self.temp_dir, "test.db")
+        with open("db/db_schema.sql") as f:
+            schema_sql = f.read()
+        conn = sqlite3.connect(path)
+        conn.executescript(schema_sql)
+        conn.close()
+        UNSWtalk.close_connections()
+        patches = [
+            mock.patch.object(UNSWtalk, 'SHARD_MAP', ShardMap([path])),
+            mock.patch.object(UNSWtalk, 'GRAPH_SNAPSHOT_PATH', os.path.join(self.temp_dir, "social_graph.bin")),
+            mock.patch.object(UNSWtalk, 'last_change_ids', None),
+            mock.patch.dict(UNSWtalk.social_graph, {'graph': None}),
+            mock.patch.dict(UNSWtalk.student_index, {'index': None}),
+            mock.patch.dict(UNSWtalk.app.config, {'TESTING': True, 'SECRET_KEY': "test"}),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        UNSWtalk.CACHE.clear()
+        UNSWtalk.upgrade_db()
+        with UNSWtalk.db_transaction() as cur:
+            for zid in [AUTHOR, PURGED]:
+                cur.execute("INSERT INTO STUDENT (zid, email, password, full_name, profile_img) VALUES (?, ?, ?, ?, ?)",
+                            [zid, zid + "@example.com", "password", "Student " + zid, "img/default.png"])
+            cur.execute("INSERT INTO POST (zid, time, message) VALUES (?, ?, ?)", [AUTHOR, 1000, "thread about purging"])
+            self.post_id = cur.lastrowid
+            cur.execute("INSERT INTO COMMENT (post_id, zid, time, message) VALUES (?, ?, ?, ?)", [self.post_id, PURGED, 1001, "comment of the purged"])
+            comment_id = cur.lastrowid
+            cur.execute("INSERT INTO REPLY (comment_id, zid, time, message) VALUES (?, ?, ?, ?)", [comment_id, PURGED, 1002, "reply of the purged"])
+            cur.execute("INSERT INTO COMMENT (post_id, zid, time, message) VALUES (?, ?, ?, ?)", [self.post_id, AUTHOR, 1003, "comment of the author"])
+            cur.execute("INSERT INTO POST (zid, time, message) VALUES (?, ?, ?)", [PURGED, 1004, "post of the purged about purging"])
+        self.client = UNSWtalk.app.test_client()
+        with self.client.session_transaction() as session:
+            session['zid'] = AUTHOR
+
+    def tearDown(self):
+        UNSWtalk.close_connections()
+        shutil.rmtree(self.temp_dir)
+
+    def count_rows(self, table, zid):
+        return UNSWtalk.db_read("SELECT count(*) FROM {} WHERE zid = ?".format(table), [zid])[0][0]
+
+    # The purge has not run yet (background thread): the purged account's
+    # comments, replies and posts are hidden instead of failing the page
+    def test_view_thread_while_purge_pending(self):
+        with mock.patch.object(UNSWtalk, 'DELETE_CHUNK_SIZE', 1), \
+             mock.patch.object(UNSWtalk, 'purge_account_content'), \
+             mock.patch.dict(UNSWtalk.app.config, {'MAINTENANCE_SCHEDULER': True}):
+            UNSWtalk.delete_account_data(PURGED)
+        self.assertEqual(self.count_rows('COMMENT', PURGED), 1)
+
+        response = self.client.get("/{}/{}/view_post_detail".format(AUTHOR, self.post_id))
+        self.assertEqual(response.status_code, 200)
+        page = response.get_data(as_text = True)
+        self.assertIn("comment of the author", page)
+        self.assertNotIn("comment of the purged", page)
+        self.assertNotIn("reply of the purged", page)
+
+        response = self.client.post("/search_results", data = {'keyword': "purging"})
+        self.assertEqual(response.status_code, 200)
+        page = response.get_data(as_text = True)
+        self.assertIn("thread about purging", page)
+        self.assertNotIn("post of the purged", page)
+
+    # Without the scheduler (CGI) the purge runs before the request returns
+    def test_purge_without_scheduler(self):
+        with mock.patch.object(UNSWtalk, 'DELETE_CHUNK_SIZE', 1), \
+             mock.patch.dict(UNSWtalk.app.config, {'MAINTENANCE_SCHEDULER': False}):
+            UNSWtalk.delete_account_data(PURGED)
+        for table in ['POST', 'COMMENT', 'REPLY']:
+            self.assertEqual(self.count_rows(table, PURGED), 0)
+        self.assertEqual(UNSWtalk.db_read("SELECT count(*) FROM ACCOUNT_PURGE", [])[0][0], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
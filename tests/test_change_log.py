@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# coding : utf-8
+
+# Polling CHANGE_LOG while other threads write
+# How to run: python -m pytest tests (or python -m unittest discover tests)
+# Each test runs on a new database in a temporary directory
+
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+# relative paths (db/, templates/) are resolved from the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+import UNSWtalk
+from shards import ShardMap
+
+
+# seconds a thread may take before it counts as stuck
+JOIN_TIMEOUT = 5
+
+
+class ChangeLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = path = os.path.join(self.temp_dir, "test.db")
+        with open("db/db_schema.sql") as f:
+            schema_sql = f.read()
+        conn = sqlite3.connect(path)
+        conn.executescript(schema_sql)
+        conn.close()
+        UNSWtalk.close_connections()
+        patches = [
+            mock.patch.object(UNSWtalk, 'SHARD_MAP', ShardMap([path])),
+            mock.patch.object(UNSWtalk, 'last_change_ids', None),
+            mock.patch.dict(UNSWtalk.change_log_prunes, {}),
+            mock.patch.object(UNSWtalk, 'CHANGE_LOG_KEEP', 0),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        UNSWtalk.CACHE.clear()
+        UNSWtalk.upgrade_db()
+        UNSWtalk.poll_changes()
+
+    # Log a change as another worker would (this one has not polled it)
+    def log_change(self, change_id):
+        with sqlite3.connect(self.path) as conn:
+            conn.execute("INSERT INTO CHANGE_LOG (id, tbl, op, zid) VALUES (?, 'STUDENT', 'U', 'z1000001')", [change_id])
+
+    def tearDown(self):
+        UNSWtalk.close_connections()
+        shutil.rmtree(self.temp_dir)
+
+    # A poll crossing a prune boundary while a writer holding the write lock
+    # caches a row: neither may wait for the other (the prune runs after)
+    def test_poll_during_write_transaction(self):
+        self.log_change(1500)
+        UNSWtalk.poll_changes()
+        self.log_change(2500)
+        writing = threading.Event()
+        polling = threading.Event()
+        writing_done = threading.Event()
+        errors = []
+
+        # holds CHANGE_LOCK until the writer tried to cache
+        def slow_listener(tbl, op, zid, ref):
+            polling.set()
+            writing_done.wait(JOIN_TIMEOUT)
+
+        def writer():
+            try:
+                with UNSWtalk.db_transaction():
+                    writing.set()
+                    polling.wait(JOIN_TIMEOUT)
+                    UNSWtalk.cache_put('STUDENT', 'z1000001', [], UNSWtalk.cache_generation)
+                    writing_done.set()
+            except Exception as error:
+                errors.append(error)
+
+        def poller():
+            try:
+                writing.wait(JOIN_TIMEOUT)
+                UNSWtalk.poll_changes()
+                UNSWtalk.prune_change_log()
+            except Exception as error:
+                errors.append(error)
+
+        with mock.patch.object(UNSWtalk, 'CHANGE_LISTENERS', UNSWtalk.CHANGE_LISTENERS + [slow_listener]):
+            threads = [threading.Thread(target = writer, daemon = True), threading.Thread(target = poller, daemon = True)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(JOIN_TIMEOUT)
+        self.assertFalse(any(thread.is_alive() for thread in threads), "deadlock")
+        self.assertEqual(errors, [])
+        self.assertTrue(writing_done.is_set())
+        self.assertEqual(UNSWtalk.db_read("SELECT count(*) FROM CHANGE_LOG", [])[0][0], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
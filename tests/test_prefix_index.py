@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# coding : utf-8
+
+# PrefixIndex and the autocomplete ranking (friends first)
+# How to run: python -m pytest tests (or python -m unittest discover tests)
+# The autocomplete tests run on a new database in a temporary directory
+
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+# relative paths (db/, templates/) are resolved from the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+import UNSWtalk
+from prefix_index import PrefixIndex, get_keys
+from shards import ShardMap
+
+
+class PrefixIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = PrefixIndex.from_students([
+            ("z5000001", "Pamela Anderson"),
+            ("z5000002", "Andrew  Smith"),
+            ("z5000003", "Sam Pam"),
+        ])
+
+    def test_keys(self):
+        self.assertEqual(get_keys("z5000002", "Andrew  Smith"), ["andrew", "andrew smith", "smith", "z5000002"])
+        self.assertEqual(get_keys("Z5000009", None), ["z5000009"])
+
+    def test_search(self):
+        # any word of the name, the zid, case-insensitive, each zid once, in key order
+        self.assertEqual(self.index.search("pam", 10), ["z5000003", "z5000001"])
+        self.assertEqual(self.index.search("AND", 10), ["z5000001", "z5000002"])
+        self.assertEqual(self.index.search("z500000", 10), ["z5000001", "z5000002", "z5000003"])
+        self.assertEqual(self.index.search("z500000", 2), ["z5000001", "z5000002"])
+        self.assertEqual(self.index.search("pamela a", 10), ["z5000001"])
+        self.assertEqual(self.index.search("  ", 10), [])
+        self.assertEqual(self.index.search("x", 10), [])
+
+    def test_add_and_remove(self):
+        self.index.add("z5000004", "Pam Lee")
+        self.assertEqual(self.index.search("pam", 10), ["z5000003", "z5000004", "z5000001"])
+        # a new name replaces the old keys
+        self.index.add("z5000001", "Rita Hall")
+        self.assertEqual(self.index.search("pam", 10), ["z5000003", "z5000004"])
+        self.assertEqual(self.index.search("rita", 10), ["z5000001"])
+        self.assertEqual(self.index.full_name("z5000001"), "Rita Hall")
+        self.index.remove("z5000003")
+        self.index.remove("z5000003")
+        self.assertEqual(self.index.search("pam", 10), ["z5000004"])
+        self.assertEqual(self.index.full_name("z5000003"), None)
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.index.entries, sorted(self.index.entries))
+
+    def test_matching(self):
+        self.assertEqual(self.index.matching(["z5000003", "z5000002", "z5000001", "unknown"], "pam"), ["z5000003", "z5000001"])
+        self.assertEqual(self.index.matching(["z5000003"], ""), [])
+
+
+VIEWER = "z5000000"
+FRIEND = "z5000098"
+FRIEND_OF_FRIEND = "z5000099"
+
+
+class AutocompleteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        path = os.path.join(self.temp_dir, "test.db")
+        with open("db/db_schema.sql") as f:
+            schema_sql = f.read()
+        conn = sqlite3.connect(path)
+        conn.executescript(schema_sql)
+        conn.close()
+        UNSWtalk.close_connections()
+        patches = [
+            mock.patch.object(UNSWtalk, 'SHARD_MAP', ShardMap([path])),
+            mock.patch.object(UNSWtalk, 'GRAPH_SNAPSHOT_PATH', os.path.join(self.temp_dir, "social_graph.bin")),
+            mock.patch.object(UNSWtalk, 'last_change_ids', None),
+            mock.patch.dict(UNSWtalk.social_graph, {'graph': None}),
+            mock.patch.dict(UNSWtalk.student_index, {'index': None}),
+            # the index scan alone stops before the friends
+            mock.patch.object(UNSWtalk, 'AUTOCOMPLETE_SCAN', 5),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        UNSWtalk.CACHE.clear()
+        UNSWtalk.upgrade_db()
+        # many "Sam" students sort before the friend and the friend of friend
+        with UNSWtalk.db_transaction() as cur:
+            students = [(VIEWER, "Viewer"), (FRIEND, "Sam Zed"), (FRIEND_OF_FRIEND, "Sam Zoe")]
+            students += [("z50000{:02d}".format(i), "Sam A{:02d}".format(i)) for i in range(1, 40)]
+            for zid, full_name in students:
+                cur.execute("INSERT INTO STUDENT (zid, password, full_name, profile_img) VALUES (?, 'password', ?, 'img/default.png')", [zid, full_name])
+            for zid, friend_zid in [(VIEWER, FRIEND), (FRIEND, FRIEND_OF_FRIEND)]:
+                cur.execute("INSERT INTO FRIENDS (zid, friend_zid) VALUES (?, ?)", [zid, friend_zid])
+                cur.execute("INSERT INTO FRIENDS (zid, friend_zid) VALUES (?, ?)", [friend_zid, zid])
+
+    def tearDown(self):
+        UNSWtalk.close_connections()
+        shutil.rmtree(self.temp_dir)
+
+    def autocomplete(self, prefix, limit = UNSWtalk.AUTOCOMPLETE_LIMIT):
+        with UNSWtalk.app.test_request_context():
+            return [(result['zid'], result['relation']) for result in UNSWtalk.get_autocomplete(VIEWER, prefix, limit)]
+
+    def test_friends_before_scan_limit(self):
+        self.assertEqual(UNSWtalk.get_student_index().search("sam", UNSWtalk.AUTOCOMPLETE_SCAN)[-1], "z5000005")
+        results = self.autocomplete("sam")
+        self.assertEqual(results[:2], [(FRIEND, 'friend'), (FRIEND_OF_FRIEND, 'friend of friend')])
+        self.assertEqual(results[2:], [("z50000{:02d}".format(i), None) for i in range(1, 6)])
+        self.assertEqual(self.autocomplete("sam", limit = 1), [(FRIEND, 'friend')])
+        # friends only come back if they match
+        self.assertEqual(self.autocomplete("sam a0", limit = 3), [("z5000001", None), ("z5000002", None), ("z5000003", None)])
+
+    def test_suspended_friend_hidden(self):
+        with UNSWtalk.db_transaction() as cur:
+            cur.execute("INSERT INTO TO_BE_SUSPENDED SELECT * FROM STUDENT WHERE zid = ?", [FRIEND])
+            cur.execute("DELETE FROM STUDENT WHERE zid = ?", [FRIEND])
+        self.assertEqual(self.autocomplete("sam z"), [(FRIEND_OF_FRIEND, 'friend of friend')])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# coding : utf-8
+
+# Shard map routing and id ranges, before and after rebalance_shards.py
+# How to run: python -m pytest tests (or python -m unittest discover tests)
+# The rebalance tests run in a temporary directory holding db/
+
+import os
+import sys
+import json
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+from contextlib import redirect_stdout
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+import UNSWtalk
+import rebalance_shards
+from shards import ShardMap, MAX_SHARDS, SHARD_ID_RANGE, seed_sequences
+
+
+ZIDS = ["z{:07d}".format(5000000 + i) for i in range(40)]
+
+
+class ShardMapTest(unittest.TestCase):
+
+    def test_routing(self):
+        shard_map = ShardMap(["a.db", "b.db", "c.db"])
+        shards = [shard_map.shard_for_zid(zid) for zid in ZIDS]
+        # the same on every call and for every map of the same size
+        self.assertEqual(shards, [ShardMap(["x", "y", "z"], 5).shard_for_zid(zid) for zid in ZIDS])
+        self.assertEqual(set(shards), {0, 1, 2})
+        groups = shard_map.group_by_shard(ZIDS)
+        self.assertEqual(sorted(zid for zids in groups.values() for zid in zids), ZIDS)
+        for shard, zids in groups.items():
+            self.assertTrue(all(shard_map.shard_for_zid(zid) == shard for zid in zids))
+        self.assertEqual(ShardMap(["only.db"]).shard_for_zid(ZIDS[0]), 0)
+
+    def test_id_ranges(self):
+        old_map = ShardMap(["a.db", "b.db"])
+        new_map = ShardMap(["c.db", "d.db", "e.db"], 1)
+        first_ids = [old_map.first_id(shard) for shard in range(2)] + [new_map.first_id(shard) for shard in range(3)]
+        self.assertEqual(len(set(first_ids)), 5)
+        for shard in range(3):
+            for row_id in [new_map.first_id(shard) + 1, new_map.first_id(shard) + SHARD_ID_RANGE - 1]:
+                self.assertEqual(new_map.shard_for_id(row_id), shard)
+                # an id of another generation is only a hint
+                self.assertEqual(old_map.shard_for_id(row_id), None)
+        self.assertEqual(old_map.shard_for_id(old_map.first_id(1) + 7), 1)
+        self.assertEqual(new_map.shard_for_id(old_map.first_id(1) + 7), None)
+        with self.assertRaises(ValueError):
+            ShardMap([])
+        with self.assertRaises(ValueError):
+            ShardMap(["x.db"] * (MAX_SHARDS + 1))
+
+    def test_seed_sequences(self):
+        conn = sqlite3.connect(":memory:")
+        conn.execute("CREATE TABLE POST (id INTEGER PRIMARY KEY AUTOINCREMENT, message TEXT)")
+        shard_map = ShardMap(["a.db", "b.db"], 2)
+        seed_sequences(conn, shard_map.first_id(1))
+        seed_sequences(conn, shard_map.first_id(1))
+        post_id = conn.execute("INSERT INTO POST (message) VALUES ('first')").lastrowid
+        self.assertEqual(post_id, shard_map.first_id(1) + 1)
+        self.assertEqual(shard_map.shard_for_id(post_id), 1)
+        conn.close()
+
+    def test_save_and_load(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        config_path = os.path.join(temp_dir, "shards.json")
+        ShardMap(["a.db", "b.db"], 3).save(config_path)
+        shard_map = ShardMap.load(config_path, "default.db")
+        self.assertEqual((shard_map.paths, shard_map.generation), (["a.db", "b.db"], 3))
+        self.assertEqual(ShardMap.load(os.path.join(temp_dir, "missing.json"), "default.db").paths, ["default.db"])
+
+
+class RebalanceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.temp_dir, "db"))
+        for name in ["db_schema.sql", "db_upgrade.sql"]:
+            shutil.copy(os.path.join(ROOT, "db", name), os.path.join(self.temp_dir, "db", name))
+        os.chdir(self.temp_dir)
+        self.addCleanup(os.chdir, ROOT)
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.old_map = ShardMap(["db/test.shard{}.db".format(shard) for shard in range(2)])
+        patches = [
+            mock.patch.object(UNSWtalk, 'SHARD_MAP', self.old_map),
+            mock.patch.object(UNSWtalk, 'DATABASE_NAME', "test"),
+            mock.patch.object(UNSWtalk, 'SHARD_CONFIG_PATH', "db/test.shards.json"),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        conns = rebalance_shards.create_shards(self.old_map)
+        self.fill(conns)
+        for conn in conns:
+            conn.commit()
+            conn.close()
+
+    # Students, friendships and threads, each row on the shard of its zid / post
+    def fill(self, conns):
+        def cursor(zid):
+            return conns[self.old_map.shard_for_zid(zid)]
+        for zid in ZIDS:
+            cursor(zid).execute("INSERT INTO STUDENT (zid, password, full_name) VALUES (?, 'password', ?)", [zid, "Student " + zid])
+        for i, zid in enumerate(ZIDS):
+            friend_zid = ZIDS[(i * 7 + 3) % len(ZIDS)]
+            if friend_zid != zid:
+                cursor(zid).execute("INSERT OR IGNORE INTO FRIENDS (zid, friend_zid) VALUES (?, ?)", [zid, friend_zid])
+                cursor(friend_zid).execute("INSERT OR IGNORE INTO FRIENDS (zid, friend_zid) VALUES (?, ?)", [friend_zid, zid])
+        # id -> zid of the post author, for every post / comment / reply
+        self.rows = {'POST': {}, 'COMMENT': {}, 'REPLY': {}}
+        for i, zid in enumerate(ZIDS):
+            conn = cursor(zid)
+            shard = self.old_map.shard_for_zid(zid)
+            post_id = conn.execute("INSERT INTO POST (zid, time, message) VALUES (?, ?, ?)", [zid, 1000 + i, "post " + zid]).lastrowid
+            self.rows['POST'][post_id] = zid
+            # comments and replies by other students stay with the post
+            commenter = ZIDS[(i + 1) % len(ZIDS)]
+            comment_id = conn.execute("INSERT INTO COMMENT (post_id, zid, time, message) VALUES (?, ?, ?, ?)",
+                                      [post_id, commenter, 2000 + i, "comment"]).lastrowid
+            self.rows['COMMENT'][comment_id] = zid
+            reply_id = conn.execute("INSERT INTO REPLY (comment_id, zid, time, message) VALUES (?, ?, ?, ?)",
+                                    [comment_id, ZIDS[(i + 2) % len(ZIDS)], 3000 + i, "reply"]).lastrowid
+            self.rows['REPLY'][reply_id] = zid
+            self.assertEqual(self.old_map.shard_for_id(post_id), shard)
+
+    # Rows of table on each shard of shard_map: [{id: row}]
+    def read_rows(self, shard_map, table, key = 'id'):
+        shards = []
+        for path in shard_map.paths:
+            conn = sqlite3.connect(path)
+            conn.row_factory = sqlite3.Row
+            shards.append({row[key]: dict(row) for row in conn.execute("SELECT * FROM {}".format(table))})
+            conn.close()
+        return shards
+
+    def rebalance(self, count):
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            rebalance_shards.rebalance(count)
+        with open("db/test.shards.json") as f:
+            config = json.load(f)
+        return ShardMap(config['paths'], config['generation'])
+
+    def test_rows_follow_their_zid(self):
+        new_map = self.rebalance(3)
+        self.assertEqual((new_map.count, new_map.generation), (3, 1))
+        self.assertFalse(set(new_map.paths) & set(self.old_map.paths))
+        students = self.read_rows(new_map, 'STUDENT', 'zid')
+        self.assertEqual(sorted(zid for shard in students for zid in shard), ZIDS)
+        for shard, rows in enumerate(students):
+            self.assertTrue(all(new_map.shard_for_zid(zid) == shard for zid in rows))
+        old_friends = sum(len(rows) for rows in self.read_rows(self.old_map, 'FRIENDS'))
+        self.assertEqual(sum(len(rows) for rows in self.read_rows(new_map, 'FRIENDS')), old_friends)
+        # posts / comments / replies keep their ids and stay with the post's author
+        for table, ids in self.rows.items():
+            shards = self.read_rows(new_map, table)
+            self.assertEqual(sorted(row_id for rows in shards for row_id in rows), sorted(ids))
+            for shard, rows in enumerate(shards):
+                for row_id in rows:
+                    self.assertEqual(new_map.shard_for_zid(ids[row_id]), shard)
+                    # old ids are not taken for ids of the new generation
+                    self.assertEqual(new_map.shard_for_id(row_id), None)
+        # the triggers' counters are right (not doubled by the copy)
+        for rows in self.read_rows(new_map, 'POST'):
+            for post in rows.values():
+                self.assertEqual((post['comment_count'], post['reply_count']), (1, 1))
+
+    # New rows get ids of the new generation, on the shard that allocated them
+    def test_new_ids_after_rebalance(self):
+        new_map = self.rebalance(3)
+        old_ids = set(self.rows['POST'])
+        for zid in ZIDS[:6]:
+            shard = new_map.shard_for_zid(zid)
+            conn = sqlite3.connect(new_map.paths[shard])
+            post_id = conn.execute("INSERT INTO POST (zid, time, message) VALUES (?, 5000, 'new')", [zid]).lastrowid
+            conn.commit()
+            conn.close()
+            self.assertNotIn(post_id, old_ids)
+            self.assertEqual(new_map.shard_for_id(post_id), shard)
+
+    # Rebalancing to the same number of shards moves no student
+    def test_same_count_keeps_routing(self):
+        old_students = self.read_rows(self.old_map, 'STUDENT', 'zid')
+        new_map = self.rebalance(2)
+        self.assertEqual([sorted(rows) for rows in self.read_rows(new_map, 'STUDENT', 'zid')], [sorted(rows) for rows in old_students])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# coding : utf-8
+
+# SocialGraph: overlays, compaction, snapshots and the connection search
+# How to run: python -m pytest tests (or python -m unittest discover tests)
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from social_graph import SocialGraph, SearchTimeout
+
+
+# Function: friendships
+# Both FRIENDS rows of each (zid, friend_zid) pair
+def friendships(pairs):
+    return [row for zid, friend_zid in pairs for row in [(zid, friend_zid), (friend_zid, zid)]]
+
+
+# Function: adjacency
+# zid -> set of friend zids of graph
+def adjacency(graph):
+    return {zid: set(graph.friends(zid)) for zid in graph.zids}
+
+
+# Function: bfs_distance
+# Length of the shortest path in adjacency (dict of sets), not through skipped zids
+def bfs_distance(friends, zid, target_zid, skip = ()):
+    distances = {zid: 0}
+    frontier = [zid]
+    while len(frontier) > 0:
+        next_frontier = []
+        for node in frontier:
+            for friend in friends.get(node, ()):
+                if friend in distances or (friend in skip and friend != target_zid):
+                    continue
+                distances[friend] = distances[node] + 1
+                next_frontier.append(friend)
+        frontier = next_frontier
+    return distances.get(target_zid)
+
+
+class OverlayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = SocialGraph.from_edges(friendships([("z1", "z2"), ("z2", "z3"), ("z3", "z4")]))
+
+    def test_add_remove_then_compact(self):
+        graph = self.graph
+        for edge in friendships([("z1", "z3"), ("z4", "z5")]):
+            graph.add_edge(*edge)
+        for edge in friendships([("z2", "z3")]):
+            graph.remove_edge(*edge)
+        # adding an edge already there, removing one that is not: no-ops
+        graph.add_edge("z1", "z2")
+        graph.remove_edge("z1", "z4")
+        expected = {"z1": {"z2", "z3"}, "z2": {"z1"}, "z3": {"z1", "z4"}, "z4": {"z3", "z5"}, "z5": {"z4"}}
+        self.assertEqual(adjacency(graph), expected)
+        self.assertTrue(graph.is_friend("z5", "z4"))
+        self.assertEqual(graph.degree("z3"), 2)
+
+        graph.compact()
+        offsets, neighbours, added, removed = graph.state
+        self.assertEqual((added, removed), ({}, {}))
+        self.assertEqual(len(offsets), len(graph.zids) + 1)
+        self.assertEqual(adjacency(graph), expected)
+
+    # Removing then adding back an edge of the CSR arrays leaves no overlay
+    def test_remove_then_add_back(self):
+        self.graph.remove_edge("z2", "z3")
+        self.assertFalse(self.graph.is_friend("z2", "z3"))
+        self.graph.add_edge("z2", "z3")
+        self.assertEqual(self.graph.state[2:], ({}, {}))
+        self.assertTrue(self.graph.is_friend("z2", "z3"))
+
+    def test_mutual_friends(self):
+        self.graph.add_edge("z1", "z3")
+        self.graph.add_edge("z3", "z1")
+        self.assertEqual(self.graph.mutual_friends("z1", "z3"), ["z2"])
+        self.assertEqual(self.graph.mutual_count("z2", "z4"), 1)
+        self.assertEqual(self.graph.mutual_friends("z1", "unknown"), [])
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.path = os.path.join(self.temp_dir, "social_graph.bin")
+
+    def test_round_trip(self):
+        rng = random.Random(1)
+        zids = ["z{:07d}".format(i) for i in range(200)]
+        pairs = set((rng.choice(zids), rng.choice(zids)) for i in range(600))
+        graph = SocialGraph.from_edges(friendships((a, b) for a, b in pairs if a != b), change_id = 42)
+        # changes still in the overlays (and a new student) are saved too
+        for edge in friendships([(zids[0], "z9999999"), (zids[1], zids[2])]):
+            graph.add_edge(*edge)
+        removed_friend = graph.friends(zids[3])[0]
+        for edge in friendships([(zids[3], removed_friend)]):
+            graph.remove_edge(*edge)
+        expected = adjacency(graph)
+        graph.save_snapshot(self.path)
+
+        loaded = SocialGraph.load_snapshot(self.path)
+        self.assertEqual(loaded.change_id, 42)
+        self.assertEqual(loaded.zids, graph.zids)
+        self.assertEqual(adjacency(loaded), expected)
+        # the memory-mapped arrays take overlays like built ones
+        loaded.add_edge(zids[5], zids[6])
+        self.assertIn(zids[6], loaded.friends(zids[5]))
+
+    def test_not_a_snapshot(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'\0' * 64)
+        with self.assertRaises(ValueError):
+            SocialGraph.load_snapshot(self.path)
+
+
+class ShortestPathTest(unittest.TestCase):
+
+    def test_path_around_skipped_nodes(self):
+        # a - b - d is the shortest, a - c - e - d avoids b
+        graph = SocialGraph.from_edges(friendships([("a", "b"), ("b", "d"), ("a", "c"), ("c", "e"), ("e", "d")]))
+        self.assertEqual(graph.shortest_path("a", "d"), ["a", "b", "d"])
+        self.assertEqual(graph.shortest_path("a", "d", skip = {"b"}.__contains__), ["a", "c", "e", "d"])
+        self.assertEqual(graph.shortest_path("a", "d", max_depth = 2, skip = {"b"}.__contains__), None)
+        self.assertEqual(graph.shortest_path("a", "d", skip = {"b", "e"}.__contains__), None)
+        # the two ends are never skipped
+        self.assertEqual(graph.shortest_path("a", "b", skip = {"a", "b"}.__contains__), ["a", "b"])
+        self.assertEqual(graph.shortest_path("a", "a"), ["a"])
+        self.assertEqual(graph.shortest_path("a", "unknown"), None)
+
+    # Paths are shortest (compared with a plain BFS) and made of friendships
+    def test_random_graphs(self):
+        rng = random.Random(7)
+        for trial in range(20):
+            zids = ["z{}".format(i) for i in range(60)]
+            pairs = set((rng.choice(zids), rng.choice(zids)) for i in range(80))
+            graph = SocialGraph.from_edges(friendships((a, b) for a, b in pairs if a != b))
+            friends = adjacency(graph)
+            skipped = set(rng.sample(graph.zids, 5))
+            for i in range(20):
+                zid, target_zid = rng.choice(graph.zids), rng.choice(graph.zids)
+                path = graph.shortest_path(zid, target_zid, max_depth = 60, skip = skipped.__contains__)
+                distance = bfs_distance(friends, zid, target_zid, skipped)
+                if distance == None:
+                    self.assertEqual(path, None)
+                    continue
+                self.assertEqual(len(path) - 1, distance)
+                self.assertEqual((path[0], path[-1]), (zid, target_zid))
+                for a, b in zip(path, path[1:]):
+                    self.assertIn(b, friends[a])
+                self.assertFalse(skipped.intersection(path[1:-1]))
+
+    def test_deadline(self):
+        graph = SocialGraph.from_edges(friendships([("a", "b"), ("b", "c")]))
+        with self.assertRaises(SearchTimeout):
+            graph.shortest_path("a", "c", deadline = time.monotonic() - 1)
+
+
+if __name__ == "__main__":
+    unittest.main()